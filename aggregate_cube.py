@@ -0,0 +1,192 @@
+import hashlib
+import io
+import json
+import os
+import numpy as np
+import pandas as pd
+import analyze_certificates as analysis
+import constants
+from scan_metrics import write_atomic
+
+# Suffixes kept in the cube: every region, so one cube serves all of them
+ALL_SUFFIXES = [suffix for suffixes in constants.regions.values() for suffix in suffixes]
+
+CUBE_COLUMNS = ['suffix', 'company', 'country', 'expiration_group', 'count']
+
+# Bytes hashed at each end of the already-processed part of a CSV source
+_SAMPLE_BYTES = 1 << 20
+
+class _BoundedReader(io.RawIOBase):
+    # Read a file only up to 'end', so a half-written last line is left for next time
+    def __init__(self, file, end):
+        self.file = file
+        self.end = end
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        size = min(len(buffer), self.end - self.file.tell())
+        if size <= 0:
+            return 0
+        data = self.file.read(size)
+        buffer[:len(data)] = data
+        return len(data)
+
+def _prefix_hash(path, length):
+    # Hash the start and end of the first 'length' bytes of the file
+    digest = hashlib.sha256()
+    with open(path, mode='rb') as file:
+        digest.update(file.read(min(length, _SAMPLE_BYTES)))
+        file.seek(max(length - _SAMPLE_BYTES, 0))
+        digest.update(file.read(min(length, _SAMPLE_BYTES)))
+    return digest.hexdigest()
+
+def _complete_lines_end(path, size):
+    # Offset just past the last newline of the file
+    with open(path, mode='rb') as file:
+        position = size
+        while position > 0:
+            start = max(position - 65536, 0)
+            file.seek(start)
+            block = file.read(position - start)
+            newline = block.rfind(b'\n')
+            if newline >= 0:
+                return start + newline + 1
+            position = start
+    return 0
+
+def _count(df):
+    df = analysis.prepare_certificates(df, ALL_SUFFIXES)
+    return analysis.aggregate_counts(df)
+
+def _csv_increment(source, meta, seen, chunksize):
+    """
+    Count the leaf rows added to a CSV scan output since 'meta' was written.
+    A row is a leaf when its domain was not seen before, in this increment
+    or an earlier one ('seen' holds their hashes and is returned updated).
+    """
+    size = os.path.getsize(source)
+    end = _complete_lines_end(source, size)
+    offset = meta.get('offset', 0)
+    partial = []
+
+    with open(source, mode='rb') as file:
+        header = file.readline().decode('utf-8').rstrip('\r\n').split(',')
+        file.seek(max(offset, file.tell()))
+        if file.tell() >= end:
+            # Nothing but a half-written line (or nothing at all) since last time
+            meta.update({'offset': max(offset, file.tell()),
+                         'prefix_hash': _prefix_hash(source, max(offset, file.tell()))})
+            return partial, seen
+        reader = io.BufferedReader(_BoundedReader(file, end))
+        for chunk in pd.read_csv(reader, names=header, header=None, usecols=analysis.LEAF_COLUMNS,
+                                 dtype=analysis.LEAF_DTYPES, chunksize=chunksize):
+            if chunk.empty:
+                continue
+            first, seen = analysis.first_rows(chunk['domain'], seen)
+            partial.append(_count(chunk[first]))
+
+    meta.update({'offset': end, 'prefix_hash': _prefix_hash(source, end)})
+    return partial, seen
+
+def _parquet_increment(source, meta, seen):
+    # Parquet parts are immutable once closed; count the ones not counted yet.
+    # Leaf rows are selected as for a CSV source, 'seen' holding domain hashes
+    counted = set(meta.get('parts', []))
+    parts = sorted(name for name in os.listdir(source) if name.endswith('.parquet'))
+    partial = []
+    for name in parts:
+        if name not in counted:
+            df = pd.read_parquet(os.path.join(source, name), columns=analysis.LEAF_COLUMNS,
+                                 filters=[('chain_position', '==', 0)])
+            first, seen = analysis.first_rows(df['domain'], seen)
+            partial.append(_count(df[first]))
+    meta['parts'] = parts
+    return partial, seen
+
+def _is_current(source, meta):
+    # The processed part of the source must be unchanged for the cube to be reused
+    if meta.get('version') != 3:
+        return False
+    if os.path.isdir(source):
+        return set(meta.get('parts', [])) <= set(os.listdir(source))
+    offset = meta.get('offset', 0)
+    return os.path.getsize(source) >= offset and meta.get('prefix_hash') == _prefix_hash(source, offset)
+
+def load_cube(source, cube_path=None, chunksize=500000):
+    """
+    Return the aggregate counts (suffix x issuer organization x issuer
+    country x expiration group) of a scan output, as produced by
+    analyze_certificates.aggregate_counts for every region suffix.
+
+    The cube is stored next to the source and brought up to date on each
+    call: rows appended since the last call are counted and merged in, and
+    the cube is rebuilt from scratch if the source changed otherwise
+    (truncated, or the processed part's hash differs).
+
+    The cube, the hashes of its domains and its meta file are each replaced
+    atomically, meta last: meta records how many domains and certificates
+    were counted, and a cube or hash file that does not match it (left by
+    a crash between the writes) is rebuilt.
+    """
+    if cube_path is None:
+        cube_path = source.rstrip('/') + '.cube.csv'
+    meta_path = cube_path + '.json'
+    # Hashes of the domains counted so far
+    seen_path = cube_path + '.seen.npy'
+
+    cube, meta = None, {}
+    seen = np.empty(0, dtype=np.uint64)
+    if all(os.path.exists(path) for path in (cube_path, meta_path, seen_path)):
+        with open(meta_path, mode='r', encoding='utf-8') as file:
+            meta = json.load(file)
+        cube = _read_cube(cube_path)
+        if _is_current(source, meta) and _matches_meta(cube, seen_path, meta):
+            # Unchanged since the last call: nothing to read from the source
+            if meta.get('mtime') == os.path.getmtime(source) and meta.get('size') == _source_size(source):
+                return cube
+            seen = np.load(seen_path)
+        else:
+            cube, meta = None, {}
+
+    if os.path.isdir(source):
+        partial, seen = _parquet_increment(source, meta, seen)
+    else:
+        partial, seen = _csv_increment(source, meta, seen, chunksize)
+
+    for counts in partial:
+        cube = analysis.merge_counts(cube, counts)
+    if cube is None:
+        cube = pd.DataFrame(columns=CUBE_COLUMNS)
+
+    with open(seen_path + '.tmp', mode='wb') as file:
+        np.save(file, seen)
+    os.replace(seen_path + '.tmp', seen_path)
+    write_atomic(cube_path, cube.to_csv(index=False))
+    meta.update({'version': 3, 'mtime': os.path.getmtime(source), 'size': _source_size(source),
+                 'domains': len(seen), 'certificates': int(cube['count'].sum())})
+    write_atomic(meta_path, json.dumps(meta))
+    return cube
+
+def _matches_meta(cube, seen_path, meta):
+    # The cube and hashes are the ones meta was written for
+    domains = len(np.load(seen_path, mmap_mode='r'))
+    return domains == meta.get('domains') and int(cube['count'].sum()) == meta.get('certificates')
+
+def _source_size(source):
+    if os.path.isdir(source):
+        return sum(os.path.getsize(os.path.join(source, name)) for name in os.listdir(source))
+    return os.path.getsize(source)
+
+def _read_cube(cube_path):
+    cube = pd.read_csv(cube_path, dtype={'suffix': str, 'company': str, 'country': str,
+                                         'expiration_group': str, 'count': 'int64'},
+                       keep_default_na=False, na_values=[''])
+    cube['expiration_group'] = pd.Categorical(cube['expiration_group'],
+                                              categories=analysis.EXPIRATION_LABELS, ordered=True)
+    return cube
+
+def region_counts(cube, suffixes):
+    # The part of a cube covering one region's suffixes
+    return cube[cube['suffix'].isin(suffixes)]
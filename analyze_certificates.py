@@ -1,19 +1,35 @@
+import numpy as np
 import pandas as pd
 import matplotlib.pyplot as plt
 import seaborn as sns
-import pycountry
 import constants
+from suffix_classifier import SuffixClassifier
+from issuer_fields import ALPHA2_TO_ALPHA3, ALPHA2_TO_NAME, alpha_2_to_alpha_3, map_categories, parse_issuers, split_dn
+
+def finish_plot(output_file=None):
+    # Show the figure interactively, or save it and free it when running headless
+    if output_file is None:
+        plt.show()
+    else:
+        plt.savefig(output_file)
+        plt.close()
 
 def plot_eu_vs_non_eu_individual_counts(df, eu_country_codes):
-    # Remove the 'C=' prefix from the 'country' column
-    df['country_code'] = df['country'].apply(lambda c: c.split('=')[1] if isinstance(c, str) and c.startswith('C=') else None)
+    # 'eu_country_codes' are alpha-2 codes; a cube stores alpha-3 ones
+    if is_counts(df):
+        country_counts = counts_by(df, 'country')
+        eu_country_codes = [ALPHA2_TO_ALPHA3.get(code, code) for code in eu_country_codes]
+    else:
+        # Remove the 'C=' prefix from the 'country' column (once per distinct value)
+        df['country_code'] = map_categories(df['country'], lambda c: c.split('=')[1] if isinstance(c, str) and c.startswith('C=') else None)
+        country_counts = df['country_code'].value_counts()
 
     # Classify each domain's country as 'EU' or 'Non-EU'
-    df['is_eu'] = df['country_code'].apply(lambda c: 'EU' if c in eu_country_codes else 'Non-EU')
+    is_eu = country_counts.index.isin(eu_country_codes)
 
     # Count the number of domains for EU countries (grouped into one) and non-EU countries (individually)
-    eu_count = df[df['is_eu'] == 'EU'].shape[0]
-    non_eu_counts = df[df['is_eu'] == 'Non-EU']['country_code'].value_counts()
+    eu_count = int(country_counts[is_eu].sum())
+    non_eu_counts = country_counts[~is_eu].sort_values(ascending=False)
 
     # Create a DataFrame for plotting
     data = {
@@ -42,6 +58,11 @@ def plot_eu_vs_non_eu_individual_counts(df, eu_country_codes):
     plt.show()
 
 def plot_combined_top_4_country_counts(df_filtered, country_counts_by_suffix, suffixes):
+    # Country counts per suffix, or an aggregate_counts() table to take them from
+    if isinstance(country_counts_by_suffix, pd.DataFrame) and is_counts(country_counts_by_suffix):
+        country_counts_by_suffix = {suffix: counts_by(country_counts_by_suffix, 'country', suffix)
+                                    for suffix in suffixes}
+
     # Create an empty list to store the data for the plot
     plot_data = []
 
@@ -85,16 +106,17 @@ def plot_combined_top_4_country_counts(df_filtered, country_counts_by_suffix, su
 
 # Function to extract the 'C=' field from the issuer string
 def extract_country(issuer):
-    # Split the issuer string by commas
-    fields = issuer.split(',')
-    # Find the field that starts with 'C='
-    for field in fields:
-        if field.strip().startswith('C='):
-            return field.strip()
-    return None
+    country = split_dn(issuer).get('C')
+    return None if country is None else f'C={country}'
 
 # Function to plot the top 4 country counts for a given suffix (without normalization)
-def plot_top_4_country_counts(suffix, counts, total_domains):
+def plot_top_4_country_counts(suffix, counts, total_domains=None):
+    # 'counts' is the suffix's country counts, or an aggregate_counts() table to take them from
+    if isinstance(counts, pd.DataFrame) and is_counts(counts):
+        counts = counts_by(counts, 'country', suffix)
+    if total_domains is None:
+        total_domains = int(counts.sum())
+
     # Get the top 4 countries by count
     top_4_counts = counts.nlargest(4)
     
@@ -122,7 +144,10 @@ def plot_top_4_country_counts(suffix, counts, total_domains):
 
 def plot_top_countries_percentage(df, country_column='country'):
     # Count the occurrences of each country
-    country_counts = df[country_column].value_counts()
+    if is_counts(df):
+        country_counts = counts_by(df, country_column)
+    else:
+        country_counts = df[country_column].value_counts()
 
     # Calculate the total number of domains
     total_domains = country_counts.sum()
@@ -165,17 +190,28 @@ def extract_company(issuer):
     Extracts the company name from the 'issuer' field.
     Assumes the format 'O=company_name' where 'O=' precedes the company name.
     """
-    # Split the issuer string by commas
-    fields = issuer.split(',')
-    # Find the field that starts with 'O='
-    for field in fields:
-        if field.strip().startswith('O='):
-            return field.strip().split('=')[1]  # Return the company name after 'O='
-    return None
+    return split_dn(issuer).get('O')
+
+def plot_company_counts(company_counts, title, output_file=None):
+    # Plotting the top 5 companies from precomputed counts
+    plt.figure()
+    company_counts.nlargest(5).plot(kind='bar', color='skyblue')
+    plt.title(title)
+    plt.ylabel('Certificate Count')
+    plt.xlabel('Company')
+    plt.xticks(rotation=45, ha='right')
+    plt.tight_layout()
+    finish_plot(output_file)
 
 def plot_top_5_companies_by_suffix(df):
+    if is_counts(df):
+        # Precomputed counts: sum them per suffix instead of counting rows
+        for suffix in df['suffix'].dropna().unique():
+            plot_company_counts(counts_by(df, 'company', suffix), f"Top 5 Companies for {suffix} Suffix")
+        return
+
     # Add a new column for company names extracted from 'issuer'
-    df['company'] = df['issuer'].apply(extract_company)
+    df['company'] = parse_issuers(df['issuer'], attributes=('O',))['O']
     
     # Group by suffix and find the top 5 companies for each suffix
     for suffix in df['suffix'].unique():
@@ -183,32 +219,24 @@ def plot_top_5_companies_by_suffix(df):
         suffix_df = df[df['suffix'] == suffix]
         
         # Count occurrences of each company
-        company_counts = suffix_df['company'].value_counts().nlargest(5)
+        company_counts = suffix_df['company'].value_counts()
         
         # Plotting the top 5 companies for the current suffix
-        company_counts.plot(kind='bar', color='skyblue')
-        plt.title(f"Top 5 Companies for {suffix} Suffix")
-        plt.ylabel('Certificate Count')
-        plt.xlabel('Company')
-        plt.xticks(rotation=45, ha='right')
-        plt.tight_layout()
-        plt.show()
+        plot_company_counts(company_counts, f"Top 5 Companies for {suffix} Suffix")
 
 def plot_top_5_companies_overall(df):
+    if is_counts(df):
+        plot_company_counts(counts_by(df, 'company'), "Top 5 Companies Overall")
+        return
+
     # Add a new column for company names extracted from 'issuer'
-    df['company'] = df['issuer'].apply(extract_company)
+    df['company'] = parse_issuers(df['issuer'], attributes=('O',))['O']
     
     # Count occurrences of each company across the entire dataframe
-    company_counts = df['company'].value_counts().nlargest(5)
+    company_counts = df['company'].value_counts()
     
     # Plotting the top 5 companies overall
-    company_counts.plot(kind='bar', color='skyblue')
-    plt.title("Top 5 Companies Overall")
-    plt.ylabel('Certificate Count')
-    plt.xlabel('Company')
-    plt.xticks(rotation=45, ha='right')
-    plt.tight_layout()
-    plt.show()
+    plot_company_counts(company_counts, "Top 5 Companies Overall")
 
 def cap_out_of_bounds_dates(series, min_date=None, max_date=None):
     """
@@ -226,114 +254,226 @@ def cap_out_of_bounds_dates(series, min_date=None, max_date=None):
     
     return series
 
-def plot_cert_expiration_by_suffix(df):
+# Bins and labels for the expiration groups, in years of validity
+EXPIRATION_BINS = [-float('inf'), 1, 5, 10, float('inf')]
+EXPIRATION_LABELS = ['< 1 year', '1-5 years', '5-10 years', '> 10 years']
+
+def expiration_group(df):
+    """
+    Bucket each certificate's validity period into EXPIRATION_LABELS.
+    Rows where 'not_after' is not later than 'not_before' get NaN.
+    """
     # Define the cap limits for datetime (min_date is optional if you want to set lower bounds)
     max_valid_date = '2262-04-11'
 
     # Ensure 'not_before' and 'not_after' are capped to avoid out-of-bounds dates
-    df['not_before'] = cap_out_of_bounds_dates(df['not_before'])
-    df['not_after'] = cap_out_of_bounds_dates(df['not_after'], max_date=max_valid_date)
-
-    # Filter out rows where 'not_after' is earlier than 'not_before'
-    df = df[df['not_after'] > df['not_before']]
-
-    # Calculate the certificate duration (in years)
-    df['Years to Expiration'] = (df['not_after'] - df['not_before']).dt.total_seconds() / (365 * 24 * 3600)
-
-    # Define bins and labels for the expiration groups
-    bins = [-float('inf'), 1, 5, 10, float('inf')]
-    labels = ['< 1 year', '1-5 years', '5-10 years', '> 10 years']
+    not_before = cap_out_of_bounds_dates(df['not_before'])
+    not_after = cap_out_of_bounds_dates(df['not_after'], max_date=max_valid_date)
+
+    # Calculate the certificate duration (in years), leaving out rows where
+    # 'not_after' is earlier than 'not_before'
+    years = (not_after - not_before).dt.total_seconds() / (365 * 24 * 3600)
+    years = years.where(not_after > not_before)
+
+    # Categorize the expiration into intervals
+    return pd.cut(years, bins=EXPIRATION_BINS, labels=EXPIRATION_LABELS)
+
+def plot_expiration_counts(counts, title, output_file=None):
+    # Plotting a certificate expiration distribution from precomputed counts
+    plt.figure()
+    counts.plot(kind='bar', stacked=True, color='skyblue')
+    plt.title(title)
+    plt.ylabel('Certificate Count')
+    plt.xlabel('Expiration Group')
+    plt.xticks(rotation=0)
+    plt.tight_layout()
+    finish_plot(output_file)
 
-    # Create a new column that categorizes the expiration into intervals
-    df['Expiration Group'] = pd.cut(df['Years to Expiration'], bins=bins, labels=labels)
+def plot_cert_expiration_by_suffix(df):
+    if is_counts(df):
+        # Precomputed counts: sum them per suffix and expiration group
+        grouped = (df.groupby(['suffix', 'expiration_group'], observed=False)['count'].sum()
+                   .unstack(fill_value=0).rename_axis(columns='Expiration Group'))
+    else:
+        # Create a new column that categorizes the expiration into intervals
+        df = df.assign(**{'Expiration Group': expiration_group(df)})
 
-    # Group by suffix and expiration group, then count the certificates
-    grouped = df.groupby(['suffix', 'Expiration Group']).size().unstack(fill_value=0)
+        # Group by suffix and expiration group, then count the certificates
+        grouped = df.groupby(['suffix', 'Expiration Group'], observed=False).size().unstack(fill_value=0)
 
     # Plotting certificate expiration distribution for each suffix
     for suffix in grouped.index:
-        grouped.loc[suffix].plot(kind='bar', stacked=True)
-        plt.title(f"Certificate Expiration Distribution for .{suffix} Domains")
-        plt.ylabel('Certificate Count')
-        plt.xlabel('Expiration Group')
-        plt.xticks(rotation=0)
-        plt.tight_layout()
-        plt.show()
+        plot_expiration_counts(grouped.loc[suffix], f"Certificate Expiration Distribution for .{suffix} Domains")
 
 def plot_cert_expiration_overall(df):
-    # Define the cap limits for datetime (min_date is optional if you want to set lower bounds)
-    max_valid_date = '2262-04-11'
+    if is_counts(df):
+        grouped = counts_by(df, 'expiration_group')
+    else:
+        # Create a new column that categorizes the expiration into intervals
+        df = df.assign(**{'Expiration Group': expiration_group(df)})
 
-    # Ensure 'not_before' and 'not_after' are capped to avoid out-of-bounds dates
-    df['not_before'] = cap_out_of_bounds_dates(df['not_before'])
-    df['not_after'] = cap_out_of_bounds_dates(df['not_after'], max_date=max_valid_date)
-
-    # Filter out rows where 'not_after' is earlier than 'not_before'
-    df = df[df['not_after'] > df['not_before']]
-
-    # Calculate the certificate duration (in years)
-    df['Years to Expiration'] = (df['not_after'] - df['not_before']).dt.total_seconds() / (365 * 24 * 3600)
-
-    # Define bins and labels for the expiration groups
-    bins = [-float('inf'), 1, 5, 10, float('inf')]
-    labels = ['< 1 year', '1-5 years', '5-10 years', '> 10 years']
-
-    # Create a new column that categorizes the expiration into intervals
-    df['Expiration Group'] = pd.cut(df['Years to Expiration'], bins=bins, labels=labels)
-
-    # Group by expiration group and count the certificates
-    grouped = df.groupby('Expiration Group').size()
+        # Group by expiration group and count the certificates
+        grouped = df.groupby('Expiration Group', observed=False).size()
 
     # Plotting overall certificate expiration distribution
-    grouped.plot(kind='bar', stacked=True, color='skyblue')
-    plt.title("Overall Certificate Expiration Distribution")
-    plt.ylabel('Certificate Count')
-    plt.xlabel('Expiration Group')
-    plt.xticks(rotation=0)
-    plt.tight_layout()
-    plt.show()
+    plot_expiration_counts(grouped, "Overall Certificate Expiration Distribution")
 
 # Replace country codes (ISO Alpha-2 codes) with country names for the heatmap
-    # We'll use pycountry to convert country codes to full country names
+    # We'll use the pycountry table to convert country codes to full country names
 def get_country_name(country_code):
-    try:
-        return pycountry.countries.get(alpha_2=country_code).name
-    except:
-        return None
+    return ALPHA2_TO_NAME.get(str(country_code).upper())
 
 # Function to convert 'C=xx' to 'xxx' (alpha-3 code)
 def convert_to_alpha_3(country_code):
     if country_code.startswith('C='):
         alpha_2 = country_code.split('=')[1]
-        try:
-            alpha_3 = pycountry.countries.get(alpha_2=alpha_2).alpha_3
-            return alpha_3
-        except AttributeError:
-            return None  # Handle cases where the country code is not found
+        return ALPHA2_TO_ALPHA3.get(alpha_2.upper())  # None when the code is not found
     return None
 
-# Modify the get_countries function to call the combined plotting function
-def get_countries(csv_filename):
+# Columns the analysis needs from a scan output
+LEAF_COLUMNS = ['domain', 'issuer', 'not_before', 'not_after']
+
+def load_leaf_certificates(filename):
+    """
+    Load the leaf certificate of every domain from a scan output.
+    Parquet outputs are read column-pruned and filtered on chain_position.
+    A domain scanned twice (e.g. again after a crash) keeps its first row.
+    """
+    if filename.endswith('.parquet'):
+        df = pd.read_parquet(filename, columns=LEAF_COLUMNS, filters=[('chain_position', '==', 0)])
+        return df.drop_duplicates(subset='domain', keep='first').reset_index(drop=True)
+
     # Load the CSV file into a pandas DataFrame
-    df = pd.read_csv(csv_filename)
+    df = pd.read_csv(filename)
 
     # Drop duplicate rows based on the 'domain' column, keeping the first occurrence
-    df = df.drop_duplicates(subset='domain', keep='first')
+    return df.drop_duplicates(subset='domain', keep='first')
+
+def prepare_certificates(df, suffixes):
+    """
+    Keep the leaf certificates whose domain ends with one of 'suffixes' and
+    whose issuer names a country, adding 'country' (alpha-3) and 'suffix'.
+    """
     df = df.dropna(subset='issuer')
 
-    # Apply the function to the 'issuer' column and create a new column with the extracted country code
-    df['country'] = df['issuer'].apply(extract_country)
+    # Split the issuer DNs once per distinct issuer and keep the alpha-2 country code
+    df['country'] = parse_issuers(df['issuer'], attributes=('C',))['C']
     # Drop rows where 'country' is None
     df = df.dropna(subset=['country'])
 
-    df['suffix'] = df['domain'].apply(lambda x: next((s for s in constants.eu_suffixes if x.endswith(s)), None))
+    df['suffix'] = SuffixClassifier({'selected': suffixes}).classify_series(df['domain'])['suffix']
 
     # Filter the DataFrame to keep only rows with the defined suffixes
     df= df[df['suffix'].notnull()]
-    df['country'] = df['country'].apply(convert_to_alpha_3)
-    #plot_cert_expiration_overall(df)
-    #plot_top_5_companies_by_suffix(df)
-    plot_top_5_companies_overall(df)
+    df['country'] = alpha_2_to_alpha_3(df['country'])
+    return df
+
+def aggregate_counts(df):
+    """
+    Count certificates by suffix, issuer organization, issuer country and
+    expiration group in a single groupby. Every table the plots need can
+    be derived from the result without going back to the rows.
+    """
+    keys = pd.DataFrame({
+        'suffix': df['suffix'],
+        'company': parse_issuers(df['issuer'], attributes=('O',))['O'],
+        'country': df['country'],
+        'expiration_group': expiration_group(df),
+    })
+    counts = keys.groupby(list(keys.columns), dropna=False, observed=True).size()
+    return counts.rename('count').reset_index()
+
+def merge_counts(counts, other):
+    # Add two aggregate_counts() tables together
+    if counts is None or counts.empty:
+        return other
+    merged = pd.concat([counts, other], ignore_index=True)
+    merged = merged.groupby(['suffix', 'company', 'country', 'expiration_group'],
+                            dropna=False, observed=True)['count'].sum()
+    return merged.reset_index()
+
+# Column types for chunked reads: issuers repeat, so they load as categories
+LEAF_DTYPES = {'domain': str, 'issuer': 'category', 'not_before': str, 'not_after': str}
+
+def first_rows(domains, seen):
+    """
+    Mask of the rows whose domain has not been seen in this or an earlier
+    chunk, as drop_duplicates(keep='first') would keep. 'seen' is a sorted
+    array of 64-bit domain hashes, returned updated with the mask.
+
+    It holds every distinct domain read so far, so memory grows with the
+    file, not the chunk: 8 bytes per domain, twice that while a chunk's new
+    hashes are merged in. The merge inserts them in place of re-sorting, so
+    each chunk costs one pass over 'seen'.
+    """
+    hashes = pd.util.hash_pandas_object(domains, index=False).to_numpy()
+    position = np.searchsorted(seen, hashes).clip(max=max(len(seen) - 1, 0))
+    earlier = (seen[position] == hashes) if len(seen) else np.zeros(len(hashes), dtype=bool)
+    first = ~pd.Series(hashes).duplicated().to_numpy() & ~earlier
+    fresh = np.sort(hashes[first])
+    return first, np.insert(seen, np.searchsorted(seen, fresh), fresh)
+
+def iter_leaf_chunks(filename, chunksize=500000):
+    """
+    Yield the leaf certificates of a scan output 'chunksize' rows at a time,
+    reading only LEAF_COLUMNS. Together the chunks hold the same rows as
+    load_leaf_certificates(filename).
+    """
+    if filename.endswith('.parquet'):
+        import pyarrow.dataset as ds
+
+        seen = np.empty(0, dtype=np.uint64)
+        dataset = ds.dataset(filename, format='parquet')
+        for batch in dataset.to_batches(columns=LEAF_COLUMNS, batch_size=chunksize,
+                                        filter=ds.field('chain_position') == 0):
+            if batch.num_rows:
+                chunk = batch.to_pandas()
+                first, seen = first_rows(chunk['domain'], seen)
+                yield chunk[first]
+        return
+
+    seen = np.empty(0, dtype=np.uint64)
+    for chunk in pd.read_csv(filename, usecols=LEAF_COLUMNS, dtype=LEAF_DTYPES, chunksize=chunksize):
+        first, seen = first_rows(chunk['domain'], seen)
+        yield chunk[first]
+
+def aggregate_certificates(filename, suffixes, chunksize=500000):
+    """
+    aggregate_counts(prepare_certificates(load_leaf_certificates(filename), suffixes))
+    computed chunk by chunk, so the certificate rows in memory are bounded by
+    'chunksize' rather than the size of the file. Finding each domain's
+    first row still takes 8 bytes per distinct domain, see first_rows().
+    """
+    counts = None
+    for chunk in iter_leaf_chunks(filename, chunksize):
+        counts = merge_counts(counts, aggregate_counts(prepare_certificates(chunk, suffixes)))
+    if counts is None:
+        return pd.DataFrame(columns=['suffix', 'company', 'country', 'expiration_group', 'count'])
+    return counts
+
+def is_counts(df):
+    # True for an aggregate_counts() table, or a cube loaded from disk, rather than certificate rows
+    return 'count' in df.columns and 'expiration_group' in df.columns
+
+def counts_by(counts, column, suffix=None):
+    """
+    Sum aggregate_counts() output over every column but 'column', for one
+    suffix or all of them. Expiration groups keep their label order.
+    """
+    if suffix is not None:
+        counts = counts[counts['suffix'] == suffix]
+    totals = counts.groupby(column, observed=True)['count'].sum()
+    if column == 'expiration_group':
+        return totals.reindex(EXPIRATION_LABELS, fill_value=0).rename_axis('Expiration Group')
+    return totals.sort_values(ascending=False)
+
+# Modify the get_countries function to call the combined plotting function
+def get_countries(csv_filename):
+    # Streamed in chunks: the plots below only need the aggregate counts
+    counts = aggregate_certificates(csv_filename, constants.eu_suffixes)
+    #plot_cert_expiration_overall(counts)
+    #plot_top_5_companies_by_suffix(counts)
+    plot_top_5_companies_overall(counts)
 
 
 def main():
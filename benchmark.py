@@ -0,0 +1,353 @@
+import argparse
+import csv
+import datetime
+import json
+import multiprocessing
+import os
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+import constants
+from cert_writer import FIELDNAMES
+from tls_farm import ISSUERS, TLSFarm, address_for, name_for
+
+SCAN_MODES = ['sequential', 'threads', 'async', 'async-dns', 'sharded']
+ANALYSIS_MODES = ['in-memory', 'chunked', 'cube-build', 'cube-update']
+
+# Per-process latency log of the probed fetch functions, '<ok> <seconds>' lines
+_latency_log = None
+_latency_pid = None
+
+def _log_latency(seconds, ok):
+    global _latency_log, _latency_pid
+    if _latency_pid != os.getpid():
+        # Opened per process: shard workers are forked from the mode process
+        _latency_pid = os.getpid()
+        _latency_log = open(os.path.join(os.environ['BENCHMARK_LATENCY_DIR'], f'{_latency_pid}.log'),
+                            mode='a', buffering=1, encoding='utf-8')
+    _latency_log.write(f'{int(ok)} {seconds:.6f}\n')
+
+def _sync_probe(fetch, port):
+    # Sends every fetch to the farm's port and logs how long it took
+    def probe(hostname, _port=443, *args, **kwargs):
+        start = time.perf_counter()
+        ok = False
+        try:
+            result = fetch(hostname, port, *args, **kwargs)
+            ok = True
+            return result
+        finally:
+            _log_latency(time.perf_counter() - start, ok)
+    return probe
+
+def _async_probe(fetch, port):
+    async def probe(hostname, context, _port=443, *args, **kwargs):
+        start = time.perf_counter()
+        ok = False
+        try:
+            result = await fetch(hostname, context, port, *args, **kwargs)
+            ok = True
+            return result
+        finally:
+            _log_latency(time.perf_counter() - start, ok)
+    return probe
+
+def _benchmark_scheduler():
+    # Short timeouts and a single retry, so black holes do not dominate the run
+    from scan_scheduler import AdaptiveTimeout, RetryScheduler
+    return RetryScheduler(max_attempts=2, first_timeout=AdaptiveTimeout(initial=2.0, minimum=0.5, maximum=2.0),
+                          retry_timeout=2.0, retry_delay=0.5)
+
+def _run_scan_mode(config):
+    # Runs in a fresh interpreter per mode, so peak RSS belongs to that mode
+    import fetch_cert_chain
+    import fetch_cert_chain_multi
+    import scan_async
+
+    port = config['port']
+    fetch_cert_chain.fetch_ssl_certificate_chain_or_raise = _sync_probe(
+        fetch_cert_chain.fetch_ssl_certificate_chain_or_raise, port)
+    fetch_cert_chain_multi.fetch_ssl_certificate_chain_or_raise = _sync_probe(
+        fetch_cert_chain_multi.fetch_ssl_certificate_chain_or_raise, port)
+    scan_async.fetch_ssl_certificate_chain = _async_probe(scan_async.fetch_ssl_certificate_chain, port)
+
+    mode, input_file, output_file = config['mode'], config['input'], config['output']
+    scheduler = _benchmark_scheduler()
+    fast = config['fast_handshake']
+    if mode == 'sequential':
+        fetch_cert_chain.process_domains_from_csv(input_file, output_file, scheduler=scheduler,
+                                                  fast_handshake=fast)
+    elif mode == 'threads':
+        fetch_cert_chain_multi.process_domains_from_csv(input_file, output_file, max_workers=config['workers'],
+                                                        scheduler=scheduler, fast_handshake=fast)
+    elif mode == 'async':
+        scan_async.process_domains_from_csv(input_file, output_file, config['concurrency'], resolve=False,
+                                            scheduler=scheduler, fast_handshake=fast)
+    elif mode == 'async-dns':
+        scan_async.process_domains_from_csv(input_file, output_file, config['concurrency'],
+                                            scheduler=scheduler, nameservers=[tuple(config['nameserver'])],
+                                            fast_handshake=fast)
+    elif mode == 'sharded':
+        import sharded_scan
+        # Shard workers must inherit the probes
+        multiprocessing.set_start_method('fork', force=True)
+        shards = config['shards'] or os.cpu_count()
+        sharded_scan.process_domains_sharded(input_file, output_file, shards,
+                                             max(config['concurrency'] // shards, 1), scheduler,
+                                             resolve=False, port=port, fast_handshake=fast)
+    else:
+        raise ValueError(f'Unknown scan mode: {mode}')
+
+def _run_analysis_mode(config):
+    import analyze_certificates as analysis
+    import aggregate_cube
+
+    mode, source = config['mode'], config['input']
+    if mode == 'in-memory':
+        df = analysis.prepare_certificates(analysis.load_leaf_certificates(source), aggregate_cube.ALL_SUFFIXES)
+        analysis.aggregate_counts(df)
+    elif mode == 'chunked':
+        analysis.aggregate_certificates(source, aggregate_cube.ALL_SUFFIXES, config['chunksize'])
+    elif mode == 'cube-build':
+        cube_path = os.path.join(config['workdir'], 'bench.cube.csv')
+        for path in (cube_path, cube_path + '.json', cube_path + '.seen.npy'):
+            if os.path.exists(path):
+                os.remove(path)
+        aggregate_cube.load_cube(source, cube_path, config['chunksize'])
+    elif mode == 'cube-update':
+        # Cube already built: only the file's metadata and hash are checked
+        aggregate_cube.load_cube(source, os.path.join(config['workdir'], 'bench.cube.csv'), config['chunksize'])
+    else:
+        raise ValueError(f'Unknown analysis mode: {mode}')
+
+def _run_mode(config):
+    start = time.perf_counter()
+    if config['kind'] == 'scan':
+        _run_scan_mode(config)
+    else:
+        _run_analysis_mode(config)
+    elapsed = time.perf_counter() - start
+    # ru_maxrss is in KiB on Linux; children covers shard worker processes
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    print(json.dumps({
+        'elapsed': elapsed,
+        'cpu_seconds': usage.ru_utime + usage.ru_stime + children.ru_utime + children.ru_stime,
+        'peak_rss_mb': usage.ru_maxrss / 1024,
+        'children_peak_rss_mb': children.ru_maxrss / 1024,
+    }))
+
+def _run_subprocess(config, log_file, env=None):
+    # The last stdout line of the child is its JSON result; the rest goes to the log
+    result = subprocess.run([sys.executable, os.path.abspath(__file__), '_run', json.dumps(config)],
+                            capture_output=True, text=True, env=env, cwd=os.path.dirname(os.path.abspath(__file__)))
+    with open(log_file, mode='a', encoding='utf-8') as log:
+        log.write(f"== {config['mode']}\n{result.stdout}{result.stderr}")
+    if result.returncode != 0:
+        raise RuntimeError(f"{config['mode']} failed, see {log_file}:\n{result.stderr[-2000:]}")
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+def _quantile(ordered, q):
+    if not ordered:
+        return None
+    return ordered[min(int(len(ordered) * q), len(ordered) - 1)]
+
+def _read_latencies(directory):
+    successes, failures = [], 0
+    for name in os.listdir(directory):
+        with open(os.path.join(directory, name), mode='r', encoding='utf-8') as file:
+            for line in file:
+                ok, seconds = line.split()
+                if ok == '1':
+                    successes.append(float(seconds))
+                else:
+                    failures += 1
+    return sorted(successes), failures
+
+def _scanned_domains(output_file):
+    if not os.path.exists(output_file):
+        return 0
+    with open(output_file, mode='r', newline='', encoding='utf-8') as file:
+        return len({row['domain'] for row in csv.DictReader(file)})
+
+def benchmark_scanners(modes=None, domains=2000, sequential_domains=200, concurrency=500, workers=200,
+                       shards=None, farm=None, workdir=None, fast_handshake=False):
+    """
+    Scan 'domains' loopback destinations served by a TLSFarm with each
+    scan mode, each in its own process, and return one dict per mode with
+    domains/sec, success count, p50/p99 latency of successful fetches,
+    scanner CPU time per domain and peak RSS. The sequential scanner gets
+    'sequential_domains' only.
+    """
+    modes = modes or SCAN_MODES
+    farm = farm or TLSFarm()
+    workdir = workdir or tempfile.mkdtemp(prefix='scan-benchmark-')
+    log_file = os.path.join(workdir, 'scan.log')
+    results = []
+
+    with farm:
+        expected = sum(farm.kind(address_for(index)) in ('ok', 'slow') for index in range(domains))
+        for mode in modes:
+            count = sequential_domains if mode == 'sequential' else domains
+            input_file = os.path.join(workdir, f'{mode}-input.csv')
+            with open(input_file, mode='w', encoding='utf-8') as file:
+                names = name_for if mode == 'async-dns' else address_for
+                file.writelines(f'{names(index)}\n' for index in range(count))
+
+            latency_dir = os.path.join(workdir, f'{mode}-latency')
+            os.makedirs(latency_dir, exist_ok=True)
+            output_file = os.path.join(workdir, f'{mode}-certificates.csv')
+            config = {'kind': 'scan', 'mode': mode, 'input': input_file, 'output': output_file,
+                      'port': farm.port, 'nameserver': farm.nameserver, 'concurrency': concurrency,
+                      'workers': workers, 'shards': shards, 'fast_handshake': fast_handshake}
+            run = _run_subprocess(config, log_file, dict(os.environ, BENCHMARK_LATENCY_DIR=latency_dir))
+
+            latencies, failures = _read_latencies(latency_dir)
+            p50, p99 = _quantile(latencies, 0.5), _quantile(latencies, 0.99)
+            results.append({
+                'mode': mode,
+                'domains': count,
+                'succeeded': _scanned_domains(output_file),
+                'reachable': expected if count == domains else None,
+                'failed_attempts': failures,
+                'seconds': run['elapsed'],
+                'domains_per_second': count / run['elapsed'],
+                'cpu_ms_per_domain': run['cpu_seconds'] * 1000 / count,
+                'p50_ms': p50 and p50 * 1000,
+                'p99_ms': p99 and p99 * 1000,
+                'peak_rss_mb': max(run['peak_rss_mb'], run['children_peak_rss_mb']),
+            })
+            print(_format_row(results[-1]), flush=True)
+    return results
+
+def generate_certificate_csv(path, domains, seed=0):
+    """
+    Write a synthetic scan output for 'domains' domains in the usual CSV
+    layout: chains of 1-4 certificates per domain, EU, BRICS and generic
+    suffixes, and issuers and validity periods drawn from realistic mixes.
+    Returns the number of rows written.
+    """
+    rng = random.Random(seed)
+    suffixes = constants.eu_suffixes + constants.brics_suffixes + ['.com', '.org', '.net']
+    # RFC 4514 strings as the scanners write them, commas in values escaped
+    issuers = []
+    for organization, country in ISSUERS:
+        escaped = organization.replace(',', '\\,')
+        issuers.append(f'CN={escaped} CA 0,O={escaped},C={country}')
+    # Leaf validity in days, weighted towards short-lived certificates
+    validities = [90] * 6 + [365] * 3 + [730, 1825, 3650 * 3]
+    start = datetime.datetime(2023, 1, 1)
+
+    rows = 0
+    with open(path, mode='w', newline='', encoding='utf-8') as file:
+        writer = csv.writer(file)
+        writer.writerow(FIELDNAMES)
+        for index in range(domains):
+            domain = f'site{index}{rng.choice(suffixes)}'
+            issuer = rng.choice(issuers)
+            not_before = start + datetime.timedelta(seconds=rng.randrange(3 * 365 * 86400))
+            not_after = not_before + datetime.timedelta(days=rng.choice(validities))
+            writer.writerow([domain, f'CN={domain}', issuer, 'v3', rng.getrandbits(128),
+                             not_before, not_after])
+            for level in range(rng.choice((0, 1, 1, 2, 3))):
+                intermediate = issuer.replace(' CA 0', f' CA {level + 1}')
+                writer.writerow([domain, issuer, intermediate, 'v3', rng.getrandbits(64),
+                                 start, start + datetime.timedelta(days=3650)])
+                issuer = intermediate
+            rows += 1
+    return rows
+
+def benchmark_analysis(domains=1000000, chunksize=500000, modes=None, workdir=None, source=None):
+    """
+    Time the analysis paths on a synthetic scan output of 'domains'
+    domains (generated unless 'source' is given), each in its own process,
+    and return seconds, domains/sec and peak RSS per mode.
+    """
+    modes = modes or ANALYSIS_MODES
+    workdir = workdir or tempfile.mkdtemp(prefix='analysis-benchmark-')
+    log_file = os.path.join(workdir, 'analysis.log')
+    if source is None:
+        source = os.path.join(workdir, 'certificates.csv')
+        start = time.perf_counter()
+        generate_certificate_csv(source, domains)
+        print(f'Generated {domains} domains ({os.path.getsize(source) / 2**20:.0f} MiB) '
+              f'in {time.perf_counter() - start:.1f}s', flush=True)
+
+    results = []
+    for mode in modes:
+        config = {'kind': 'analysis', 'mode': mode, 'input': source, 'workdir': workdir,
+                  'chunksize': chunksize}
+        run = _run_subprocess(config, log_file)
+        results.append({'mode': mode, 'domains': domains, 'seconds': run['elapsed'],
+                        'domains_per_second': domains / run['elapsed'],
+                        'peak_rss_mb': run['peak_rss_mb']})
+        print(_format_row(results[-1]), flush=True)
+    return results
+
+def _format_row(row):
+    parts = [f"{row['mode']:<12}", f"{row['domains']:>9} domains", f"{row['seconds']:8.2f}s",
+             f"{row['domains_per_second']:10.1f}/s"]
+    if 'succeeded' in row:
+        parts.append(f"ok {row['succeeded']}" + (f"/{row['reachable']}" if row['reachable'] is not None else ''))
+        if row['p50_ms'] is not None:
+            parts.append(f"p50 {row['p50_ms']:.1f}ms p99 {row['p99_ms']:.1f}ms")
+        parts.append(f"cpu {row['cpu_ms_per_domain']:.2f}ms/domain")
+    parts.append(f"peak RSS {row['peak_rss_mb']:.0f} MiB")
+    return ' | '.join(parts)
+
+def main():
+    if len(sys.argv) == 3 and sys.argv[1] == '_run':
+        _run_mode(json.loads(sys.argv[2]))
+        return
+
+    parser = argparse.ArgumentParser(description='Offline scanner and analysis benchmarks.')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    scan = commands.add_parser('scan', help='scan a local TLS server farm with every scan mode')
+    scan.add_argument('--modes', default=','.join(SCAN_MODES))
+    scan.add_argument('--domains', type=int, default=2000)
+    scan.add_argument('--sequential-domains', type=int, default=200)
+    scan.add_argument('--concurrency', type=int, default=500)
+    scan.add_argument('--workers', type=int, default=200, help='threads of the threaded scanner')
+    scan.add_argument('--shards', type=int, default=None)
+    scan.add_argument('--farm-processes', type=int, default=None)
+    scan.add_argument('--slow', type=float, default=0.05, help='fraction of slow endpoints')
+    scan.add_argument('--blackhole', type=float, default=0.01, help='fraction of black-holed endpoints')
+    scan.add_argument('--reset', type=float, default=0.01, help='fraction of resetting endpoints')
+    scan.add_argument('--fast-handshake', action='store_true')
+    scan.add_argument('--output', default=None, help='also write the results as JSON')
+
+    analysis = commands.add_parser('analysis', help='time the analysis paths on a synthetic scan output')
+    analysis.add_argument('--modes', default=','.join(ANALYSIS_MODES))
+    analysis.add_argument('--domains', type=int, default=1000000)
+    analysis.add_argument('--chunksize', type=int, default=500000)
+    analysis.add_argument('--source', default=None, help='existing scan output to use instead')
+    analysis.add_argument('--output', default=None, help='also write the results as JSON')
+
+    generate = commands.add_parser('generate', help='write a synthetic certificate CSV')
+    generate.add_argument('path')
+    generate.add_argument('--domains', type=int, default=1000000)
+    generate.add_argument('--seed', type=int, default=0)
+
+    args = parser.parse_args()
+    if args.command == 'generate':
+        generate_certificate_csv(args.path, args.domains, args.seed)
+        return
+
+    if args.command == 'scan':
+        farm = TLSFarm(args.farm_processes, slow=args.slow, blackhole=args.blackhole, reset=args.reset)
+        results = benchmark_scanners(args.modes.split(','), args.domains, args.sequential_domains,
+                                     args.concurrency, args.workers, args.shards, farm,
+                                     fast_handshake=args.fast_handshake)
+    else:
+        results = benchmark_analysis(args.domains, args.chunksize, args.modes.split(','), source=args.source)
+
+    if args.output:
+        with open(args.output, mode='w', encoding='utf-8') as file:
+            json.dump(results, file, indent=2)
+
+if __name__ == '__main__':
+    main()
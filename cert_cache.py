@@ -0,0 +1,67 @@
+import hashlib
+import threading
+from collections import OrderedDict
+from OpenSSL import crypto
+from cryptography import x509
+
+class CertDetailsCache:
+    """
+    LRU cache of certificate details keyed by SHA-256 fingerprint.
+
+    Intermediate and root certificates repeat across millions of domains,
+    so each distinct one is parsed and turned into RFC 4514 strings once.
+    Leaf certificates (position 0) are almost always unique and are parsed
+    without going through the cache, so they do not evict intermediates.
+    Safe to share between threads.
+    """
+    def __init__(self, extract, maxsize=4096):
+        self.extract = extract
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    @property
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses, "hit_rate": self.hit_rate,
+                "size": len(self._entries)}
+
+    def details(self, der, cacheable=True):
+        # Every certificate's details carry its hex SHA-256 fingerprint and
+        # its DER bytes, which the CSV layout leaves out but incremental
+        # rescans and the DER archive use
+        fingerprint = hashlib.sha256(der).digest()
+        if not cacheable:
+            return dict(self.extract(x509.load_der_x509_certificate(der)), fingerprint=fingerprint.hex(),
+                        der=der)
+
+        with self._lock:
+            cached = self._entries.get(fingerprint)
+            if cached is not None:
+                self._entries.move_to_end(fingerprint)
+                self.hits += 1
+                return dict(cached)
+            self.misses += 1
+
+        # Parse outside the lock; a concurrent miss on the same certificate
+        # just does the work twice
+        details = dict(self.extract(x509.load_der_x509_certificate(der)), fingerprint=fingerprint.hex(),
+                       der=der)
+        with self._lock:
+            self._entries[fingerprint] = details
+            if len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+        return dict(details)
+
+    def chain_details(self, cert_chain):
+        """
+        Return the details of a pyOpenSSL certificate chain, converting each
+        certificate straight from DER instead of going through PEM.
+        """
+        return [self.details(crypto.dump_certificate(crypto.FILETYPE_ASN1, cert), position > 0)
+                for position, cert in enumerate(cert_chain)]
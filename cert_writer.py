@@ -0,0 +1,158 @@
+import csv
+import queue
+import threading
+import time
+from scan_metrics import WRITE
+
+FIELDNAMES = ["domain", "subject", "issuer", "version", "serial_number", "not_before", "not_after"]
+
+# Marker put on the queue to tell the writer thread to finish
+_CLOSE = object()
+
+class CsvSink:
+    """
+    Keeps the output CSV open for the whole scan and writes the header
+    only when the file is empty. Columns outside 'fieldnames', such as
+    chain_position, are left out to keep the existing CSV layout.
+    """
+    def __init__(self, filename, fieldnames=FIELDNAMES):
+        self.file = open(filename, mode='a', newline='')
+        self.writer = csv.DictWriter(self.file, fieldnames=fieldnames, extrasaction='ignore')
+        if self.file.tell() == 0:
+            self.writer.writeheader()
+
+    def write_rows(self, rows):
+        self.writer.writerows(rows)
+
+    def flush(self, domains):
+        # Returns the domains whose rows have reached the file
+        self.file.flush()
+        return domains
+
+    def close(self):
+        self.file.close()
+        return []
+
+def open_sink(filename):
+    # A '.parquet' output is a directory of Parquet parts; it needs pyarrow,
+    # which CSV output does not
+    if filename.endswith('.parquet'):
+        from parquet_output import ParquetSink
+        return ParquetSink(filename)
+    return CsvSink(filename)
+
+class CertChainWriter:
+    """
+    Single writer stage for scan results. Scanners hand over whole chains
+    with write(), which only puts them on a queue; a dedicated thread owns
+    the output sink and writes rows in batches of 'flush_size' rows, or
+    whatever is pending every 'flush_interval' seconds.
+
+    'on_flush', if given, is called from the writer thread with the domains
+    whose rows the sink reports as written, e.g. to mark them done in a
+    ScanState. A Parquet sink only reports them once their part is closed. With 'metrics' (ScanMetrics), each batch write is
+    timed as the 'write' phase. With 'archive' (DerArchive), each batch's
+    chains are archived as raw DER before on_flush is called.
+    """
+    def __init__(self, filename=None, flush_size=1000, flush_interval=1.0, sink=None,
+                 on_flush=None, metrics=None, archive=None):
+        self.sink = sink if sink is not None else open_sink(filename)
+        self.archive = archive
+        self.on_flush = on_flush
+        self.metrics = metrics
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self.rows_written = 0
+        self._queue = queue.SimpleQueue()
+        self._error = None
+        self._thread = threading.Thread(target=self._run, name='cert-writer', daemon=True)
+        self._thread.start()
+
+    def write(self, domain, cert_chain):
+        # Never blocks: the queue is unbounded and rows are built on the writer thread.
+        # An empty chain writes no rows but is still reported to on_flush
+        if self._error is not None:
+            raise self._error
+        self._queue.put((domain, cert_chain))
+
+    def close(self):
+        self._queue.put(_CLOSE)
+        self._thread.join()
+        if self._error is not None:
+            raise self._error
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def _write_batch(self, batch, domains, chains):
+        if self.archive is not None:
+            for domain, cert_chain in chains:
+                self.archive.add_chain(domain, cert_chain)
+            self.archive.flush()
+        start = time.perf_counter()
+        if batch:
+            self.sink.write_rows(batch)
+        done = self.sink.flush(domains)
+        if batch:
+            self.rows_written += len(batch)
+            if self.metrics is not None:
+                self.metrics.observe(WRITE, time.perf_counter() - start)
+        if self.on_flush is not None and done:
+            self.on_flush(done)
+
+    def _close_sink(self):
+        # Domains the sink held back until now are reported once it is closed
+        done = self.sink.close()
+        if self.on_flush is not None and done and self._error is None:
+            self.on_flush(done)
+
+    def _run(self):
+        batch = []
+        domains = []
+        chains = []
+        deadline = time.monotonic() + self.flush_interval
+        while True:
+            try:
+                item = self._queue.get(timeout=max(deadline - time.monotonic(), 0))
+            except queue.Empty:
+                item = None
+
+            if item is _CLOSE:
+                break
+
+            if item is not None and self._error is None:
+                domain, cert_chain = item
+                domains.append(domain)
+                if self.archive is not None:
+                    chains.append(item)
+                for position, cert in enumerate(cert_chain):
+                    row = {"domain": domain, "chain_position": position}
+                    row.update(cert)
+                    batch.append(row)
+
+            if len(batch) >= self.flush_size or time.monotonic() >= deadline:
+                if domains and self._error is None:
+                    try:
+                        self._write_batch(batch, domains, chains)
+                    except Exception as e:
+                        # Keep draining the queue so scanners never block; the error
+                        # is raised to them on their next write() or on close()
+                        self._error = e
+                batch = []
+                domains = []
+                chains = []
+                deadline = time.monotonic() + self.flush_interval
+
+        if domains and self._error is None:
+            try:
+                self._write_batch(batch, domains, chains)
+            except Exception as e:
+                self._error = e
+        try:
+            self._close_sink()
+        except Exception as e:
+            if self._error is None:
+                self._error = e
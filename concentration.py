@@ -0,0 +1,189 @@
+import argparse
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+import numpy as np
+import pandas as pd
+import matplotlib.pyplot as plt
+import analyze_certificates as analysis
+import constants
+from aggregate_cube import load_cube, region_counts
+
+# Columns whose categories are measured: issuer organization and issuer country
+DIMENSIONS = ['company', 'country']
+
+# Shares of the k largest categories reported, as in the top-4 and top-5 charts
+TOP_K = (1, 4, 5)
+
+# 'suffix' of the rows covering a whole region
+ALL = 'all'
+
+TABLE_COLUMNS = ['region', 'suffix', 'dimension', 'metric', 'value', 'ci_low', 'ci_high',
+                 'certificates', 'categories']
+
+# Resampled counts kept in memory at once, as float64 values
+_BATCH_VALUES = 1 << 22
+
+def metric_names(top_k=TOP_K):
+    return ['hhi', 'gini', 'entropy'] + [f'top{k}_share' for k in top_k]
+
+def concentration_metrics(counts, top_k=TOP_K):
+    """
+    Concentration of each row of 'counts', a 2-D array of certificate
+    counts per category (one row per sample, at least one category).
+    Returns {metric: array with one value per row}:
+
+        hhi          Herfindahl-Hirschman index of the shares, 0-10000
+        gini         Gini coefficient of the shares, 0 when all are equal
+        entropy      Shannon entropy of the shares, in bits
+        topK_share   share of the K largest categories
+    """
+    counts = np.asarray(counts, dtype=np.float64)
+    totals = counts.sum(axis=1, keepdims=True)
+    shares = counts / np.where(totals > 0, totals, 1)
+    ordered = np.sort(shares, axis=1)
+    categories = counts.shape[1]
+
+    ranks = np.arange(1, categories + 1)
+    metrics = {
+        'hhi': 10000 * np.square(shares).sum(axis=1),
+        'gini': (2 * (ordered * ranks).sum(axis=1) - (categories + 1) * ordered.sum(axis=1)) / categories,
+        'entropy': (shares * np.log2(1 / np.where(shares > 0, shares, 1))).sum(axis=1),
+    }
+    largest = np.cumsum(ordered[:, ::-1], axis=1)
+    for k in top_k:
+        metrics[f'top{k}_share'] = largest[:, min(k, categories) - 1]
+    return metrics
+
+def _bootstrap(category_counts, resamples, confidence, top_k, seed):
+    # Point values and interval bounds of every metric, in metric_names() order
+    rng = np.random.default_rng(seed)
+    total = int(category_counts.sum())
+    point = concentration_metrics(category_counts[np.newaxis], top_k)
+    values = np.array([value[0] for value in point.values()])
+    if not resamples or not total:
+        return values, np.full_like(values, np.nan), np.full_like(values, np.nan)
+
+    shares = category_counts / total
+    batch = max(_BATCH_VALUES // len(category_counts), 1)
+    samples = []
+    for start in range(0, resamples, batch):
+        drawn = rng.multinomial(total, shares, size=min(batch, resamples - start))
+        samples.append(np.stack(list(concentration_metrics(drawn, top_k).values())))
+    alpha = (1 - confidence) / 2
+    low, high = np.quantile(np.concatenate(samples, axis=1), [alpha, 1 - alpha], axis=1)
+    return values, low, high
+
+def bootstrap_metrics(category_counts, resamples=1000, confidence=0.95, top_k=TOP_K, seed=None):
+    """
+    Metrics of one group's category counts, with percentile bootstrap
+    intervals. Resampling the group's certificates with replacement is
+    drawing its counts from a multinomial with the observed shares, so a
+    batch of resamples is one rng.multinomial() call over the integer-coded
+    categories rather than a loop. Returns a DataFrame indexed by metric
+    with 'value', 'ci_low' and 'ci_high'.
+    """
+    values, low, high = _bootstrap(np.asarray(category_counts, dtype=np.int64), resamples, confidence,
+                                   top_k, seed)
+    return pd.DataFrame({'value': values, 'ci_low': low, 'ci_high': high}, index=metric_names(top_k))
+
+def _bootstrap_groups(groups, resamples, confidence, top_k):
+    # Runs in a worker process
+    return [_bootstrap(category_counts, resamples, confidence, top_k, seed) for category_counts, seed in groups]
+
+def _groups(counts, dimension):
+    # (suffix, category counts) of every suffix and of all of them, as counts_by() totals them
+    totals = counts.groupby(['suffix', dimension], observed=True)['count'].sum()
+    totals = totals[totals > 0]
+    overall = totals.groupby(level=dimension, observed=True).sum()
+    if len(overall):
+        yield ALL, overall.to_numpy()
+    for suffix, group in totals.groupby(level='suffix', observed=True):
+        yield suffix, group.to_numpy()
+
+def concentration_table(counts, region, resamples=1000, confidence=0.95, top_k=TOP_K, seed=0,
+                        processes=None):
+    """
+    Concentration metrics of issuer organization and issuer country for
+    one region's aggregate_counts() table: one row per (suffix, dimension,
+    metric), suffix 'all' covering the whole region, with the point value,
+    its bootstrap interval and the number of certificates and categories
+    it was computed from.
+
+    Groups are resampled by 'processes' worker processes, each group with
+    its own seed derived from 'seed', so the table does not depend on how
+    many there are.
+    """
+    groups = [(dimension, suffix, category_counts) for dimension in DIMENSIONS
+              for suffix, category_counts in _groups(counts, dimension)]
+    if not groups:
+        return pd.DataFrame(columns=TABLE_COLUMNS)
+    work = list(zip((category_counts for _, _, category_counts in groups),
+                    np.random.SeedSequence(seed).spawn(len(groups))))
+
+    processes = processes or os.cpu_count()
+    size = -(-len(work) // (processes * 4))
+    chunks = [work[start:start + size] for start in range(0, len(work), size)]
+    if processes == 1 or len(chunks) == 1:
+        results = [result for chunk in chunks
+                   for result in _bootstrap_groups(chunk, resamples, confidence, top_k)]
+    else:
+        with ProcessPoolExecutor(max_workers=processes) as executor:
+            results = [result for part in executor.map(_bootstrap_groups, chunks, repeat(resamples),
+                                                       repeat(confidence), repeat(top_k))
+                       for result in part]
+
+    names = metric_names(top_k)
+    values, low, high = (np.concatenate(arrays) for arrays in zip(*results))
+    table = pd.DataFrame({
+        'region': region,
+        'suffix': np.repeat([suffix for _, suffix, _ in groups], len(names)),
+        'dimension': np.repeat([dimension for dimension, _, _ in groups], len(names)),
+        'metric': np.tile(names, len(groups)),
+        'value': values,
+        'ci_low': low,
+        'ci_high': high,
+        'certificates': np.repeat([int(category_counts.sum()) for _, _, category_counts in groups], len(names)),
+        'categories': np.repeat([len(category_counts) for _, _, category_counts in groups], len(names)),
+    })
+    return table[TABLE_COLUMNS]
+
+def plot_concentration(table, dimension, metric, title, output_file=None):
+    # One bar per suffix, the whole region first, with the bootstrap interval as error bars
+    rows = table[(table['dimension'] == dimension) & (table['metric'] == metric)]
+    rows = pd.concat([rows[rows['suffix'] == ALL], rows[rows['suffix'] != ALL].sort_values('value')])
+    errors = [(rows['value'] - rows['ci_low']).clip(lower=0).fillna(0),
+              (rows['ci_high'] - rows['value']).clip(lower=0).fillna(0)]
+    plt.figure(figsize=(max(6, len(rows) * 0.35), 4))
+    plt.bar(rows['suffix'], rows['value'], yerr=errors, color='skyblue', capsize=2)
+    plt.title(title)
+    plt.ylabel(metric)
+    plt.xlabel('Suffix')
+    plt.xticks(rotation=45, ha='right')
+    plt.tight_layout()
+    analysis.finish_plot(output_file)
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Compute issuer concentration metrics with bootstrap confidence intervals.')
+    parser.add_argument('output_file', help='metrics table (CSV)')
+    parser.add_argument('datasets', nargs='+', metavar='REGION=FILE', help='scan output per region')
+    parser.add_argument('--resamples', type=int, default=1000)
+    parser.add_argument('--confidence', type=float, default=0.95)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--processes', type=int, default=None)
+    args = parser.parse_args()
+
+    start_time = time.time()
+    tables = []
+    for region, filename in (dataset.split('=', 1) for dataset in args.datasets):
+        counts = region_counts(load_cube(filename), constants.regions[region])
+        tables.append(concentration_table(counts, region, args.resamples, args.confidence, seed=args.seed,
+                                          processes=args.processes))
+    table = pd.concat(tables, ignore_index=True)
+    table.to_csv(args.output_file, index=False)
+    print(f'Wrote {len(table)} metrics to {args.output_file} in {time.time() - start_time:.1f}s')
+
+if __name__ == '__main__':
+    main()
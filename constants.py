@@ -10,4 +10,10 @@ brics_suffixes = [
     ".in",  # India
     ".cn",  # China
     ".za"   # South Africa
-]
\ No newline at end of file
+]
+
+# Suffix lists by region name, used by suffix_classifier
+regions = {
+    "eu": eu_suffixes,
+    "brics": brics_suffixes,
+}
\ No newline at end of file
@@ -0,0 +1,331 @@
+import argparse
+import csv
+import datetime
+import hashlib
+import mmap
+import os
+import struct
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+import numpy as np
+import pandas as pd
+from cryptography import x509
+from cryptography.exceptions import UnsupportedAlgorithm
+from cryptography.x509.oid import PublicKeyAlgorithmOID, SignatureAlgorithmOID
+
+CERTS_FILE = 'certs.bin'
+INDEX_FILE = 'certs.idx'
+CHAINS_FILE = 'chains.csv'
+CHAINS_FIELDNAMES = ['scan_date', 'domain', 'cert_ids']
+
+# One index record per distinct certificate; its record number is the cert_id
+_RECORD = struct.Struct('<32sQI')
+INDEX_DTYPE = np.dtype([('fingerprint', 'V32'), ('offset', '<u8'), ('length', '<u4')])
+
+def _truncate(path, size):
+    if os.path.exists(path) and os.path.getsize(path) > size:
+        with open(path, mode='r+b') as file:
+            file.truncate(size)
+
+class DerArchive:
+    """
+    Append-only archive of the raw DER certificates of scanned chains, in
+    the directory 'path':
+
+        certs.bin   every distinct certificate once, back to back
+        certs.idx   per certificate: SHA-256 fingerprint, offset, length
+        chains.csv  scan_date, domain and the cert_ids of its chain in order
+
+    Intermediates repeat across millions of chains and are stored once.
+    Index records and chain lines are held until flush(), which syncs
+    certs.bin to disk before writing them. When the archive is opened
+    again, a torn tail is cut off, along with any index record that points
+    past the end of certs.bin and the chains that use it. Not thread-safe:
+    CertChainWriter feeds it from its writer thread.
+    """
+    def __init__(self, path, scan_date=None):
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+        self.scan_date = scan_date or datetime.datetime.now(datetime.timezone.utc).date().isoformat()
+        self.certificates_added = 0
+        self.chains_added = 0
+        self._ids = {}
+        self._offset = 0
+        # Index records and chain rows not written yet, see flush()
+        self._records = []
+        self._rows = []
+        self._recover()
+
+        self._certs = open(os.path.join(path, CERTS_FILE), mode='ab')
+        self._index = open(os.path.join(path, INDEX_FILE), mode='ab')
+        self._chains_file = open(os.path.join(path, CHAINS_FILE), mode='a', newline='', encoding='utf-8')
+        self._chains = csv.writer(self._chains_file)
+        if self._chains_file.tell() == 0:
+            self._chains.writerow(CHAINS_FIELDNAMES)
+
+    def _recover(self):
+        # Keep whole index records whose blob is complete, the blobs they
+        # cover and whole chain lines that only use those records
+        index_path = os.path.join(self.path, INDEX_FILE)
+        certs_path = os.path.join(self.path, CERTS_FILE)
+        size = os.path.getsize(index_path) if os.path.exists(index_path) else 0
+        certs_size = os.path.getsize(certs_path) if os.path.exists(certs_path) else 0
+        end = 0
+        if size >= _RECORD.size:
+            with open(index_path, mode='rb') as file:
+                for fingerprint, offset, length in _RECORD.iter_unpack(file.read(size - size % _RECORD.size)):
+                    if offset + length > certs_size:
+                        break
+                    self._ids[fingerprint] = len(self._ids)
+                    end = offset + length
+        _truncate(index_path, len(self._ids) * _RECORD.size)
+        _truncate(certs_path, end)
+        self._offset = os.path.getsize(certs_path) if os.path.exists(certs_path) else 0
+
+        chains_path = os.path.join(self.path, CHAINS_FILE)
+        if os.path.exists(chains_path):
+            with open(chains_path, mode='rb') as file:
+                end = file.seek(0, os.SEEK_END)
+                while end > 0:
+                    start = max(end - 65536, 0)
+                    file.seek(start)
+                    newline = file.read(end - start).rfind(b'\n')
+                    if newline >= 0:
+                        end = start + newline + 1
+                        break
+                    end = start
+            _truncate(chains_path, end)
+            if len(self._ids) < size // _RECORD.size:
+                self._drop_chains(chains_path)
+
+    def _drop_chains(self, chains_path):
+        # Rewrite chains.csv without the chains using a dropped index record
+        temp_path = chains_path + '.tmp'
+        with open(chains_path, mode='r', newline='', encoding='utf-8') as infile, \
+                open(temp_path, mode='w', newline='', encoding='utf-8') as outfile:
+            writer = csv.writer(outfile)
+            for row in csv.reader(infile):
+                if row == CHAINS_FIELDNAMES or all(int(cert_id) < len(self._ids) for cert_id in row[2].split()):
+                    writer.writerow(row)
+        os.replace(temp_path, chains_path)
+
+    def add_chain(self, domain, cert_chain):
+        """
+        Archive a chain of certificate details that carry their 'der' bytes.
+        Chains without them (e.g. copied from an older CSV) are skipped;
+        returns whether the chain was archived.
+        """
+        if not cert_chain or any(cert.get('der') is None for cert in cert_chain):
+            return False
+        cert_ids = []
+        for cert in cert_chain:
+            der = cert['der']
+            fingerprint = (bytes.fromhex(cert['fingerprint']) if cert.get('fingerprint')
+                           else hashlib.sha256(der).digest())
+            cert_id = self._ids.get(fingerprint)
+            if cert_id is None:
+                cert_id = len(self._ids)
+                self._ids[fingerprint] = cert_id
+                self._certs.write(der)
+                self._records.append(_RECORD.pack(fingerprint, self._offset, len(der)))
+                self._offset += len(der)
+                self.certificates_added += 1
+            cert_ids.append(cert_id)
+        self._rows.append([self.scan_date, domain, ' '.join(map(str, cert_ids))])
+        self.chains_added += 1
+        return True
+
+    def flush(self):
+        # The blobs are on disk before any index record points into them
+        self._certs.flush()
+        os.fsync(self._certs.fileno())
+        self._index.write(b''.join(self._records))
+        self._index.flush()
+        self._chains.writerows(self._rows)
+        self._chains_file.flush()
+        self._records = []
+        self._rows = []
+
+    def close(self):
+        self.flush()
+        self._certs.close()
+        self._index.close()
+        self._chains_file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+def _map(path):
+    # An empty file cannot be mapped
+    with open(path, mode='rb') as file:
+        if os.fstat(file.fileno()).st_size == 0:
+            return b''
+        return mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+
+class ArchiveReader:
+    """
+    Read side of a DerArchive, as of when it was opened. Blobs and index
+    are memory-mapped: 'index' is a numpy view of certs.idx and der()
+    returns a memoryview slice of certs.bin, neither copies anything.
+    cryptography only parses bytes, so certificate() copies the one
+    certificate it parses.
+    """
+    def __init__(self, path):
+        self.path = path
+        self._certs = _map(os.path.join(path, CERTS_FILE))
+        self._index = _map(os.path.join(path, INDEX_FILE))
+        self.index = np.frombuffer(self._index, dtype=INDEX_DTYPE,
+                                   count=len(self._index) // INDEX_DTYPE.itemsize)
+        self._view = memoryview(self._certs)
+
+    def __len__(self):
+        return len(self.index)
+
+    def der(self, cert_id):
+        record = self.index[cert_id]
+        offset = int(record['offset'])
+        return self._view[offset:offset + int(record['length'])]
+
+    def certificate(self, cert_id):
+        return x509.load_der_x509_certificate(bytes(self.der(cert_id)))
+
+    def chains(self, scan_date=None):
+        """
+        DataFrame of (scan_date, domain, chain_position, cert_id), one row
+        per archived certificate of each chain, optionally for one scan date.
+        """
+        chains = pd.read_csv(os.path.join(self.path, CHAINS_FILE), dtype=str, keep_default_na=False)
+        if scan_date is not None:
+            chains = chains[chains['scan_date'] == scan_date]
+        chains = chains.assign(cert_id=chains['cert_ids'].str.split(' ')).explode('cert_id')
+        chains['cert_id'] = chains['cert_id'].astype('int64')
+        chains['chain_position'] = chains.groupby(level=0).cumcount()
+        # Ids written after this reader mapped the index are not visible yet
+        chains = chains[chains['cert_id'] < len(self)]
+        return chains[['scan_date', 'domain', 'chain_position', 'cert_id']].reset_index(drop=True)
+
+    def close(self):
+        # Views of a map must be gone before it can be closed
+        self.index = None
+        self._view.release()
+        for mapped in (self._certs, self._index):
+            if isinstance(mapped, mmap.mmap):
+                mapped.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+def _oid_names(oids):
+    # Names of cryptography's public OID constants by dotted string, e.g. 'rsa_with_sha256'
+    return {oid.dotted_string: name.lower() for name, oid in vars(oids).items()
+            if isinstance(oid, x509.ObjectIdentifier)}
+
+SIGNATURE_ALGORITHMS = _oid_names(SignatureAlgorithmOID)
+KEY_ALGORITHMS = _oid_names(PublicKeyAlgorithmOID)
+
+def certificate_fields(cert):
+    """
+    Fields the CSV output never had, extracted from a parsed certificate.
+    An example of what can be re-extracted without rescanning. Keys that
+    cryptography cannot load, such as GOST keys, are named after their
+    algorithm OID and have no size.
+    """
+    signature_oid = cert.signature_algorithm_oid.dotted_string
+    fields = {
+        'key_type': None,
+        'key_size': None,
+        'signature_algorithm': SIGNATURE_ALGORITHMS.get(signature_oid, signature_oid),
+        'san_count': 0,
+        'policy_oids': '',
+        'sct_count': 0,
+    }
+    try:
+        key = cert.public_key()
+    except UnsupportedAlgorithm:
+        key_oid = cert.public_key_algorithm_oid.dotted_string
+        fields['key_type'] = KEY_ALGORITHMS.get(key_oid, key_oid)
+    else:
+        fields['key_type'] = type(key).__name__.lstrip('_').replace('PublicKey', '')
+        fields['key_size'] = getattr(key, 'key_size', None)
+    extensions = cert.extensions
+    try:
+        sans = extensions.get_extension_for_class(x509.SubjectAlternativeName).value
+        fields['san_count'] = len(sans)
+    except x509.ExtensionNotFound:
+        pass
+    try:
+        policies = extensions.get_extension_for_class(x509.CertificatePolicies).value
+        fields['policy_oids'] = ' '.join(policy.policy_identifier.dotted_string for policy in policies)
+    except x509.ExtensionNotFound:
+        pass
+    try:
+        scts = extensions.get_extension_for_class(x509.PrecertificateSignedCertificateTimestamps).value
+        fields['sct_count'] = len(scts)
+    except x509.ExtensionNotFound:
+        pass
+    return fields
+
+def _extract(path, cert_ids, function):
+    # Runs in a worker process, which maps the archive itself
+    rows = []
+    with ArchiveReader(path) as reader:
+        for cert_id in cert_ids:
+            try:
+                rows.append(function(reader.certificate(int(cert_id))))
+            except (ValueError, UnsupportedAlgorithm):
+                # Malformed DER or extension, or an algorithm cryptography lacks; the row stays empty
+                rows.append({})
+    return rows
+
+def extract_fields(path, function=certificate_fields, cert_ids=None, processes=None, chunk_size=10000):
+    """
+    DataFrame of function(certificate) for each distinct certificate in
+    'cert_ids' (default: all), indexed by cert_id. 'function' must be a
+    module-level function; certificates are parsed by 'processes' worker
+    processes, 'chunk_size' at a time.
+    """
+    if cert_ids is None:
+        with ArchiveReader(path) as reader:
+            cert_ids = np.arange(len(reader))
+    cert_ids = np.asarray(cert_ids)
+    chunks = [cert_ids[start:start + chunk_size] for start in range(0, len(cert_ids), chunk_size)]
+    with ProcessPoolExecutor(max_workers=processes) as executor:
+        rows = [row for part in executor.map(_extract, repeat(path), chunks, repeat(function))
+                for row in part]
+    return pd.DataFrame(rows, index=pd.Index(cert_ids, name='cert_id'))
+
+def extract_chains(path, function=certificate_fields, scan_date=None, leaf_only=False, processes=None):
+    """
+    Chains of 'scan_date' (default: every scan) joined with
+    function(certificate) of each of their certificates. Each distinct
+    certificate is parsed once however many chains it is in.
+    """
+    with ArchiveReader(path) as reader:
+        chains = reader.chains(scan_date)
+    if leaf_only:
+        chains = chains[chains['chain_position'] == 0].reset_index(drop=True)
+    fields = extract_fields(path, function, np.unique(chains['cert_id'].to_numpy()), processes)
+    return chains.join(fields, on='cert_id')
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Extract certificate fields from DER archives without rescanning.')
+    parser.add_argument('output_file')
+    parser.add_argument('archives', nargs='+', help='archive directories, e.g. one per shard')
+    parser.add_argument('--scan-date', default=None, help='only chains scanned on this date (YYYY-MM-DD)')
+    parser.add_argument('--leaf-only', action='store_true')
+    parser.add_argument('--processes', type=int, default=None)
+    args = parser.parse_args()
+
+    frames = [extract_chains(path, scan_date=args.scan_date, leaf_only=args.leaf_only,
+                             processes=args.processes) for path in args.archives]
+    pd.concat(frames, ignore_index=True).to_csv(args.output_file, index=False)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,170 @@
+import asyncio
+import heapq
+import ipaddress
+from collections import deque
+
+class DestinationLimits:
+    """
+    Limits applied per destination by scan_domains(): at most
+    'per_destination' handshakes in flight to one destination, and if
+    'rate' is set, at most 'rate' new handshakes per second to it with
+    bursts of up to 'burst' (token bucket). A destination is the resolved
+    IP address, or its /'prefix' network when 'prefix' is set (IPv4; IPv6
+    addresses are grouped by /64).
+    """
+    def __init__(self, per_destination=8, rate=None, burst=None, prefix=None, lookahead=8):
+        self.per_destination = per_destination
+        self.rate = rate
+        self.burst = burst if burst is not None else max(per_destination or 1, 1)
+        self.prefix = prefix
+        # Resolved domains kept waiting per handshake slot, so there is
+        # something to interleave when a few destinations dominate the list
+        self.lookahead = lookahead
+
+    def destination(self, address):
+        if address is None or self.prefix is None:
+            return address
+        ip = ipaddress.ip_address(address)
+        prefix = self.prefix if ip.version == 4 else 64
+        return ipaddress.ip_network(f'{address}/{prefix}', strict=False)
+
+class DestinationQueue:
+    """
+    Queue between the resolve stage and the handshake workers. Items are
+    kept per destination and handed out round-robin over the destinations
+    that are under their concurrency cap and have a token, so one CDN edge
+    cannot take every worker. Items without an address (no resolver) are
+    not limited. Workers must call release() when done with an item.
+    """
+    def __init__(self, limits, maxsize):
+        self.limits = limits
+        self.maxsize = maxsize
+        lock = asyncio.Lock()
+        self._not_empty = asyncio.Condition(lock)
+        self._not_full = asyncio.Condition(lock)
+        self._pending = {}      # destination -> deque of items
+        self._active = {}       # destination -> handshakes in flight
+        self._buckets = {}      # destination -> [tokens, last refill time]
+        self._ready = deque()   # destinations that may start a handshake now
+        self._scheduled = set() # in _ready or _delayed
+        self._delayed = []      # heap of (time a token is due, sequence, destination)
+        self._sequence = 0
+        self._size = 0
+        self._closed = False
+
+    def _now(self):
+        return asyncio.get_running_loop().time()
+
+    def _tokens(self, destination, now):
+        tokens, last = self._buckets.get(destination, (self.limits.burst, now))
+        tokens = min(tokens + (now - last) * self.limits.rate, self.limits.burst)
+        self._buckets[destination] = [tokens, now]
+        return tokens
+
+    def _schedule(self, destination):
+        # Put a destination with pending items back in line, unless it is
+        # already there or has to wait for a slot (release) or a token
+        if destination in self._scheduled or destination not in self._pending:
+            return
+        if destination is not None:
+            cap = self.limits.per_destination
+            if cap is not None and self._active.get(destination, 0) >= cap:
+                return
+            if self.limits.rate is not None:
+                now = self._now()
+                tokens = self._tokens(destination, now)
+                if tokens < 1:
+                    due = now + (1 - tokens) / self.limits.rate
+                    self._sequence += 1
+                    heapq.heappush(self._delayed, (due, self._sequence, destination))
+                    self._scheduled.add(destination)
+                    return
+        self._ready.append(destination)
+        self._scheduled.add(destination)
+
+    def _promote_delayed(self):
+        now = self._now()
+        while self._delayed and self._delayed[0][0] <= now:
+            _, _, destination = heapq.heappop(self._delayed)
+            self._scheduled.discard(destination)
+            self._schedule(destination)
+
+    def _prune_buckets(self):
+        # Forget buckets of idle destinations once they would be full again anyway
+        if len(self._buckets) <= 2 * (len(self._pending) + len(self._active)) + 1024:
+            return
+        now = self._now()
+        for destination in list(self._buckets):
+            if (destination not in self._pending and destination not in self._active
+                    and self._tokens(destination, now) >= self.limits.burst):
+                del self._buckets[destination]
+
+    async def put(self, item, address):
+        destination = self.limits.destination(address)
+        async with self._not_full:
+            while self._size >= self.maxsize:
+                await self._not_full.wait()
+            self._pending.setdefault(destination, deque()).append(item)
+            self._size += 1
+            self._schedule(destination)
+            self._not_empty.notify()
+
+    async def get(self):
+        """
+        Return (item, destination) for the next handshake, or None once the
+        queue is closed and empty.
+        """
+        async with self._not_empty:
+            while True:
+                self._promote_delayed()
+                if self._ready:
+                    destination = self._ready.popleft()
+                    self._scheduled.discard(destination)
+                    items = self._pending[destination]
+                    item = items.popleft()
+                    if not items:
+                        del self._pending[destination]
+                    self._size -= 1
+                    if destination is not None:
+                        self._active[destination] = self._active.get(destination, 0) + 1
+                        if self.limits.rate is not None:
+                            self._buckets[destination][0] -= 1
+                    # Back of the line: the next get() serves another destination
+                    self._schedule(destination)
+                    self._not_full.notify()
+                    if self._closed and self._size == 0:
+                        # Drained: every waiting worker can stop
+                        self._not_empty.notify_all()
+                    elif self._ready:
+                        # Wake one worker at a time rather than all of them
+                        self._not_empty.notify()
+                    return item, destination
+
+                if self._closed and self._size == 0:
+                    return None
+                timeout = max(self._delayed[0][0] - self._now(), 0) if self._delayed else None
+                try:
+                    await asyncio.wait_for(self._not_empty.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+
+    async def release(self, destination):
+        if destination is None:
+            return
+        async with self._not_empty:
+            active = self._active[destination] - 1
+            if active:
+                self._active[destination] = active
+            else:
+                del self._active[destination]
+            self._schedule(destination)
+            if self.limits.rate is not None:
+                self._prune_buckets()
+            if self._ready:
+                self._not_empty.notify()
+
+    async def close(self):
+        # No more put() calls; get() returns None once the queue drains
+        async with self._not_empty:
+            self._closed = True
+            self._not_empty.notify_all()
@@ -0,0 +1,275 @@
+import asyncio
+import random
+import socket
+import struct
+import time
+
+QTYPE_A = 1
+QTYPE_CNAME = 5
+QTYPE_SOA = 6
+QTYPE_AAAA = 28
+
+RCODE_NOERROR = 0
+RCODE_SERVFAIL = 2
+RCODE_NXDOMAIN = 3
+
+class DNSError(Exception):
+    """
+    Raised when a name cannot be resolved. 'rcode' is the DNS response code,
+    or None when no answer was received at all. 'ttl' is how long the
+    negative answer may be cached, when the server said so.
+    """
+    def __init__(self, name, reason, rcode=None, ttl=None):
+        super().__init__(f"{name}: {reason}")
+        self.name = name
+        self.rcode = rcode
+        self.ttl = ttl
+
+def read_nameservers(path='/etc/resolv.conf'):
+    # Same rule as the C library: no 'nameserver' line means the local host
+    nameservers = []
+    try:
+        with open(path, mode='r', encoding='utf-8') as file:
+            for line in file:
+                fields = line.split()
+                if len(fields) >= 2 and fields[0] == 'nameserver':
+                    nameservers.append((fields[1], 53))
+    except OSError:
+        pass
+    return nameservers or [('127.0.0.1', 53)]
+
+def question_section(name, qtype=QTYPE_A):
+    # QNAME, QTYPE and class IN, as sent in a query and echoed in its response
+    qname = b''.join(bytes([len(label)]) + label
+                     for label in name.rstrip('.').encode('idna').split(b'.'))
+    return qname + b'\x00' + struct.pack('!HH', qtype, 1)
+
+def build_query(query_id, name, qtype=QTYPE_A):
+    # Header: id, flags (recursion desired), 1 question, no other records
+    header = struct.pack('!HHHHHH', query_id, 0x0100, 1, 0, 0, 0)
+    return header + question_section(name, qtype)
+
+def _skip_name(message, offset):
+    # Skip an encoded name, stopping at the first compression pointer
+    while True:
+        length = message[offset]
+        if length == 0:
+            return offset + 1
+        if length & 0xC0 == 0xC0:
+            return offset + 2
+        offset += length + 1
+
+def parse_response(message, qtype=QTYPE_A):
+    """
+    Parse a DNS response into (query_id, rcode, addresses, ttl).
+    'ttl' is the smallest TTL of the records that led to the answer; for
+    negative answers it is the SOA negative-caching TTL, or None if the
+    server sent no SOA record.
+    """
+    query_id, flags, qdcount, ancount, nscount, _ = struct.unpack_from('!HHHHHH', message)
+    rcode = flags & 0x000F
+
+    offset = 12
+    for _ in range(qdcount):
+        offset = _skip_name(message, offset) + 4
+
+    addresses = []
+    ttl = None
+    for _ in range(ancount):
+        offset = _skip_name(message, offset)
+        rtype, _, rttl, rdlength = struct.unpack_from('!HHIH', message, offset)
+        offset += 10
+        rdata = message[offset:offset + rdlength]
+        offset += rdlength
+
+        if rtype == qtype == QTYPE_A and rdlength == 4:
+            addresses.append(socket.inet_ntop(socket.AF_INET, rdata))
+        elif rtype == qtype == QTYPE_AAAA and rdlength == 16:
+            addresses.append(socket.inet_ntop(socket.AF_INET6, rdata))
+        elif rtype != QTYPE_CNAME:
+            continue
+        ttl = rttl if ttl is None else min(ttl, rttl)
+
+    if not addresses:
+        # RFC 2308: negative answers are cached for min(SOA TTL, SOA MINIMUM)
+        ttl = None
+        for _ in range(nscount):
+            offset = _skip_name(message, offset)
+            rtype, _, rttl, rdlength = struct.unpack_from('!HHIH', message, offset)
+            offset += 10
+            if rtype == QTYPE_SOA:
+                minimum = struct.unpack_from('!I', message, offset + rdlength - 4)[0]
+                ttl = min(rttl, minimum)
+            offset += rdlength
+
+    return query_id, rcode, addresses, ttl
+
+def _matches(data, addr, nameserver, question):
+    # A response from the queried server that echoes the question asked.
+    # Ids are reused as soon as a query times out, so a late answer to an
+    # earlier query can carry the id of a current one; names compare
+    # case-insensitively
+    _, flags, qdcount = struct.unpack_from('!HHH', data)
+    return (flags & 0x8000 and qdcount == 1
+            and tuple(addr[:2]) == tuple(nameserver[:2])
+            and data[12:12 + len(question)].lower() == question.lower())
+
+class _ResolverProtocol(asyncio.DatagramProtocol):
+    # Hands each response to the future waiting for its query id, dropping
+    # responses that do not match the query's server and question
+    def __init__(self, pending):
+        self.pending = pending
+
+    def datagram_received(self, data, addr):
+        if len(data) < 12:
+            return
+        query_id = struct.unpack_from('!H', data)[0]
+        query = self.pending.get(query_id)
+        if query is None:
+            return
+        future, nameserver, question = query
+        if not future.done() and _matches(data, addr, nameserver, question):
+            future.set_result(data)
+
+class AsyncResolver:
+    """
+    Concurrent stub resolver with a TTL-aware cache, used to resolve names
+    before any TCP or TLS work starts. All queries share one UDP socket;
+    concurrent lookups of the same name share one query, and negative
+    answers (NXDOMAIN, no address) are cached as well.
+    """
+    def __init__(self, nameservers=None, qtype=QTYPE_A, timeout=2.0, attempts=2,
+                 min_ttl=0, max_ttl=3600, negative_ttl=300):
+        self.nameservers = nameservers or read_nameservers()
+        self.qtype = qtype
+        self.timeout = timeout
+        self.attempts = attempts
+        self.min_ttl = min_ttl
+        self.max_ttl = max_ttl
+        self.negative_ttl = negative_ttl
+        self.hits = 0
+        self.misses = 0
+        self._cache = {}
+        self._lookups = {}
+        self._pending = {}
+        self._transports = {}
+
+    @property
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses, "hit_rate": self.hit_rate,
+                "cached_names": len(self._cache)}
+
+    async def resolve(self, name):
+        """
+        Return the list of addresses for 'name', raising DNSError if it
+        does not resolve.
+        """
+        name = name.rstrip('.').lower()
+        entry = self._cache.get(name)
+        if entry is not None:
+            expires_at, addresses, error = entry
+            if expires_at > time.monotonic():
+                self.hits += 1
+                if error is not None:
+                    # Drop the traceback of the previous raise so it does not grow
+                    raise error.with_traceback(None)
+                return addresses
+            del self._cache[name]
+
+        # Another task is already asking for this name
+        lookup = self._lookups.get(name)
+        if lookup is not None:
+            self.hits += 1
+            return await asyncio.shield(lookup)
+
+        self.misses += 1
+        lookup = asyncio.ensure_future(self._lookup(name))
+        self._lookups[name] = lookup
+        try:
+            return await asyncio.shield(lookup)
+        finally:
+            self._lookups.pop(name, None)
+
+    async def _lookup(self, name):
+        try:
+            addresses, ttl = await self._query(name)
+        except DNSError as e:
+            if e.rcode is not None:
+                self._store(name, None, e, self.negative_ttl if e.ttl is None else e.ttl)
+            raise
+
+        if not addresses:
+            error = DNSError(name, "No address records", RCODE_NOERROR)
+            self._store(name, None, error, self.negative_ttl if ttl is None else ttl)
+            raise error
+
+        self._store(name, addresses, None, ttl)
+        return addresses
+
+    def _store(self, name, addresses, error, ttl):
+        ttl = min(max(ttl, self.min_ttl), self.max_ttl)
+        if ttl > 0:
+            self._cache[name] = (time.monotonic() + ttl, addresses, error)
+
+    async def _transport_for(self, nameserver):
+        # Every task starting at once must still end up sharing one socket
+        transport = self._transports.get(nameserver)
+        if transport is None:
+            loop = asyncio.get_running_loop()
+            transport = loop.create_future()
+            self._transports[nameserver] = transport
+            family = socket.AF_INET6 if ':' in nameserver[0] else socket.AF_INET
+            try:
+                endpoint, _ = await loop.create_datagram_endpoint(
+                    lambda: _ResolverProtocol(self._pending), family=family)
+            except Exception as e:
+                del self._transports[nameserver]
+                transport.set_exception(e)
+                raise
+            transport.set_result(endpoint)
+        return await asyncio.shield(transport)
+
+    def _new_query_id(self):
+        while True:
+            query_id = random.getrandbits(16)
+            if query_id not in self._pending:
+                return query_id
+
+    async def _query(self, name):
+        loop = asyncio.get_running_loop()
+        for attempt in range(self.attempts):
+            # Rotate through the configured nameservers on each retry
+            nameserver = self.nameservers[attempt % len(self.nameservers)]
+            transport = await self._transport_for(nameserver)
+
+            query_id = self._new_query_id()
+            future = loop.create_future()
+            self._pending[query_id] = (future, nameserver, question_section(name, self.qtype))
+            try:
+                transport.sendto(build_query(query_id, name, self.qtype), nameserver)
+                message = await asyncio.wait_for(future, self.timeout)
+            except asyncio.TimeoutError:
+                continue
+            finally:
+                del self._pending[query_id]
+
+            _, rcode, addresses, ttl = parse_response(message, self.qtype)
+            if rcode == RCODE_NXDOMAIN:
+                raise DNSError(name, "NXDOMAIN", rcode, ttl)
+            if rcode == RCODE_SERVFAIL:
+                continue
+            if rcode != RCODE_NOERROR:
+                raise DNSError(name, f"DNS error rcode {rcode}", rcode)
+            return addresses, ttl
+
+        raise DNSError(name, f"No answer after {self.attempts} attempts")
+
+    def close(self):
+        for transport in self._transports.values():
+            if transport.done() and transport.exception() is None:
+                transport.result().close()
+        self._transports.clear()
@@ -1,56 +1,80 @@
 import csv
 import socket
 import select
-from OpenSSL import SSL, crypto
-from cryptography import x509
+from OpenSSL import SSL
 import time
-from cryptography.hazmat.backends import default_backend
+from cert_cache import CertDetailsCache
+from cert_writer import CertChainWriter
+from handshake import chain_received, reset_on_close, worker_context
+from scan_errors import ConnectTimeout, HandshakeTimeout, classify_error
+from scan_metrics import CONNECT, HANDSHAKE, PARSE, MetricsReporter, ScanMetrics
+from scan_scheduler import RetryScheduler
+from scan_state import ScanState
 
 def fetch_ssl_certificate_chain(hostname, port=443, timeout=10):
     try:
-        # Create a new SSL context
-        context = SSL.Context(SSL.TLSv1_2_METHOD)
-        context.set_verify(SSL.VERIFY_NONE, lambda *x: True)
-        
-        # Create a socket and wrap it in an SSL connection
+        return fetch_ssl_certificate_chain_or_raise(hostname, port, timeout)
+    except Exception as e:
+        print(f"An error occurred for hostname {hostname}: {e}")
+        return []
+
+# Same as fetch_ssl_certificate_chain, but lets the error through so it can be recorded.
+# With 'metrics', completed phases are timed; 'connect' includes the DNS lookup here.
+# 'fast' negotiates TLS 1.2 or 1.3 and stops once the chain is in (see handshake.py)
+def fetch_ssl_certificate_chain_or_raise(hostname, port=443, timeout=10, metrics=None, fast=False):
+    # Built once and reused for every domain
+    context = worker_context(fast)
+    
+    # Create a socket and wrap it in an SSL connection
+    start = time.perf_counter()
+    try:
         sock = socket.create_connection((hostname, port), timeout=timeout)
-        ssl_conn = SSL.Connection(context, sock)
-        ssl_conn.set_connect_state()
-        ssl_conn.set_tlsext_host_name(hostname.encode())
-        
-        end_time = time.time() + timeout
-        while True:
-            try:
-                ssl_conn.do_handshake()
+    except socket.timeout:
+        raise ConnectTimeout(f"TCP connect to {hostname} timed out") from None
+    if metrics is not None:
+        connected = time.perf_counter()
+        metrics.observe(CONNECT, connected - start)
+    ssl_conn = SSL.Connection(context, sock)
+    ssl_conn.set_connect_state()
+    ssl_conn.set_tlsext_host_name(hostname.encode())
+    
+    end_time = time.time() + timeout
+    while True:
+        try:
+            ssl_conn.do_handshake()
+            break
+        except SSL.WantReadError:
+            # The chain is all a fast handshake waits for
+            if fast and chain_received(ssl_conn):
                 break
-            except SSL.WantReadError:
-                if time.time() > end_time:
-                    raise TimeoutError("SSL handshake timed out")
-                select.select([ssl_conn], [], [], end_time - time.time())
-            except SSL.WantWriteError:
-                if time.time() > end_time:
-                    raise TimeoutError("SSL handshake timed out")
-                select.select([], [ssl_conn], [], end_time - time.time())
-        
-        # Retrieve the entire certificate chain
-        cert_chain = ssl_conn.get_peer_cert_chain()
-        
-        cert_details = []
-        for cert in cert_chain:
-            pem_cert = crypto.dump_certificate(crypto.FILETYPE_PEM, cert).decode()
-            parsed_cert = x509.load_pem_x509_certificate(pem_cert.encode(), default_backend())
-            cert_details.append(extract_certificate_details(parsed_cert))
+            if time.time() > end_time:
+                raise HandshakeTimeout("SSL handshake timed out")
+            select.select([ssl_conn], [], [], end_time - time.time())
+        except SSL.WantWriteError:
+            if time.time() > end_time:
+                raise HandshakeTimeout("SSL handshake timed out")
+            select.select([], [ssl_conn], [], end_time - time.time())
+    if metrics is not None:
+        handshaken = time.perf_counter()
+        metrics.observe(HANDSHAKE, handshaken - connected)
+    
+    # Retrieve the entire certificate chain
+    cert_chain = ssl_conn.get_peer_cert_chain()
+    
+    # Intermediates are looked up by fingerprint instead of being parsed again
+    cert_details = cert_cache.chain_details(cert_chain)
+    if metrics is not None:
+        metrics.observe(PARSE, time.perf_counter() - handshaken)
 
-        # Close the connection
+    # Close the connection; a fast handshake skips close_notify and resets it
+    if fast:
+        reset_on_close(sock)
+    else:
         ssl_conn.shutdown()
-        ssl_conn.close()
-        sock.close()
+    ssl_conn.close()
+    sock.close()
 
-        return cert_details
-
-    except Exception as e:
-        print(f"An error occurred for hostname {hostname}: {e}")
-        return []
+    return cert_details
 
 def extract_certificate_details(cert):
     details = {
@@ -63,11 +87,14 @@ def extract_certificate_details(cert):
     }
     return details
 
+# Shared by every fetch in this process
+cert_cache = CertDetailsCache(extract_certificate_details)
+
 def write_cert_chain_to_csv(domain, cert_chain, filename):
     fieldnames = ["domain", "subject", "issuer", "version", "serial_number", "not_before", "not_after"]
     
     with open(filename, mode='a', newline='') as file:
-        writer = csv.DictWriter(file, fieldnames=fieldnames)
+        writer = csv.DictWriter(file, fieldnames=fieldnames, extrasaction='ignore')
         
         # Write header only if file is empty
         if file.tell() == 0:
@@ -78,18 +105,75 @@ def write_cert_chain_to_csv(domain, cert_chain, filename):
             row.update(cert)
             writer.writerow(row)
 
-def process_domains_from_csv(input_file, output_file):
-    with open(input_file, mode='r', newline='', encoding='utf-8') as infile:
+def process_domains_from_csv(input_file, output_file, state_file=None, max_attempts=3, scheduler=None,
+                             fast_handshake=False, metrics_json=None, metrics_prometheus=None,
+                             progress_interval=10.0):
+    # With a state file, domains finished by an earlier run are skipped and
+    # retryable failures are attempted again, up to max_attempts times
+    state = ScanState(state_file) if state_file else None
+    on_flush = state.record_successes if state else None
+
+    # A short adaptive timeout first; retryable failures get later rounds
+    # with longer timeouts instead of holding up the whole list
+    if scheduler is None:
+        scheduler = RetryScheduler(max_attempts)
+    metrics = ScanMetrics()
+
+    def scan(domain, timeout):
+        start = time.monotonic()
+        metrics.started()
+        try:
+            cert_chain = fetch_ssl_certificate_chain_or_raise(domain, timeout=timeout, metrics=metrics,
+                                                              fast=fast_handshake)
+        except Exception as e:
+            error = e
+        else:
+            error = None
+            writer.write(domain, cert_chain)
+        finally:
+            metrics.finished()
+        # Only final results are counted, and final failures reported and recorded
+        if not scheduler.record(domain, error, time.monotonic() - start):
+            return
+        metrics.record_result(None if error is None else classify_error(error))
+        if error is not None:
+            print(f"An error occurred for hostname {domain}: {error}")
+            if state:
+                state.record_failure(domain, error)
+
+    # The reporter is stopped last, so its final report includes the last write
+    with open(input_file, mode='r', newline='', encoding='utf-8') as infile, \
+         MetricsReporter(metrics, progress_interval, metrics_json, metrics_prometheus), \
+         CertChainWriter(output_file, on_flush=on_flush, metrics=metrics) as writer:
         reader = csv.reader(infile)
+        domains = (row[0] for row in reader)
+        if state:
+            domains = state.pending(domains, max_attempts)
         
-        for row in reader:
-            domain = row[0]
-            cert_chain = fetch_ssl_certificate_chain(domain)
-            if cert_chain:
-                write_cert_chain_to_csv(domain, cert_chain, output_file)
+        for domain in domains:
+            scan(domain, scheduler.first_timeout())
+
+        while True:
+            retry = scheduler.next_round()
+            if retry is None:
+                break
+            delay, timeout, retry_domains = retry
+            time.sleep(delay)
+            for domain in retry_domains:
+                scan(domain, timeout)
+
+    if state:
+        print(f"Skipped {state.skipped} domains already done or given up in {state_file}; delete it to scan them again")
+        state.close()
+
+    print(f"Attempts by outcome: {scheduler.stats.summary()}")
+
+    print(f"Certificate cache: {cert_cache.hits} hits, {cert_cache.misses} misses ({cert_cache.hit_rate:.1%} hit rate)")
 
 def main():
-    process_domains_from_csv('./csv/brics.csv', './csv/brics_certificates.csv')
+    # Domains done in an earlier run are skipped; delete the state file to start from scratch
+    process_domains_from_csv('./csv/brics.csv', './csv/brics_certificates.csv',
+                             state_file='./csv/brics_scan_state.db')
 
 if __name__ == '__main__':
     main()
\ No newline at end of file
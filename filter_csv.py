@@ -1,5 +1,10 @@
 import csv
+import io
+import os
+from collections import deque
+from multiprocessing import Pool
 import constants
+from suffix_classifier import SuffixClassifier
 
 # Function to check if the string ends with any of the specified suffixes
 def ends_with_suffix(string, suffixes):
@@ -14,28 +19,103 @@ def remove_prefix(domain):
     return domain
 
 # Read and filter the CSV file
-def filter_csv(input_file, output_file):
-    with open(input_file, mode='r', newline='', encoding='utf-8') as infile, \
-         open(output_file, mode='w', newline='', encoding='utf-8') as outfile:
-        reader = csv.reader(infile)
-        writer = csv.writer(outfile)
-        
-        # Write header to output file if there is one
-        header = next(reader, None)
-        if header:
-            pass
-        
-        # Filter rows based on the first field
-        for row in reader:
-            domain = remove_prefix(row[0])
-            if ends_with_suffix(domain, constants.brics_suffixes):
-                writer.writerow([domain] + row[1:])
-
-# Specify input and output CSV file paths
-input_csv_file = './csv/202406.csv'
-output_csv_file = './csv/brics.csv'
-
-# Filter the CSV file
-filter_csv(input_csv_file, output_csv_file)
-
-print(f'Filtered data has been written to {output_csv_file}')
\ No newline at end of file
+def filter_csv(input_file, output_file, suffixes=constants.brics_suffixes):
+    partition_csv(input_file, {"selected": output_file}, {"selected": suffixes}, workers=1)
+
+# Set in each process by _init_partitioner
+_classifier = None
+_catch_all = ()
+
+def _init_partitioner(regions):
+    global _classifier, _catch_all
+    # A region without a suffix list takes every domain
+    _classifier = SuffixClassifier({region: suffixes for region, suffixes in regions.items()
+                                    if suffixes is not None})
+    _catch_all = tuple(region for region, suffixes in regions.items() if suffixes is None)
+
+def _partition_chunk(text):
+    # Route every row of a block of input lines to all the regions it matches;
+    # returns the CSV text to append to each region's output
+    buffers = {}
+    writers = {}
+    for row in csv.reader(io.StringIO(text)):
+        if not row:
+            continue
+        domain = remove_prefix(row[0])
+        for region in _classifier.regions_for(domain) + _catch_all:
+            if region not in writers:
+                buffers[region] = io.StringIO()
+                writers[region] = csv.writer(buffers[region])
+            writers[region].writerow([domain] + row[1:])
+    return {region: buffer.getvalue() for region, buffer in buffers.items()}
+
+def _read_chunks(infile, chunk_bytes):
+    # Blocks of whole lines, roughly chunk_bytes each
+    while True:
+        lines = infile.readlines(chunk_bytes)
+        if not lines:
+            return
+        yield ''.join(lines)
+
+def partition_csv(input_file, outputs, regions=None, workers=None, chunk_bytes=1 << 22):
+    """
+    Split a top list into one CSV per region in a single streaming pass.
+    'outputs' maps region names to output paths and 'regions' maps region
+    names to suffix lists (None meaning every domain). Each domain, with its
+    prefix removed, goes to every region it matches. Blocks of lines are
+    classified on 'workers' processes while the input is still being read,
+    with at most two blocks per worker pending; output order follows input.
+    """
+    if regions is None:
+        regions = constants.regions
+    regions = {region: regions[region] for region in outputs}
+    if workers is None:
+        workers = os.cpu_count() or 1
+
+    outfiles = {region: open(path, mode='w', newline='', encoding='utf-8')
+                for region, path in outputs.items()}
+    try:
+        with open(input_file, mode='r', newline='', encoding='utf-8') as infile:
+            # Skip the header line, like the original filter
+            infile.readline()
+            chunks = _read_chunks(infile, chunk_bytes)
+
+            if workers <= 1:
+                _init_partitioner(regions)
+                for chunk in chunks:
+                    for region, text in _partition_chunk(chunk).items():
+                        outfiles[region].write(text)
+                return
+
+            with Pool(workers, initializer=_init_partitioner, initargs=(regions,)) as pool:
+                pending = deque()
+                for chunk in chunks:
+                    pending.append(pool.apply_async(_partition_chunk, (chunk,)))
+                    # Bound memory: wait for the oldest block before reading further
+                    if len(pending) >= 2 * workers:
+                        for region, text in pending.popleft().get().items():
+                            outfiles[region].write(text)
+                while pending:
+                    for region, text in pending.popleft().get().items():
+                        outfiles[region].write(text)
+    finally:
+        for outfile in outfiles.values():
+            outfile.close()
+
+def main():
+    # Specify input and output CSV file paths
+    input_csv_file = './csv/202406.csv'
+    output_csv_files = {
+        'brics': './csv/brics.csv',
+        'eu': './csv/eu.csv',
+        'world': './csv/world.csv',
+    }
+
+    # Partition the CSV file; 'world' keeps every domain
+    partition_csv(input_csv_file, output_csv_files, dict(constants.regions, world=None))
+
+    for path in output_csv_files.values():
+        print(f'Filtered data has been written to {path}')
+
+if __name__ == '__main__':
+    main()
\ No newline at end of file
@@ -0,0 +1,51 @@
+import socket
+import struct
+import threading
+from OpenSSL import SSL
+
+def create_context(fast=False):
+    """
+    Client context for fetching chains, without certificate verification.
+    The default context speaks exactly TLS 1.2, as the scanners always
+    did. The fast one negotiates TLS 1.2 or 1.3, asks for no session
+    ticket and installs no Python verify callback, which otherwise runs
+    for every certificate of every chain.
+    """
+    if not fast:
+        context = SSL.Context(SSL.TLSv1_2_METHOD)
+        context.set_verify(SSL.VERIFY_NONE, lambda *x: True)
+        return context
+    context = SSL.Context(SSL.TLS_CLIENT_METHOD)
+    context.set_min_proto_version(SSL.TLS1_2_VERSION)
+    context.set_options(SSL.OP_NO_TICKET)
+    context.set_verify(SSL.VERIFY_NONE)
+    return context
+
+_local = threading.local()
+
+def worker_context(fast=False):
+    # One context per thread, built on first use and kept for every later domain
+    contexts = getattr(_local, 'contexts', None)
+    if contexts is None:
+        contexts = _local.contexts = {}
+    if fast not in contexts:
+        contexts[fast] = create_context(fast)
+    return contexts[fast]
+
+def chain_received(ssl_conn):
+    """
+    True once the server's Certificate message has been processed. In
+    fast mode the handshake stops there: with TLS 1.2 that saves the
+    round trip for the server's Finished. Over a memory BIO (scan_async)
+    the client's next flight also stays unsent; on a socket OpenSSL has
+    usually written it already by the time this is checked.
+    """
+    return ssl_conn.get_peer_cert_chain() is not None
+
+def reset_on_close(sock):
+    # Closing then sends a RST instead of a FIN: no close_notify, no
+    # lingering and no TIME_WAIT entry holding a local port for a minute
+    try:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER, struct.pack('ii', 1, 0))
+    except OSError:
+        pass
@@ -0,0 +1,419 @@
+import argparse
+import asyncio
+import csv
+import datetime
+import os
+import sqlite3
+import time
+from collections import Counter, namedtuple
+from cert_writer import CertChainWriter
+from destination_limits import DestinationLimits
+from dns_resolver import AsyncResolver
+from filter_csv import remove_prefix
+from issuer_fields import split_dn
+from scan_errors import classify_error
+from scan_metrics import MetricsReporter, ScanMetrics
+from scan_scheduler import RetryScheduler
+import scan_async
+
+# Why a domain is rescanned, in the order rescans are run when a budget
+# does not cover all of them
+NEW = 'new'
+EXPIRING = 'expiring'
+FAILED = 'failed'
+STALE = 'stale'
+PRIORITIES = (NEW, EXPIRING, FAILED, STALE)
+
+# Changes recorded in the diff dataset
+RENEWED = 'renewed'
+ISSUER_CHANGED = 'issuer_changed'
+DISAPPEARED = 'disappeared'
+DELISTED = 'delisted'
+
+DIFF_FIELDNAMES = ['snapshot', 'domain', 'change', 'old_issuer', 'new_issuer',
+                   'old_not_after', 'new_not_after', 'old_fingerprint', 'new_fingerprint']
+
+# Last known state of a domain; fields are None until it was scanned
+Record = namedtuple('Record', ['fingerprint', 'issuer', 'not_after', 'scanned_at', 'status'])
+
+# Domains looked up per query, below SQLite's limit on bound parameters
+_LOOKUP_BATCH = 500
+
+class CertificateStore:
+    """
+    Last known leaf certificate (fingerprint, issuer, not_after) of every
+    domain, kept in SQLite across monthly snapshots, with the number of
+    domains per issuer in each snapshot. Everything a snapshot run changes
+    is committed at once by finish_snapshot(), so an interrupted run leaves
+    the store as the previous snapshot left it.
+    """
+    def __init__(self, path):
+        self.conn = sqlite3.connect(path)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS certificates (
+                domain TEXT PRIMARY KEY,
+                fingerprint TEXT,
+                issuer TEXT,
+                not_after TEXT,
+                scanned_at REAL,
+                status TEXT,
+                listed TEXT
+            );
+            CREATE TABLE IF NOT EXISTS snapshots (
+                name TEXT PRIMARY KEY,
+                output_file TEXT NOT NULL,
+                created_at REAL NOT NULL,
+                scanned INTEGER NOT NULL,
+                carried INTEGER NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS issuer_counts (
+                snapshot TEXT NOT NULL,
+                issuer TEXT NOT NULL,
+                domains INTEGER NOT NULL,
+                PRIMARY KEY (snapshot, issuer)
+            );""")
+        self.conn.commit()
+
+    def has_snapshot(self, name):
+        return self.conn.execute("SELECT 1 FROM snapshots WHERE name = ?", (name,)).fetchone() is not None
+
+    def last_snapshot(self):
+        # (name, output_file) of the latest snapshot, or (None, None)
+        row = self.conn.execute(
+            "SELECT name, output_file FROM snapshots ORDER BY created_at DESC LIMIT 1").fetchone()
+        return row or (None, None)
+
+    def lookup(self, domains):
+        """Return {domain: Record} for the given domains the store knows."""
+        found = {}
+        for start in range(0, len(domains), _LOOKUP_BATCH):
+            batch = domains[start:start + _LOOKUP_BATCH]
+            rows = self.conn.execute(
+                "SELECT domain, fingerprint, issuer, not_after, scanned_at, status FROM certificates "
+                f"WHERE domain IN ({','.join('?' * len(batch))})", batch)
+            for domain, *fields in rows:
+                found[domain] = Record(*fields)
+        return found
+
+    def list_domains(self, snapshot, domains):
+        # Mark the domains as part of this snapshot's input list
+        self.conn.executemany("""
+            INSERT INTO certificates (domain, listed) VALUES (?, ?)
+            ON CONFLICT(domain) DO UPDATE SET listed = excluded.listed""",
+            ((domain, snapshot) for domain in domains))
+
+    def delisted(self, previous):
+        """
+        Domains with a certificate in the 'previous' snapshot that the
+        current input list no longer has; call after list_domains().
+        """
+        if previous is None:
+            return []
+        return self.conn.execute(
+            "SELECT domain, fingerprint, issuer, not_after FROM certificates "
+            "WHERE listed = ? AND status = 'success'", (previous,)).fetchall()
+
+    def record_success(self, domain, fingerprint, issuer, not_after, scanned_at):
+        self.conn.execute("""
+            UPDATE certificates SET fingerprint = ?, issuer = ?, not_after = ?, scanned_at = ?,
+                status = 'success' WHERE domain = ?""",
+            (fingerprint, issuer, not_after, scanned_at, domain))
+
+    def record_failure(self, domain, scanned_at):
+        # The last certificate seen is kept, to tell a comeback from a new domain
+        self.conn.execute("UPDATE certificates SET scanned_at = ?, status = 'failed' WHERE domain = ?",
+                          (scanned_at, domain))
+
+    def finish_snapshot(self, snapshot, output_file, scanned, carried):
+        self.conn.execute("""
+            INSERT INTO issuer_counts (snapshot, issuer, domains)
+            SELECT listed, issuer, COUNT(*) FROM certificates
+            WHERE listed = ? AND status = 'success' AND issuer IS NOT NULL
+            GROUP BY issuer""", (snapshot,))
+        self.conn.execute("INSERT INTO snapshots VALUES (?, ?, ?, ?, ?)",
+                          (snapshot, output_file, time.time(), scanned, carried))
+        self.conn.commit()
+
+    def issuer_history(self):
+        """
+        Return (snapshot, issuer, domains) rows in snapshot order, for
+        following CA concentration over time.
+        """
+        return self.conn.execute("""
+            SELECT snapshots.name, issuer, domains FROM issuer_counts
+            JOIN snapshots ON snapshots.name = issuer_counts.snapshot
+            ORDER BY snapshots.created_at, domains DESC""").fetchall()
+
+    def close(self):
+        # Uncommitted changes of an unfinished snapshot are dropped
+        self.conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+def _timestamp(not_after):
+    # not_after as stored: the str() of the naive UTC datetime of the certificate
+    try:
+        return datetime.datetime.fromisoformat(not_after).replace(tzinfo=datetime.timezone.utc).timestamp()
+    except (TypeError, ValueError):
+        return 0.0
+
+def plan_rescan(domains, known, now, expiry_window, staleness):
+    """
+    Split a snapshot's domains into the ones to rescan, as (reason, domain)
+    in the order they should be scanned, and the ones whose last
+    certificate is carried forward: scanned successfully within
+    'staleness' seconds and not expiring within 'expiry_window' seconds.
+    New domains come first, in input order, then expiring ones by expiry,
+    then previously failed and stale ones, oldest scan first.
+    """
+    due = {reason: [] for reason in PRIORITIES}
+    carried = []
+    for domain in domains:
+        record = known.get(domain)
+        if record is None or record.scanned_at is None:
+            due[NEW].append((0, domain))
+        elif record.status != 'success':
+            due[FAILED].append((record.scanned_at, domain))
+        elif _timestamp(record.not_after) <= now + expiry_window:
+            due[EXPIRING].append((_timestamp(record.not_after), domain))
+        elif record.scanned_at <= now - staleness:
+            due[STALE].append((record.scanned_at, domain))
+        else:
+            carried.append(domain)
+
+    rescan = []
+    for reason in PRIORITIES:
+        due[reason].sort(key=lambda item: item[0])
+        rescan.extend((reason, domain) for _, domain in due[reason])
+    return rescan, carried
+
+def _organization(issuer):
+    # Issuer DNs change with every intermediate rollover; the organization does not
+    fields = split_dn(issuer)
+    return fields.get('O', issuer)
+
+def classify_change(old, leaf):
+    """
+    Compare the stored record of a domain with the leaf details of a new
+    scan: returns NEW, RENEWED, ISSUER_CHANGED, or None if the certificate
+    is the same.
+    """
+    if old is None or old.fingerprint is None:
+        return NEW
+    if old.fingerprint == leaf.get('fingerprint'):
+        return None
+    if _organization(old.issuer) != _organization(leaf.get('issuer')):
+        return ISSUER_CHANGED
+    return RENEWED
+
+def _group_by_domain(rows):
+    chain, current = [], None
+    for row in rows:
+        if row['domain'] != current and chain:
+            yield current, chain
+            chain = []
+        current = row['domain']
+        chain.append(row)
+    if chain:
+        yield current, chain
+
+def _previous_chains(path, domains):
+    # (domain, rows) for the wanted domains in a previous snapshot output;
+    # a domain's rows are written together, in chain order
+    if path.endswith('.parquet'):
+        import pyarrow.compute as pc
+        import pyarrow.dataset as ds
+        table = ds.dataset(path, format='parquet').to_table(filter=pc.field('domain').isin(list(domains)))
+        yield from _group_by_domain(sorted(table.to_pylist(),
+                                           key=lambda row: (row['domain'], row['chain_position'])))
+        return
+    with open(path, mode='r', newline='', encoding='utf-8') as file:
+        yield from _group_by_domain(row for row in csv.DictReader(file) if row['domain'] in domains)
+
+def carry_forward(previous_output, domains, writer):
+    """
+    Copy the rows of 'domains' from the previous snapshot output to
+    'writer'. Both outputs must have the same format. Returns the set of
+    domains that had rows.
+    """
+    found = set()
+    for domain, chain in _previous_chains(previous_output, domains):
+        writer.write(domain, chain)
+        found.add(domain)
+    return found
+
+def read_domains(input_file):
+    """
+    Distinct domains of a top list such as 202406.csv, or of a list
+    filter_csv wrote from one, in order. Prefixes are removed as
+    filter_csv does; the top list's header row (e.g. 'origin,rank') is
+    skipped, filtered lists have none.
+    """
+    with open(input_file, mode='r', newline='', encoding='utf-8') as infile:
+        rows = csv.reader(infile)
+        domains = [remove_prefix(row[0]) for row in rows if row]
+    if domains and '.' not in domains[0]:
+        domains = domains[1:]
+    return list(dict.fromkeys(domains))
+
+async def rescan_snapshot(input_file, output_file, store, snapshot, diff_file, concurrency,
+                          scheduler, resolve, limits, budget, expiry_window, staleness,
+                          metrics_json, metrics_prometheus, nameservers, fast_handshake):
+    now = time.time()
+    domains = read_domains(input_file)
+
+    previous, previous_output = store.last_snapshot()
+    known = store.lookup(domains)
+    store.list_domains(snapshot, domains)
+    rescan, carried = plan_rescan(domains, known, now, expiry_window, staleness)
+    can_carry = bool(previous_output and os.path.exists(previous_output))
+    if carried and not can_carry:
+        # Nothing to copy the unchanged chains from: scan them too
+        print(f"Previous output {previous_output} not found, rescanning {len(carried)} unchanged domains")
+        rescan.extend((STALE, domain) for domain in carried)
+        carried = []
+    if budget is not None and len(rescan) > budget:
+        # Past the budget, domains with a known certificate keep it and
+        # come back at the front of the queue next month. Without a previous
+        # output to copy it from, they are left out of this snapshot
+        deferred = rescan[budget:]
+        rescan = rescan[:budget]
+        if can_carry:
+            carried.extend(domain for _, domain in deferred
+                           if domain in known and known[domain].status == 'success')
+        print(f"Budget of {budget} handshakes: {len(deferred)} rescans deferred"
+              + ("" if can_carry else ", left out of this snapshot"))
+
+    changes = Counter()
+    reasons = Counter(reason for reason, _ in rescan)
+    print(f"Snapshot {snapshot}: {len(domains)} domains, {len(carried)} carried forward, "
+          f"rescanning {len(rescan)} ({', '.join(f'{reason} {reasons[reason]}' for reason in PRIORITIES)})")
+
+    resolver = AsyncResolver(nameservers) if resolve else None
+    metrics = ScanMetrics()
+    with open(diff_file, mode='w', newline='', encoding='utf-8') as difffile, \
+         MetricsReporter(metrics, json_path=metrics_json, prometheus_path=metrics_prometheus), \
+         CertChainWriter(output_file, metrics=metrics) as writer:
+        diff = csv.DictWriter(difffile, fieldnames=DIFF_FIELDNAMES)
+        diff.writeheader()
+
+        def record_change(domain, change, old, leaf):
+            changes[change] += 1
+            diff.writerow({'snapshot': snapshot, 'domain': domain, 'change': change,
+                           'old_issuer': old and old.issuer, 'new_issuer': leaf.get('issuer'),
+                           'old_not_after': old and old.not_after, 'new_not_after': leaf.get('not_after'),
+                           'old_fingerprint': old and old.fingerprint,
+                           'new_fingerprint': leaf.get('fingerprint')})
+
+        for domain, fingerprint, issuer, not_after in store.delisted(previous):
+            record_change(domain, DELISTED, Record(fingerprint, issuer, not_after, None, None), {})
+
+        # Unchanged chains are copied on a thread while the handshakes run
+        carrying = asyncio.ensure_future(
+            asyncio.to_thread(carry_forward, previous_output, set(carried), writer)) if carried else None
+
+        async for result in scan_async.scan_with_retries((domain for _, domain in rescan), scheduler,
+                                                         concurrency, resolver=resolver, limits=limits,
+                                                         metrics=metrics, fast_handshake=fast_handshake):
+            old = known.get(result.domain)
+            metrics.record_result(None if result.error is None else classify_error(result.error))
+            if result.error is not None:
+                store.record_failure(result.domain, time.time())
+                if old is not None and old.status == 'success':
+                    record_change(result.domain, DISAPPEARED, old, {})
+                continue
+
+            writer.write(result.domain, result.cert_chain)
+            leaf = result.cert_chain[0] if result.cert_chain else {}
+            not_after = leaf.get('not_after')
+            store.record_success(result.domain, leaf.get('fingerprint'), leaf.get('issuer'),
+                                 None if not_after is None else str(not_after), time.time())
+            change = classify_change(old, leaf)
+            if change is None:
+                changes['unchanged'] += 1
+            else:
+                record_change(result.domain, change, old, leaf)
+
+        found = await carrying if carrying else set()
+        if len(found) < len(carried):
+            print(f"{len(carried) - len(found)} carried domains had no rows in {previous_output}")
+
+    if resolver is not None:
+        resolver.close()
+    store.finish_snapshot(snapshot, output_file, len(rescan), len(found))
+    print(f"Changes: {', '.join(f'{change} {count}' for change, count in changes.most_common())}")
+    print(f"Attempts by outcome: {scheduler.stats.summary()}")
+
+def incremental_scan(input_file, output_file, store_file, snapshot=None, diff_file=None,
+                     concurrency=1000, budget=None, expiry_days=30, staleness_days=180,
+                     resolve=True, max_attempts=3, scheduler=None, limits=None,
+                     metrics_json=None, metrics_prometheus=None, nameservers=None,
+                     fast_handshake=False):
+    """
+    Produce a full snapshot in 'output_file' for the domains of
+    'input_file' (e.g. 202406.csv, snapshot '202406') while handshaking
+    only the domains that are new, failed last time, have a leaf expiring
+    within 'expiry_days', or were last scanned more than 'staleness_days'
+    ago, at most 'budget' of them. The other domains' chains are copied
+    from the previous snapshot output recorded in 'store_file'.
+
+    Changes against the previous snapshot (new, renewed, issuer_changed,
+    disappeared, delisted) go to 'diff_file', '<output>.diff.csv' by
+    default. An interrupted run is simply run again after removing its
+    output: the store only moves on when a snapshot completes.
+    """
+    snapshot = snapshot or os.path.splitext(os.path.basename(input_file))[0]
+    diff_file = diff_file or os.path.splitext(output_file)[0] + '.diff.csv'
+    if os.path.exists(output_file):
+        raise FileExistsError(f"{output_file} exists; snapshot outputs are written from scratch")
+
+    fd_limit = scan_async.raise_fd_limit()
+    concurrency = min(concurrency, max(fd_limit - 64, 1))
+    if scheduler is None:
+        scheduler = RetryScheduler(max_attempts)
+    if limits is None and resolve:
+        limits = DestinationLimits()
+    start_time = time.time()
+    with CertificateStore(store_file) as store:
+        if store.has_snapshot(snapshot):
+            raise ValueError(f"Snapshot {snapshot} is already in {store_file}")
+        asyncio.run(rescan_snapshot(input_file, output_file, store, snapshot, diff_file, concurrency,
+                                    scheduler, resolve, limits, budget, expiry_days * 86400,
+                                    staleness_days * 86400, metrics_json, metrics_prometheus,
+                                    nameservers, fast_handshake))
+    print(f"Snapshot {snapshot} done in {time.time() - start_time:.1f}s")
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Rescan a monthly domain list, handshaking only domains whose certificate may have changed.')
+    parser.add_argument('input_file')
+    parser.add_argument('output_file')
+    parser.add_argument('store_file', help='SQLite store of the last certificate per domain')
+    parser.add_argument('--snapshot', default=None, help='snapshot name (default: input file name)')
+    parser.add_argument('--diff-file', default=None, help='default: <output>.diff.csv')
+    parser.add_argument('--budget', type=int, default=None, help='at most this many domains are rescanned')
+    parser.add_argument('--expiry-days', type=float, default=30,
+                        help='rescan leaves expiring within this many days')
+    parser.add_argument('--staleness-days', type=float, default=180,
+                        help='rescan domains last scanned longer ago than this')
+    parser.add_argument('--concurrency', type=int, default=1000)
+    parser.add_argument('--max-attempts', type=int, default=3)
+    parser.add_argument('--no-resolve', action='store_true', help='let the OS resolver look names up')
+    parser.add_argument('--metrics-json', default=None)
+    parser.add_argument('--fast-handshake', action='store_true',
+                        help='negotiate TLS 1.2 or 1.3 and reset each connection once the chain is in')
+    args = parser.parse_args()
+
+    incremental_scan(args.input_file, args.output_file, args.store_file, args.snapshot, args.diff_file,
+                     args.concurrency, args.budget, args.expiry_days, args.staleness_days,
+                     resolve=not args.no_resolve, max_attempts=args.max_attempts,
+                     metrics_json=args.metrics_json, fast_handshake=args.fast_handshake)
+
+if __name__ == '__main__':
+    main()
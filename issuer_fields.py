@@ -0,0 +1,86 @@
+import numpy as np
+import pandas as pd
+import pycountry
+
+# ISO 3166 lookups, built once instead of asking pycountry for every row
+ALPHA2_TO_ALPHA3 = {country.alpha_2: country.alpha_3 for country in pycountry.countries}
+ALPHA2_TO_NAME = {country.alpha_2: country.name for country in pycountry.countries}
+
+def _unescape(value):
+    # Undo RFC 4514 escaping: '\,' style pairs and '\xx' hex pairs
+    if '\\' not in value:
+        return value
+    out = bytearray()
+    i = 0
+    while i < len(value):
+        char = value[i]
+        if char == '\\' and i + 1 < len(value):
+            pair = value[i + 1:i + 3]
+            if len(pair) == 2 and all(c in '0123456789abcdefABCDEF' for c in pair):
+                out.append(int(pair, 16))
+                i += 3
+                continue
+            out.extend(value[i + 1].encode())
+            i += 2
+            continue
+        out.extend(char.encode())
+        i += 1
+    return out.decode('utf-8', errors='replace')
+
+def split_dn(dn):
+    """
+    Split an RFC 4514 distinguished name into {attribute: value}, honouring
+    escaped separators. The first occurrence of an attribute wins.
+    """
+    fields = {}
+    if not isinstance(dn, str):
+        return fields
+
+    start = 0
+    escaped = False
+    for i, char in enumerate(dn + ','):
+        if escaped:
+            escaped = False
+        elif char == '\\':
+            escaped = True
+        elif char in ',+':
+            attribute, sep, value = dn[start:i].partition('=')
+            attribute = attribute.strip()
+            if sep and attribute not in fields:
+                fields[attribute] = _unescape(value.strip())
+            start = i + 1
+    return fields
+
+def _remap(codes, values, index, name=None):
+    # 'values' holds one result per category; spread them over the rows by code.
+    # Code -1 (missing input) picks the trailing -1, i.e. stays missing
+    value_codes, uniques = pd.factorize(pd.Series(values, dtype=object))
+    row_codes = np.append(value_codes, -1)[codes]
+    return pd.Series(pd.Categorical.from_codes(row_codes, categories=uniques),
+                     index=index, name=name)
+
+def map_categories(series, func):
+    """
+    Apply 'func' to each distinct value of 'series' only and map the
+    results back to every row through category codes. Returns a
+    categorical Series; None results become NaN.
+    """
+    categorical = series.astype('category').cat.remove_unused_categories()
+    values = [func(value) for value in categorical.cat.categories]
+    return _remap(categorical.cat.codes.to_numpy(), values, series.index, series.name)
+
+def parse_issuers(issuers, attributes=('C', 'O', 'CN')):
+    """
+    Split an issuer column into one categorical column per DN attribute.
+    Each distinct issuer string is parsed once.
+    """
+    categorical = issuers.astype('category').cat.remove_unused_categories()
+    parsed = [split_dn(dn) for dn in categorical.cat.categories]
+    codes = categorical.cat.codes.to_numpy()
+    return pd.DataFrame({attribute: _remap(codes, [fields.get(attribute) for fields in parsed],
+                                           issuers.index)
+                         for attribute in attributes}, index=issuers.index)
+
+def alpha_2_to_alpha_3(alpha_2):
+    # Vectorized over a Series of alpha-2 codes: only the categories are looked up
+    return map_categories(alpha_2, lambda code: ALPHA2_TO_ALPHA3.get(str(code).upper()))
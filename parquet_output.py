@@ -0,0 +1,112 @@
+import os
+import re
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+# 'issuer' repeats a few hundred values across millions of rows, so it is
+# dictionary-encoded and loads as a pandas categorical. Serial numbers are
+# up to 20 bytes and do not fit in int64.
+SCHEMA = pa.schema([
+    ("domain", pa.string()),
+    ("chain_position", pa.int16()),
+    ("subject", pa.string()),
+    ("issuer", pa.dictionary(pa.int32(), pa.string())),
+    ("version", pa.dictionary(pa.int8(), pa.string())),
+    ("serial_number", pa.string()),
+    ("not_before", pa.timestamp('s')),
+    ("not_after", pa.timestamp('s')),
+])
+
+# Finished parts; a part being written has a hidden temporary name, which
+# pyarrow's dataset discovery skips like any name starting with '.'
+PART_NAME = re.compile(r'part-(\d+)\.parquet$')
+
+class ParquetSink:
+    """
+    Writes scan rows into a directory of Parquet part files. Rows are
+    buffered into row groups of 'row_group_size' and a new part is started
+    every 'rows_per_part' rows. A part is written as '.part-NNNNN.parquet.tmp'
+    and renamed to 'part-NNNNN.parquet' when closed, so readers of the
+    directory only see whole parts and a crash loses at most the part
+    being written, whose leftover is removed on the next open. flush() and
+    close() therefore only return the domains whose rows are in closed
+    parts.
+    """
+    def __init__(self, path, row_group_size=65536, rows_per_part=1000000, compression='zstd'):
+        self.path = path
+        self.row_group_size = row_group_size
+        self.rows_per_part = rows_per_part
+        self.compression = compression
+        self._buffer = []
+        self._pending = []
+        self._done = []
+        self._writer = None
+        self._part_rows = 0
+        os.makedirs(path, exist_ok=True)
+        # Appending to an existing dataset starts after its highest part
+        parts = [-1]
+        for name in os.listdir(path):
+            match = PART_NAME.match(name)
+            if match:
+                parts.append(int(match.group(1)))
+            elif name.startswith('.part-') and name.endswith('.parquet.tmp'):
+                os.remove(os.path.join(path, name))
+        self._next_part = max(parts) + 1
+        self._filename = None
+
+    def _open_part(self):
+        self._filename = os.path.join(self.path, f'part-{self._next_part:05d}.parquet')
+        self._next_part += 1
+        self._part_rows = 0
+        self._writer = pq.ParquetWriter(self._temporary(self._filename), SCHEMA, compression=self.compression)
+
+    @staticmethod
+    def _temporary(filename):
+        directory, name = os.path.split(filename)
+        return os.path.join(directory, f'.{name}.tmp')
+
+    def _write_row_group(self, rows):
+        columns = {name: [row.get(name) for row in rows] for name in SCHEMA.names}
+        columns["serial_number"] = [None if serial is None else str(serial)
+                                    for serial in columns["serial_number"]]
+        if self._writer is None:
+            self._open_part()
+        self._writer.write_table(pa.Table.from_pydict(columns, schema=SCHEMA))
+        self._part_rows += len(rows)
+        if self._part_rows >= self.rows_per_part:
+            self._close_part()
+
+    def _close_part(self):
+        self._writer.close()
+        self._writer = None
+        os.replace(self._temporary(self._filename), self._filename)
+        self._done.extend(self._pending)
+        self._pending = []
+
+    def write_rows(self, rows):
+        self._buffer.extend(rows)
+        while len(self._buffer) >= self.row_group_size:
+            self._write_row_group(self._buffer[:self.row_group_size])
+            del self._buffer[:self.row_group_size]
+
+    def flush(self, domains):
+        # Row groups are written as they fill up; partial ones wait for close().
+        # Domains are held back until the part with their rows is closed
+        self._pending.extend(domains)
+        if self._writer is None and not self._buffer:
+            # Every row so far is in a closed part, e.g. domains without rows
+            self._done.extend(self._pending)
+            self._pending = []
+        done, self._done = self._done, []
+        return done
+
+    def close(self):
+        if self._buffer:
+            self._write_row_group(self._buffer)
+            self._buffer = []
+        if self._writer is not None:
+            self._close_part()
+        done = self._done + self._pending
+        self._done = []
+        self._pending = []
+        return done
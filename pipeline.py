@@ -0,0 +1,249 @@
+import argparse
+import asyncio
+import csv
+import os
+import queue
+import threading
+import time
+from contextlib import ExitStack
+import pandas as pd
+import analyze_certificates as analysis
+import constants
+import scan_async
+from cert_writer import CertChainWriter
+from der_archive import DerArchive
+from destination_limits import DestinationLimits
+from dns_resolver import AsyncResolver
+from filter_csv import remove_prefix
+from scan_errors import classify_error
+from scan_metrics import MetricsReporter, ScanMetrics, write_atomic
+from scan_scheduler import RetryScheduler
+from suffix_classifier import SuffixClassifier
+
+# Marker put on the aggregator queue to make its thread finish
+_CLOSE = object()
+
+def filter_domains(input_file, suffixes, filtered_file=None):
+    """
+    Filter stage: yield the domains of a top list that end with one of
+    'suffixes', with their prefix removed as filter_csv does, each domain
+    once. Lines are read only as the scanner asks for more domains. With
+    'filtered_file', the selected rows are also written there.
+    """
+    classifier = SuffixClassifier({'selected': suffixes})
+    seen = set()
+    with ExitStack() as stack:
+        infile = stack.enter_context(open(input_file, mode='r', newline='', encoding='utf-8'))
+        writer = None
+        if filtered_file:
+            writer = csv.writer(stack.enter_context(open(filtered_file, mode='w', newline='', encoding='utf-8')))
+        # Skip the header line, like filter_csv
+        infile.readline()
+        for row in csv.reader(infile):
+            if not row:
+                continue
+            domain = remove_prefix(row[0])
+            if domain in seen or not classifier.matches(domain):
+                continue
+            seen.add(domain)
+            if writer is not None:
+                writer.writerow([domain] + row[1:])
+            yield domain
+
+class CountsAggregator:
+    """
+    Aggregation stage: leaf certificates are queued with put() and folded
+    into an analyze_certificates.aggregate_counts() table on a thread,
+    'batch_size' rows at a time, so the counts are current while the scan
+    runs. The queue holds at most 'maxsize' rows; when it is full, put()
+    waits, which slows the scanner down instead of growing memory.
+
+    Every 'interval' seconds the top issuers so far are printed and, with
+    'counts_file', the counts are written there.
+    """
+    def __init__(self, suffixes, batch_size=5000, maxsize=50000, interval=5.0, counts_file=None):
+        self.suffixes = suffixes
+        self.batch_size = batch_size
+        self.interval = interval
+        self.counts_file = counts_file
+        self.counts = None
+        self.rows = 0
+        self.busy_seconds = 0.0
+        self._lock = threading.Lock()
+        self._queue = queue.Queue(maxsize)
+        self._error = None
+        self._thread = threading.Thread(target=self._run, name='aggregator', daemon=True)
+        self._thread.start()
+
+    async def put(self, domain, leaf):
+        row = {'domain': domain, 'issuer': leaf.get('issuer'),
+               'not_before': leaf.get('not_before'), 'not_after': leaf.get('not_after')}
+        try:
+            self._queue.put_nowait(row)
+        except queue.Full:
+            # Wait for room off the event loop, so handshakes keep going
+            await asyncio.to_thread(self._queue.put, row)
+
+    def close(self):
+        self._queue.put(_CLOSE)
+        self._thread.join()
+        self._report()
+        if self._error is not None:
+            raise self._error
+        return self.snapshot()
+
+    def snapshot(self):
+        with self._lock:
+            if self.counts is None:
+                return pd.DataFrame(columns=['suffix', 'company', 'country', 'expiration_group', 'count'])
+            return self.counts.copy()
+
+    def _fold(self, rows):
+        start = time.perf_counter()
+        df = analysis.prepare_certificates(pd.DataFrame(rows), self.suffixes)
+        # Only this thread replaces self.counts, so it can read it unlocked
+        counts = analysis.merge_counts(self.counts, analysis.aggregate_counts(df))
+        with self._lock:
+            self.counts = counts
+            self.rows += len(rows)
+        self.busy_seconds += time.perf_counter() - start
+
+    def _report(self):
+        counts = self.snapshot()
+        top = analysis.counts_by(counts, 'company').head(3) if len(counts) else pd.Series(dtype='int64')
+        total = int(counts['count'].sum()) if len(counts) else 0
+        print(f"Aggregated {self.rows} leaf certificates, {total} counted; top issuers: "
+              + ', '.join(f'{company} {count / max(total, 1):.0%}' for company, count in top.items()),
+              flush=True)
+        if self.counts_file:
+            write_atomic(self.counts_file, counts.to_csv(index=False))
+
+    def _run(self):
+        rows = []
+        deadline = time.monotonic() + self.interval
+        while True:
+            try:
+                item = self._queue.get(timeout=max(deadline - time.monotonic(), 0))
+            except queue.Empty:
+                item = None
+            if item is _CLOSE:
+                break
+            if item is not None:
+                rows.append(item)
+
+            due = time.monotonic() >= deadline
+            if rows and (len(rows) >= self.batch_size or due) and self._error is None:
+                try:
+                    self._fold(rows)
+                except Exception as e:
+                    # Keep draining so the scan never blocks; raised by close()
+                    self._error = e
+                rows = []
+            if due:
+                if self._error is None:
+                    self._report()
+                deadline = time.monotonic() + self.interval
+
+        if rows and self._error is None:
+            try:
+                self._fold(rows)
+            except Exception as e:
+                self._error = e
+
+async def run_pipeline(domains, aggregator, writer, scheduler, concurrency, resolve, nameservers, limits,
+                       metrics, fast_handshake):
+    # Scan stage: pulls domains from the filter and pushes results downstream
+    resolver = AsyncResolver(nameservers) if resolve else None
+    scanned = 0
+    async for result in scan_async.scan_with_retries(domains, scheduler, concurrency, resolver=resolver,
+                                                     limits=limits, metrics=metrics,
+                                                     fast_handshake=fast_handshake):
+        scanned += 1
+        metrics.record_result(None if result.error is None else classify_error(result.error))
+        if result.error is not None or not result.cert_chain:
+            continue
+        if writer is not None:
+            writer.write(result.domain, result.cert_chain)
+        await aggregator.put(result.domain, result.cert_chain[0])
+    if resolver is not None:
+        resolver.close()
+    return scanned
+
+def process_top_list(input_file, region, filtered_file=None, certificates_file=None, archive_dir=None,
+                     counts_file=None, figures_dir=None, concurrency=1000, resolve=True, max_attempts=3,
+                     scheduler=None, limits=None, fast_handshake=False, metrics_json=None,
+                     progress_interval=5.0, nameservers=None):
+    """
+    Filter a top list to one region, scan the selected domains and count
+    their leaf certificates in a single streaming run: the stages are
+    connected by bounded streams and run at the same time, so the first
+    counts are out within seconds and the run takes about as long as the
+    scan alone. Each stage's output is only written to disk if a path is
+    given for it; figures are rendered from the final counts.
+    """
+    suffixes = constants.regions[region]
+    fd_limit = scan_async.raise_fd_limit()
+    concurrency = min(concurrency, max(fd_limit - 64, 1))
+    if scheduler is None:
+        scheduler = RetryScheduler(max_attempts)
+    if limits is None and resolve:
+        limits = DestinationLimits()
+    metrics = ScanMetrics()
+    start_time = time.time()
+
+    with ExitStack() as stack:
+        archive = stack.enter_context(DerArchive(archive_dir)) if archive_dir else None
+        stack.enter_context(MetricsReporter(metrics, progress_interval, metrics_json))
+        writer = None
+        if certificates_file:
+            writer = stack.enter_context(CertChainWriter(certificates_file, metrics=metrics, archive=archive))
+        aggregator = CountsAggregator(suffixes, interval=progress_interval, counts_file=counts_file)
+        try:
+            domains = filter_domains(input_file, suffixes, filtered_file)
+            scanned = asyncio.run(run_pipeline(domains, aggregator, writer, scheduler, concurrency, resolve,
+                                               nameservers, limits, metrics, fast_handshake))
+        finally:
+            counts = aggregator.close()
+
+    elapsed = time.time() - start_time
+    print(f"Scanned {scanned} {region} domains in {elapsed:.1f}s ({scanned / max(elapsed, 1e-9):.1f} domains/sec); "
+          f"aggregation busy {aggregator.busy_seconds:.1f}s of it")
+    print(f"Attempts by outcome: {scheduler.stats.summary()}")
+
+    if figures_dir:
+        import report
+        os.makedirs(figures_dir, exist_ok=True)
+        for plot, args, output_file in report.figure_tasks(region, counts, figures_dir):
+            plot(*args, output_file=output_file)
+            print(f'Wrote {output_file}')
+    return counts
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Filter a top list, scan it and aggregate the certificates in one streaming run.')
+    parser.add_argument('input_file', help='top list CSV, e.g. ./csv/202406.csv')
+    parser.add_argument('--region', required=True, choices=sorted(constants.regions))
+    parser.add_argument('--filtered-output', default=None, help='also write the filtered domains here')
+    parser.add_argument('--certificates-output', default=None,
+                        help='also write the scanned chains here (.csv or .parquet)')
+    parser.add_argument('--archive-dir', default=None, help='also archive the raw DER chains here')
+    parser.add_argument('--counts-output', default=None,
+                        help='keep the aggregate counts so far in this CSV, rewritten as the scan goes')
+    parser.add_argument('--figures-dir', default=None, help='render the region figures here at the end')
+    parser.add_argument('--concurrency', type=int, default=1000)
+    parser.add_argument('--max-attempts', type=int, default=3)
+    parser.add_argument('--no-resolve', action='store_true', help='let the OS resolver look names up')
+    parser.add_argument('--fast-handshake', action='store_true',
+                        help='negotiate TLS 1.2 or 1.3 and reset each connection once the chain is in')
+    parser.add_argument('--metrics-json', default=None)
+    parser.add_argument('--progress-interval', type=float, default=5.0)
+    args = parser.parse_args()
+
+    process_top_list(args.input_file, args.region, args.filtered_output, args.certificates_output,
+                     args.archive_dir, args.counts_output, args.figures_dir, args.concurrency,
+                     resolve=not args.no_resolve, max_attempts=args.max_attempts,
+                     fast_handshake=args.fast_handshake, metrics_json=args.metrics_json,
+                     progress_interval=args.progress_interval)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,112 @@
+import argparse
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+import matplotlib
+matplotlib.use('Agg')  # Headless: must be chosen before pyplot is imported
+import pandas as pd
+import analyze_certificates as analysis
+import concentration
+import constants
+from aggregate_cube import load_cube, region_counts
+
+# Concentration metrics drawn, one figure per issuer dimension each
+FIGURE_METRICS = ['hhi', 'top4_share']
+
+# Scan output analysed for each region by default
+DATASETS = {
+    'eu': './csv/eu_certificates.csv',
+    'brics': './csv/brics_certificates.csv',
+}
+
+def _render(plot, args, output_file):
+    # Runs in a worker process
+    plot(*args, output_file=output_file)
+    return output_file
+
+def figure_tasks(region, counts, figures_dir, table=None):
+    """
+    List the (plot function, args, output file) of every figure for one
+    region, built from its aggregate_counts() table only. 'table' is its
+    concentration_table(), computed here if not given.
+    """
+    if table is None:
+        table = concentration.concentration_table(counts, region)
+    tasks = [
+        (analysis.plot_company_counts,
+         (analysis.counts_by(counts, 'company'), f"Top 5 Companies Overall ({region.upper()})"),
+         os.path.join(figures_dir, f'companies_overall_{region}.png')),
+        (analysis.plot_expiration_counts,
+         (analysis.counts_by(counts, 'expiration_group'),
+          f"Overall Certificate Expiration Distribution ({region.upper()})"),
+         os.path.join(figures_dir, f'{region}_expiration.png')),
+    ]
+    for suffix in sorted(counts['suffix'].dropna().unique()):
+        name = suffix.lstrip('.')
+        tasks.append((analysis.plot_company_counts,
+                      (analysis.counts_by(counts, 'company', suffix), f"Top 5 Companies for {suffix} Suffix"),
+                      os.path.join(figures_dir, f'companies_{name}.png')))
+        tasks.append((analysis.plot_expiration_counts,
+                      (analysis.counts_by(counts, 'expiration_group', suffix),
+                       f"Certificate Expiration Distribution for {suffix} Domains"),
+                      os.path.join(figures_dir, f'expiration_{name}.png')))
+    for dimension in concentration.DIMENSIONS:
+        for metric in FIGURE_METRICS:
+            tasks.append((concentration.plot_concentration,
+                          (table, dimension, metric, f"Issuer {dimension} {metric} by suffix ({region.upper()})"),
+                          os.path.join(figures_dir, f'concentration_{metric}_{dimension}_{region}.png')))
+    return tasks
+
+def generate_report(datasets=None, figures_dir='./figures', workers=None, metrics_file=None,
+                    resamples=1000):
+    """
+    Render every figure for every region without a display. Each dataset's
+    aggregate cube is loaded (and updated) once; figures are drawn on the
+    Agg backend in worker processes while the next dataset is being loaded.
+    The concentration metrics behind the figures are also written to
+    'metrics_file' if given.
+    """
+    if datasets is None:
+        datasets = DATASETS
+    os.makedirs(figures_dir, exist_ok=True)
+    start_time = time.time()
+
+    tables = []
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = []
+        for region, filename in datasets.items():
+            # The cube only reads rows appended since the last report
+            counts = region_counts(load_cube(filename), constants.regions[region])
+            table = concentration.concentration_table(counts, region, resamples)
+            tables.append(table)
+
+            for plot, args, output_file in figure_tasks(region, counts, figures_dir, table):
+                futures.append(executor.submit(_render, plot, args, output_file))
+
+        for future in futures:
+            print(f'Wrote {future.result()}')
+
+    if metrics_file and tables:
+        pd.concat(tables, ignore_index=True).to_csv(metrics_file, index=False)
+        print(f'Wrote {metrics_file}')
+
+    print(f'Rendered {len(futures)} figures in {time.time() - start_time:.1f}s')
+
+def main():
+    parser = argparse.ArgumentParser(description='Render all certificate figures to files.')
+    parser.add_argument('datasets', nargs='*', metavar='REGION=FILE',
+                        help='scan output per region (default: the eu and brics outputs in ./csv)')
+    parser.add_argument('--figures-dir', default='./figures')
+    parser.add_argument('--workers', type=int, default=None,
+                        help='rendering processes (default: one per CPU)')
+    parser.add_argument('--metrics-output', default='./csv/concentration.csv',
+                        help='concentration metrics table (CSV)')
+    parser.add_argument('--resamples', type=int, default=1000,
+                        help='bootstrap resamples per concentration interval')
+    args = parser.parse_args()
+
+    datasets = dict(dataset.split('=', 1) for dataset in args.datasets) or None
+    generate_report(datasets, args.figures_dir, args.workers, args.metrics_output, args.resamples)
+
+if __name__ == '__main__':
+    main()
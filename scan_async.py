@@ -0,0 +1,328 @@
+import asyncio
+import csv
+import resource
+import time
+from collections import namedtuple
+from OpenSSL import SSL
+from cert_cache import CertDetailsCache
+from cert_writer import CertChainWriter
+from der_archive import DerArchive
+from destination_limits import DestinationLimits, DestinationQueue
+from dns_resolver import AsyncResolver
+from handshake import chain_received, create_context, reset_on_close
+from scan_errors import ConnectTimeout, HandshakeTimeout, classify_error
+from scan_metrics import CONNECT, DNS, HANDSHAKE, PARSE, MetricsReporter, ScanMetrics
+from scan_scheduler import RetryScheduler
+from scan_state import ScanState
+from fetch_cert_chain_multi import extract_certificate_details
+
+# Result of scanning a single domain; 'error' is None on success and
+# 'elapsed' is the seconds spent on the attempt
+ScanResult = namedtuple('ScanResult', ['domain', 'cert_chain', 'error', 'elapsed'], defaults=(None,))
+
+# Shared by every scan in this process
+cert_cache = CertDetailsCache(extract_certificate_details)
+
+def raise_fd_limit():
+    """
+    Raise the soft limit on open file descriptors to the hard limit,
+    since every in-flight handshake holds one socket.
+    """
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    target = 65536 if hard == resource.RLIM_INFINITY else hard
+    if soft != resource.RLIM_INFINITY and soft < target:
+        try:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (target, hard))
+        except (ValueError, OSError):
+            return soft
+    return target
+
+def _flush_outgoing(ssl_conn, writer):
+    # Move every pending TLS record from the memory BIO to the socket
+    while True:
+        try:
+            data = ssl_conn.bio_read(65536)
+        except SSL.WantReadError:
+            return
+        if not data:
+            return
+        writer.write(data)
+
+async def _do_handshake(ssl_conn, reader, writer, fast=False):
+    # Drive the handshake over the memory BIO: OpenSSL never touches the
+    # socket, we shuttle bytes between it and the asyncio stream ourselves
+    while True:
+        try:
+            ssl_conn.do_handshake()
+            done = True
+        except SSL.WantReadError:
+            # The chain is all a fast handshake waits for; whatever the
+            # client would send next stays in the BIO
+            if fast and chain_received(ssl_conn):
+                return
+            done = False
+
+        _flush_outgoing(ssl_conn, writer)
+        await writer.drain()
+        if done:
+            return
+
+        data = await reader.read(65536)
+        if not data:
+            raise ConnectionResetError("Connection closed during SSL handshake")
+        ssl_conn.bio_write(data)
+
+async def fetch_ssl_certificate_chain(hostname, context, port=443, address=None, timeout=None,
+                                      metrics=None, fast=False):
+    # 'address' is the pre-resolved IP; SNI still carries the hostname.
+    # 'timeout' covers connect and handshake together; which of the two ran
+    # out of time is told apart by the exception raised. With 'metrics',
+    # the phases that complete are timed. 'fast' stops the handshake once
+    # the chain is in and resets the connection instead of closing it
+    loop = asyncio.get_running_loop()
+    deadline = None if timeout is None else loop.time() + timeout
+    start = time.perf_counter()
+    try:
+        reader, writer = await asyncio.wait_for(asyncio.open_connection(address or hostname, port), timeout)
+    except asyncio.TimeoutError:
+        raise ConnectTimeout(f"TCP connect to {hostname} timed out") from None
+    if metrics is not None:
+        connected = time.perf_counter()
+        metrics.observe(CONNECT, connected - start)
+    try:
+        # A connection without a socket uses a pair of memory BIOs
+        ssl_conn = SSL.Connection(context, None)
+        ssl_conn.set_connect_state()
+        ssl_conn.set_tlsext_host_name(hostname.encode())
+
+        try:
+            await asyncio.wait_for(_do_handshake(ssl_conn, reader, writer, fast),
+                                   None if deadline is None else max(deadline - loop.time(), 0))
+        except asyncio.TimeoutError:
+            raise HandshakeTimeout("SSL handshake timed out") from None
+        if metrics is not None:
+            handshaken = time.perf_counter()
+            metrics.observe(HANDSHAKE, handshaken - connected)
+
+        # Retrieve the entire certificate chain
+        cert_chain = ssl_conn.get_peer_cert_chain() or []
+
+        # Intermediates are looked up by fingerprint instead of being parsed again
+        cert_details = cert_cache.chain_details(cert_chain)
+        if metrics is not None:
+            metrics.observe(PARSE, time.perf_counter() - handshaken)
+        return cert_details
+    finally:
+        if fast:
+            reset_on_close(writer.get_extra_info('socket'))
+            writer.transport.abort()
+        else:
+            writer.close()
+
+async def scan_domains(domains, concurrency=1000, timeout=30, port=443,
+                       resolver=None, dns_concurrency=None, limits=None, metrics=None,
+                       fast_handshake=False):
+    """
+    Scan an iterable of domains, keeping at most 'concurrency' handshakes
+    in flight, and yield a ScanResult for each one as soon as it finishes.
+    Results are yielded in completion order, not input order. 'timeout'
+    is a number of seconds or a callable returning one, read per domain.
+
+    With a resolver, names are resolved by a separate stage of
+    'dns_concurrency' tasks and only resolved addresses reach the
+    handshake workers; unresolvable domains are reported straight away.
+    Resolved domains are handed to the workers round-robin by destination
+    address under 'limits' (DestinationLimits), so a few CDN edges cannot
+    take every handshake slot. 'metrics' (ScanMetrics) gets phase
+    timings and the number of handshakes in flight.
+
+    With 'fast_handshake', TLS 1.3 is negotiated too and each connection
+    is reset as soon as the peer chain has arrived (see handshake.py).
+    The event loop is the only worker, so one context serves every
+    connection of the scan.
+    """
+    context = create_context(fast_handshake)
+    loop = asyncio.get_running_loop()
+    domains = iter(domains)
+    if dns_concurrency is None:
+        dns_concurrency = concurrency if resolver is not None else 1
+    if limits is None:
+        limits = DestinationLimits(per_destination=None, lookahead=1)
+    resolved = DestinationQueue(limits, maxsize=concurrency * limits.lookahead)
+    results = asyncio.Queue(maxsize=concurrency)
+    done = object()
+
+    async def resolve_worker():
+        # All workers pull from the same iterator, so domains are read lazily
+        for domain in domains:
+            if resolver is None:
+                await resolved.put((domain, None), None)
+                continue
+            start = loop.time()
+            try:
+                addresses = await resolver.resolve(domain)
+            except Exception as e:
+                await results.put(ScanResult(domain, [], e, loop.time() - start))
+                continue
+            if metrics is not None:
+                metrics.observe(DNS, loop.time() - start)
+            await resolved.put((domain, addresses[0]), addresses[0])
+
+    async def handshake_worker():
+        while True:
+            item = await resolved.get()
+            if item is None:
+                return
+            (domain, address), destination = item
+            limit = timeout() if callable(timeout) else timeout
+            start = loop.time()
+            if metrics is not None:
+                metrics.started()
+            try:
+                cert_chain = await fetch_ssl_certificate_chain(domain, context, port, address, limit,
+                                                               metrics, fast_handshake)
+                result = ScanResult(domain, cert_chain, None, loop.time() - start)
+            except Exception as e:
+                result = ScanResult(domain, [], e, loop.time() - start)
+            finally:
+                if metrics is not None:
+                    metrics.finished()
+                await resolved.release(destination)
+            await results.put(result)
+
+    async def run_resolvers():
+        await asyncio.gather(*(resolve_worker() for _ in range(dns_concurrency)))
+        await resolved.close()
+
+    async def run_workers():
+        workers = [asyncio.ensure_future(run_resolvers())]
+        workers.extend(asyncio.ensure_future(handshake_worker()) for _ in range(concurrency))
+        cancelled = False
+        try:
+            await asyncio.gather(*workers)
+        except asyncio.CancelledError:
+            # The consumer stopped reading, nobody waits for 'done'
+            cancelled = True
+            raise
+        finally:
+            # Also when a worker failed outside its per-domain try, e.g. reading
+            # the domains: stop the others and let the consumer raise the error
+            for worker in workers:
+                worker.cancel()
+            if not cancelled:
+                await results.put(done)
+
+    runner = asyncio.ensure_future(run_workers())
+    try:
+        while True:
+            result = await results.get()
+            if result is done:
+                break
+            yield result
+        await runner
+    finally:
+        runner.cancel()
+
+async def scan_with_retries(domains, scheduler, concurrency=1000, port=443,
+                            resolver=None, dns_concurrency=None, limits=None, metrics=None,
+                            fast_handshake=False):
+    """
+    scan_domains() under a RetryScheduler: a first pass over every domain
+    with the scheduler's short timeout, then retry rounds for the domains it
+    queued. Only final results are yielded, one per domain.
+    """
+    async for result in scan_domains(domains, concurrency, scheduler.first_timeout, port,
+                                     resolver, dns_concurrency, limits, metrics, fast_handshake):
+        if scheduler.record(result.domain, result.error, result.elapsed):
+            yield result
+
+    while True:
+        retry = scheduler.next_round()
+        if retry is None:
+            return
+        delay, timeout, retry_domains = retry
+        await asyncio.sleep(delay)
+        async for result in scan_domains(retry_domains, concurrency, timeout, port,
+                                         resolver, dns_concurrency, limits, metrics, fast_handshake):
+            if scheduler.record(result.domain, result.error, result.elapsed):
+                yield result
+
+async def scan_csv(input_file, output_file, concurrency=1000, scheduler=None,
+                   flush_size=1000, flush_interval=1.0, resolve=True,
+                   state_file=None, max_attempts=3, limits=None, metrics_json=None,
+                   metrics_prometheus=None, progress_interval=10.0, nameservers=None,
+                   archive_dir=None, fast_handshake=False):
+    scanned = 0
+    start_time = time.time()
+    if scheduler is None:
+        scheduler = RetryScheduler()
+    resolver = AsyncResolver(nameservers) if resolve else None
+    # Successes are recorded by the writer once their rows are on disk
+    state = ScanState(state_file) if state_file else None
+    on_flush = state.record_successes if state else None
+    metrics = ScanMetrics()
+    archive = DerArchive(archive_dir) if archive_dir else None
+
+    # The reporter is stopped last, so its final report includes the last write
+    with open(input_file, mode='r', newline='', encoding='utf-8') as infile, \
+         MetricsReporter(metrics, progress_interval, metrics_json, metrics_prometheus), \
+         CertChainWriter(output_file, flush_size, flush_interval, on_flush=on_flush,
+                         metrics=metrics, archive=archive) as writer:
+        domains = (row[0] for row in csv.reader(infile))
+        if state:
+            domains = state.pending(domains, max_attempts)
+
+        async for result in scan_with_retries(domains, scheduler, concurrency, resolver=resolver,
+                                              limits=limits, metrics=metrics,
+                                              fast_handshake=fast_handshake):
+            scanned += 1
+            metrics.record_result(None if result.error is None else classify_error(result.error))
+            if result.error is not None:
+                print(f"An error occurred for hostname {result.domain}: {result.error}")
+                if state:
+                    state.record_failure(result.domain, result.error)
+            else:
+                # The writer thread does the disk I/O, the event loop never waits on it
+                writer.write(result.domain, result.cert_chain)
+
+    elapsed = time.time() - start_time
+    print(f"Scanned {scanned} domains in {elapsed:.1f}s ({scanned / max(elapsed, 1e-9):.1f} domains/sec)")
+    print(f"Attempts by outcome: {scheduler.stats.summary()}")
+    if resolver is not None:
+        resolver.close()
+        print(f"DNS cache: {resolver.hits} hits, {resolver.misses} misses ({resolver.hit_rate:.1%} hit rate)")
+    print(f"Certificate cache: {cert_cache.hits} hits, {cert_cache.misses} misses ({cert_cache.hit_rate:.1%} hit rate)")
+    if archive is not None:
+        archive.close()
+        print(f"DER archive: {archive.chains_added} chains, {archive.certificates_added} new certificates")
+    if state:
+        print(f"Skipped {state.skipped} domains already done or given up in {state_file}; delete it to scan them again")
+        state.close()
+
+def process_domains_from_csv(input_file, output_file, concurrency=1000, resolve=True,
+                             state_file=None, max_attempts=3, scheduler=None, limits=None,
+                             metrics_json=None, metrics_prometheus=None, nameservers=None,
+                             archive_dir=None, fast_handshake=False):
+    # Thousands of concurrent sockets need more than the default 1024 descriptors
+    fd_limit = raise_fd_limit()
+    concurrency = min(concurrency, max(fd_limit - 64, 1))
+    # 'max_attempts' limits attempts within this run; the state file counts runs
+    if scheduler is None:
+        scheduler = RetryScheduler(max_attempts)
+    # Top lists put many domains behind the same CDN edge; without a
+    # resolver there are no addresses to group by
+    if limits is None and resolve:
+        limits = DestinationLimits()
+    asyncio.run(scan_csv(input_file, output_file, concurrency, scheduler, resolve=resolve,
+                         state_file=state_file, max_attempts=max_attempts, limits=limits,
+                         metrics_json=metrics_json, metrics_prometheus=metrics_prometheus,
+                         nameservers=nameservers, archive_dir=archive_dir,
+                         fast_handshake=fast_handshake))
+
+if __name__ == "__main__":
+    input_csv_file = './csv/world.csv'  # Replace with your input CSV file path
+    output_csv_file = './csv/world_certificates.csv'  # Replace with your output CSV file path
+    state_file = './csv/world_scan_state.db'  # Delete to start the scan from scratch
+    process_domains_from_csv(input_csv_file, output_csv_file, concurrency=2000, state_file=state_file,
+                             metrics_json='./csv/world_scan_metrics.json',
+                             archive_dir='./csv/world_der_archive')
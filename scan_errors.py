@@ -0,0 +1,64 @@
+import asyncio
+import errno
+import socket
+import ssl
+from OpenSSL import SSL
+from dns_resolver import DNSError, RCODE_NXDOMAIN, RCODE_NOERROR
+
+# Error classes recorded for failed domains
+DNS = 'dns'
+DNS_TEMPORARY = 'dns_temporary'
+REFUSED = 'refused'
+TIMEOUT = 'timeout'
+TCP_TIMEOUT = 'tcp_timeout'
+HANDSHAKE_TIMEOUT = 'handshake_timeout'
+RESET = 'reset'
+UNREACHABLE = 'unreachable'
+TLS = 'tls'
+TLS_ALERT = 'tls_alert'
+OTHER = 'other'
+
+# Classes worth another attempt later; the rest will fail the same way again
+RETRYABLE = {DNS_TEMPORARY, TIMEOUT, TCP_TIMEOUT, HANDSHAKE_TIMEOUT, RESET, UNREACHABLE}
+
+class ConnectTimeout(TimeoutError):
+    """The TCP connection was not established in time."""
+
+class HandshakeTimeout(TimeoutError):
+    """The TCP connection was up but the TLS handshake did not finish in time."""
+
+def classify_error(error):
+    """
+    Map an exception raised while scanning a domain to one of the error
+    classes above.
+    """
+    if isinstance(error, DNSError):
+        if error.rcode in (RCODE_NXDOMAIN, RCODE_NOERROR):
+            return DNS
+        return DNS_TEMPORARY
+    if isinstance(error, socket.gaierror):
+        if error.errno in (socket.EAI_AGAIN, getattr(socket, 'EAI_SYSTEM', None)):
+            return DNS_TEMPORARY
+        return DNS
+    if isinstance(error, ConnectTimeout):
+        return TCP_TIMEOUT
+    if isinstance(error, HandshakeTimeout):
+        return HANDSHAKE_TIMEOUT
+    if isinstance(error, (TimeoutError, asyncio.TimeoutError, socket.timeout)):
+        return TIMEOUT
+    if isinstance(error, ConnectionRefusedError):
+        return REFUSED
+    if isinstance(error, (ConnectionResetError, ConnectionAbortedError, BrokenPipeError,
+                          SSL.SysCallError, SSL.ZeroReturnError)):
+        return RESET
+    if isinstance(error, (SSL.Error, ssl.SSLError)):
+        # The server answered with an alert, e.g. 'sslv3 alert handshake failure'
+        if 'alert' in str(error).lower():
+            return TLS_ALERT
+        return TLS
+    if isinstance(error, OSError) and error.errno in (errno.ENETUNREACH, errno.EHOSTUNREACH):
+        return UNREACHABLE
+    return OTHER
+
+def is_retryable(error_class):
+    return error_class in RETRYABLE
@@ -0,0 +1,196 @@
+import bisect
+import json
+import os
+import threading
+import time
+from collections import Counter
+
+# Phases of a scan that are timed
+DNS = 'dns'
+CONNECT = 'connect'
+HANDSHAKE = 'handshake'
+PARSE = 'parse'
+WRITE = 'write'
+PHASES = (DNS, CONNECT, HANDSHAKE, PARSE, WRITE)
+
+# Histogram bucket upper bounds in seconds, 100us to 60s
+BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+           0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+class Histogram:
+    # Fixed buckets: observing is a bisect and two additions
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, seconds):
+        self.counts[bisect.bisect_left(self.buckets, seconds)] += 1
+        self.count += 1
+        self.sum += seconds
+
+    def quantile(self, q):
+        # Upper bound of the bucket holding the q-th observation
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.buckets + (float('inf'),), self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return float('inf')
+
+class ScanMetrics:
+    """
+    Counters and per-phase timing histograms for one scan. Shared by the
+    event loop, worker threads and the writer thread; every update takes a
+    lock for a few hundred nanoseconds.
+
+    Network phases (dns, connect, handshake) overlap across connections,
+    while parsing runs on the scanning thread(s) and writing on the writer
+    thread, so parse and write time over wall time is how busy those
+    threads are: near 100% means the scan is CPU or disk bound.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.phases = {phase: Histogram() for phase in PHASES}
+        self.results = Counter()
+        self.errors = Counter()
+        self.in_flight = 0
+        self.start_time = time.time()
+        self._start_cpu = time.process_time()
+
+    def observe(self, phase, seconds):
+        with self._lock:
+            self.phases[phase].observe(seconds)
+
+    def started(self):
+        with self._lock:
+            self.in_flight += 1
+
+    def finished(self):
+        with self._lock:
+            self.in_flight -= 1
+
+    def record_result(self, error_class=None):
+        # One final result per domain; error_class is None on success
+        with self._lock:
+            self.results['success' if error_class is None else 'error'] += 1
+            if error_class is not None:
+                self.errors[error_class] += 1
+
+    def snapshot(self):
+        """Plain-data view of the current values, as written to JSON."""
+        with self._lock:
+            elapsed = max(time.time() - self.start_time, 1e-9)
+            domains = sum(self.results.values())
+            return {
+                'timestamp': time.time(),
+                'elapsed_seconds': elapsed,
+                'domains': domains,
+                'domains_per_second': domains / elapsed,
+                'in_flight': self.in_flight,
+                'results': dict(self.results),
+                'errors': dict(self.errors),
+                'cpu_utilization': (time.process_time() - self._start_cpu) / elapsed,
+                'phases': {phase: {
+                    'count': histogram.count,
+                    'sum_seconds': histogram.sum,
+                    'utilization': histogram.sum / elapsed,
+                    'p50': histogram.quantile(0.5),
+                    'p99': histogram.quantile(0.99),
+                    'buckets': dict(zip([str(bound) for bound in histogram.buckets] + ['+Inf'],
+                                        histogram.counts)),
+                } for phase, histogram in self.phases.items()},
+            }
+
+    def progress_line(self):
+        snapshot = self.snapshot()
+        parts = [f"{snapshot['domains']} domains ({snapshot['domains_per_second']:.1f}/s)",
+                 f"in flight {snapshot['in_flight']}",
+                 f"errors {sum(snapshot['errors'].values())}"]
+        for phase, values in snapshot['phases'].items():
+            if values['count']:
+                parts.append(f"{phase} p50 {values['p50'] * 1000:g}ms p99 {values['p99'] * 1000:g}ms")
+        parts.append(f"cpu {snapshot['cpu_utilization']:.0%}")
+        parts.append(f"parse {snapshot['phases'][PARSE]['utilization']:.0%}")
+        parts.append(f"write {snapshot['phases'][WRITE]['utilization']:.0%}")
+        return ' | '.join(parts)
+
+    def to_prometheus(self):
+        """Prometheus text exposition format, e.g. for node_exporter's textfile collector."""
+        snapshot = self.snapshot()
+        lines = [
+            '# TYPE scan_domains_total counter',
+            *(f'scan_domains_total{{result="{result}"}} {count}'
+              for result, count in sorted(snapshot['results'].items())),
+            '# TYPE scan_errors_total counter',
+            *(f'scan_errors_total{{class="{error_class}"}} {count}'
+              for error_class, count in sorted(snapshot['errors'].items())),
+            '# TYPE scan_in_flight gauge',
+            f"scan_in_flight {snapshot['in_flight']}",
+            '# TYPE scan_domains_per_second gauge',
+            f"scan_domains_per_second {snapshot['domains_per_second']}",
+            '# TYPE scan_cpu_utilization gauge',
+            f"scan_cpu_utilization {snapshot['cpu_utilization']}",
+            '# TYPE scan_phase_seconds histogram',
+        ]
+        for phase, values in snapshot['phases'].items():
+            cumulative = 0
+            for bound, count in values['buckets'].items():
+                cumulative += count
+                lines.append(f'scan_phase_seconds_bucket{{phase="{phase}",le="{bound}"}} {cumulative}')
+            lines.append(f'scan_phase_seconds_sum{{phase="{phase}"}} {values["sum_seconds"]}')
+            lines.append(f'scan_phase_seconds_count{{phase="{phase}"}} {values["count"]}')
+        return '\n'.join(lines) + '\n'
+
+    def write(self, json_path=None, prometheus_path=None):
+        # Replace the files atomically so readers never see half of one
+        if json_path:
+            write_atomic(json_path, json.dumps(self.snapshot(), indent=2))
+        if prometheus_path:
+            write_atomic(prometheus_path, self.to_prometheus())
+
+def write_atomic(path, text):
+    # Write 'path' through a temporary file, so readers never see half of it
+    with open(path + '.tmp', mode='w', encoding='utf-8') as file:
+        file.write(text)
+    os.replace(path + '.tmp', path)
+
+class MetricsReporter:
+    """
+    Background thread printing a progress line and rewriting the metrics
+    files every 'interval' seconds, and once more when stopped.
+    """
+    def __init__(self, metrics, interval=10.0, json_path=None, prometheus_path=None):
+        self.metrics = metrics
+        self.interval = interval
+        self.json_path = json_path
+        self.prometheus_path = prometheus_path
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='scan-metrics', daemon=True)
+
+    def _report(self):
+        print(self.metrics.progress_line(), flush=True)
+        self.metrics.write(self.json_path, self.prometheus_path)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self._report()
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+        self._report()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc, tb):
+        self.stop()
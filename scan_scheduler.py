@@ -0,0 +1,107 @@
+from collections import Counter, defaultdict, deque
+from scan_errors import classify_error, is_retryable
+
+class AdaptiveTimeout:
+    """
+    Timeout for first attempts, derived from how long successful
+    handshakes take: 'factor' times their 'percentile', kept between
+    'minimum' and 'maximum'. 'initial' is used until 'min_samples'
+    successes have been seen. The percentile is recomputed every
+    'min_samples' new samples over the last 'window' ones.
+    """
+    def __init__(self, initial=5.0, percentile=95, factor=2.0, minimum=2.0, maximum=30.0,
+                 window=10000, min_samples=100):
+        self.percentile = percentile
+        self.factor = factor
+        self.minimum = minimum
+        self.maximum = maximum
+        self.min_samples = min_samples
+        self._samples = deque(maxlen=window)
+        self._since_update = 0
+        self._value = initial
+
+    def record(self, seconds):
+        self._samples.append(seconds)
+        self._since_update += 1
+        if self._since_update >= self.min_samples:
+            self._since_update = 0
+            ordered = sorted(self._samples)
+            observed = ordered[min(len(ordered) * self.percentile // 100, len(ordered) - 1)]
+            self._value = min(max(observed * self.factor, self.minimum), self.maximum)
+
+    def __call__(self):
+        return self._value
+
+class FailureStats:
+    # Attempts and seconds spent per outcome ('success' or an error class)
+    def __init__(self):
+        self.counts = Counter()
+        self.seconds = defaultdict(float)
+
+    def record(self, outcome, seconds):
+        self.counts[outcome] += 1
+        self.seconds[outcome] += seconds or 0.0
+
+    def summary(self):
+        return ', '.join(f"{outcome}: {count} ({self.seconds[outcome]:.0f}s)"
+                         for outcome, count in self.counts.most_common())
+
+class RetryScheduler:
+    """
+    Two-phase timeout policy shared by the scanners. Every domain is first
+    tried with the short adaptive timeout; domains failing with a retryable
+    error (timeouts, resets, temporary DNS failures) are queued and tried
+    again in later rounds. Round n waits retry_delay * backoff**(n-1)
+    seconds before starting and uses a timeout of
+    retry_timeout * backoff**(n-1), capped at max_timeout. A domain gets at
+    most 'max_attempts' attempts in total.
+
+    The scanner reports each attempt with record(), which says whether the
+    result is final, and asks next_round() for more work once a pass is done.
+    """
+    def __init__(self, max_attempts=3, first_timeout=None, retry_timeout=30.0, max_timeout=120.0,
+                 backoff=2.0, retry_delay=5.0):
+        self.max_attempts = max_attempts
+        self.first_timeout = first_timeout if first_timeout is not None else AdaptiveTimeout()
+        self.retry_timeout = retry_timeout
+        self.max_timeout = max_timeout
+        self.backoff = backoff
+        self.retry_delay = retry_delay
+        self.stats = FailureStats()
+        self.round = 0
+        self._attempts = {}
+        self._retry = []
+
+    def record(self, domain, error, elapsed=None):
+        """
+        Record one attempt. Returns True if this is the domain's final
+        result, False if it was queued for another round.
+        """
+        if error is None:
+            self.stats.record('success', elapsed)
+            if self.round == 0 and elapsed is not None:
+                self.first_timeout.record(elapsed)
+            self._attempts.pop(domain, None)
+            return True
+
+        error_class = classify_error(error)
+        self.stats.record(error_class, elapsed)
+        attempts = self._attempts.get(domain, 0) + 1
+        if is_retryable(error_class) and attempts < self.max_attempts:
+            self._attempts[domain] = attempts
+            self._retry.append(domain)
+            return False
+        self._attempts.pop(domain, None)
+        return True
+
+    def next_round(self):
+        """
+        Start the next retry round: returns (delay, timeout, domains), or
+        None when nothing is left to retry.
+        """
+        if not self._retry:
+            return None
+        self.round += 1
+        domains, self._retry = self._retry, []
+        scale = self.backoff ** (self.round - 1)
+        return self.retry_delay * scale, min(self.retry_timeout * scale, self.max_timeout), domains
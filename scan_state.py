@@ -0,0 +1,115 @@
+import sqlite3
+import threading
+import time
+from scan_errors import classify_error, is_retryable
+
+SUCCESS = 'success'
+FAILED = 'failed'
+
+class ScanState:
+    """
+    Persistent per-domain scan status kept in a SQLite database in WAL mode,
+    so an interrupted scan can be resumed. Updates are buffered and
+    committed every 'commit_size' records or 'commit_interval' seconds,
+    which bounds how much work a crash can lose.
+    Safe to share between threads.
+    """
+    def __init__(self, path, commit_size=1000, commit_interval=5.0):
+        self.commit_size = commit_size
+        self.commit_interval = commit_interval
+        self._lock = threading.Lock()
+        self._buffer = []
+        self._last_commit = time.monotonic()
+        # Domains pending() left out so far
+        self.skipped = 0
+
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS domains (
+                domain TEXT PRIMARY KEY,
+                status TEXT NOT NULL,
+                error_class TEXT,
+                retryable INTEGER NOT NULL DEFAULT 0,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                updated_at REAL NOT NULL
+            )""")
+        self.conn.commit()
+
+    def record_success(self, domain):
+        self._record(domain, SUCCESS, None, False)
+
+    def record_failure(self, domain, error):
+        error_class = classify_error(error)
+        self._record(domain, FAILED, error_class, is_retryable(error_class))
+
+    def record_successes(self, domains):
+        for domain in domains:
+            self.record_success(domain)
+
+    def _record(self, domain, status, error_class, retryable):
+        with self._lock:
+            self._buffer.append((domain, status, error_class, int(retryable), time.time()))
+            if (len(self._buffer) >= self.commit_size
+                    or time.monotonic() - self._last_commit >= self.commit_interval):
+                self._commit()
+
+    def _commit(self):
+        # Caller holds the lock
+        if self._buffer:
+            self.conn.executemany("""
+                INSERT INTO domains (domain, status, error_class, retryable, attempts, updated_at)
+                VALUES (?, ?, ?, ?, 1, ?)
+                ON CONFLICT(domain) DO UPDATE SET
+                    status = excluded.status,
+                    error_class = excluded.error_class,
+                    retryable = excluded.retryable,
+                    attempts = attempts + 1,
+                    updated_at = excluded.updated_at""", self._buffer)
+            self.conn.commit()
+            self._buffer = []
+        self._last_commit = time.monotonic()
+
+    def should_scan(self, domain, max_attempts=3):
+        """
+        True if the domain was never attempted, or failed with a retryable
+        error fewer than 'max_attempts' times.
+        """
+        with self._lock:
+            row = self.conn.execute(
+                "SELECT status, retryable, attempts FROM domains WHERE domain = ?",
+                (domain,)).fetchone()
+        if row is None:
+            return True
+        status, retryable, attempts = row
+        return status == FAILED and bool(retryable) and attempts < max_attempts
+
+    def pending(self, domains, max_attempts=3):
+        # Lazily skip domains that are already done or have given up
+        for domain in domains:
+            if self.should_scan(domain, max_attempts):
+                yield domain
+            else:
+                self.skipped += 1
+
+    def summary(self):
+        """
+        Return {(status, error_class): count} for everything recorded so far.
+        """
+        with self._lock:
+            self._commit()
+            rows = self.conn.execute(
+                "SELECT status, error_class, COUNT(*) FROM domains GROUP BY status, error_class").fetchall()
+        return {(status, error_class): count for status, error_class, count in rows}
+
+    def close(self):
+        with self._lock:
+            self._commit()
+            self.conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
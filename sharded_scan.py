@@ -0,0 +1,237 @@
+import argparse
+import asyncio
+import csv
+import heapq
+import os
+import time
+import zlib
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
+from cert_writer import FIELDNAMES, CertChainWriter, CsvSink
+from destination_limits import DestinationLimits
+from der_archive import DerArchive
+from dns_resolver import AsyncResolver
+from scan_errors import classify_error
+from scan_metrics import MetricsReporter, ScanMetrics
+from scan_scheduler import RetryScheduler
+from scan_state import ScanState
+import scan_async
+
+# Shard outputs carry each domain's line number in the input so the merge
+# can restore input order
+SHARD_FIELDNAMES = ['rank', 'chain_position'] + FIELDNAMES
+
+def shard_of(domain, shards):
+    # Stable across processes and runs, unlike hash()
+    return zlib.crc32(domain.encode('utf-8')) % shards
+
+def shard_path(output_file, shard):
+    base, ext = os.path.splitext(output_file)
+    return f'{base}.shard{shard:03d}{ext or ".csv"}'
+
+def _shard_domains(input_file, shard, shards):
+    # (rank, domain) of this shard's input lines, read lazily
+    with open(input_file, mode='r', newline='', encoding='utf-8') as infile:
+        for rank, row in enumerate(csv.reader(infile)):
+            if row and shard_of(row[0], shards) == shard:
+                yield rank, row[0]
+
+async def _scan_shard(input_file, shard, shards, output_file, concurrency, scheduler,
+                      resolve, state_file, max_attempts, port, limits, metrics_dir, archive_dir,
+                      fast_handshake):
+    resolver = AsyncResolver() if resolve else None
+    state = ScanState(state_file) if state_file else None
+    on_flush = state.record_successes if state else None
+    # Ranks of the domains handed to the scanner and not finished yet
+    ranks = {}
+
+    def domains():
+        for rank, domain in _shard_domains(input_file, shard, shards):
+            if state is None or state.should_scan(domain, max_attempts):
+                ranks.setdefault(domain, deque()).append(rank)
+                yield domain
+            else:
+                state.skipped += 1
+
+    scanned = 0
+    sink = CsvSink(output_file, SHARD_FIELDNAMES)
+    metrics = ScanMetrics()
+    archive = DerArchive(os.path.join(archive_dir, f'shard{shard:03d}')) if archive_dir else None
+    metrics_base = os.path.join(metrics_dir, f'shard{shard:03d}') if metrics_dir else None
+    with MetricsReporter(metrics, json_path=metrics_base and metrics_base + '.json',
+                         prometheus_path=metrics_base and metrics_base + '.prom'), \
+         CertChainWriter(flush_size=1000, sink=sink, on_flush=on_flush, metrics=metrics,
+                         archive=archive) as writer:
+        async for result in scan_async.scan_with_retries(domains(), scheduler, concurrency, port,
+                                                         resolver=resolver, limits=limits,
+                                                         metrics=metrics, fast_handshake=fast_handshake):
+            scanned += 1
+            metrics.record_result(None if result.error is None else classify_error(result.error))
+            pending = ranks[result.domain]
+            rank = pending.popleft()
+            if not pending:
+                del ranks[result.domain]
+
+            if result.error is not None:
+                if state:
+                    state.record_failure(result.domain, result.error)
+            else:
+                writer.write(result.domain, [dict(cert, rank=rank) for cert in result.cert_chain])
+
+    if resolver is not None:
+        resolver.close()
+    if archive is not None:
+        archive.close()
+    if state:
+        print(f"Shard {shard}: skipped {state.skipped} domains already done or given up in {state_file}")
+        state.close()
+    return scanned
+
+def scan_shard(input_file, shard, shards, output_file, concurrency=1000, scheduler=None,
+               resolve=True, state_file=None, max_attempts=3, port=443, limits=None,
+               metrics_dir=None, archive_dir=None, fast_handshake=False):
+    """
+    Scan the domains of one shard with the asyncio engine. Runs in a
+    worker process, so certificate parsing and TLS work of different
+    shards happen on different cores. Destination limits apply per shard.
+    Metrics go to '<metrics_dir>/shardNNN.json' and '.prom' if given, raw
+    DER chains to the archive '<archive_dir>/shardNNN'.
+    """
+    fd_limit = scan_async.raise_fd_limit()
+    concurrency = min(concurrency, max(fd_limit - 64, 1))
+    if scheduler is None:
+        scheduler = RetryScheduler(max_attempts)
+    if limits is None and resolve:
+        limits = DestinationLimits()
+    start_time = time.time()
+    scanned = asyncio.run(_scan_shard(input_file, shard, shards, output_file, concurrency, scheduler,
+                                      resolve, state_file, max_attempts, port, limits, metrics_dir,
+                                      archive_dir, fast_handshake))
+    cache = scan_async.cert_cache
+    print(f"Shard {shard}: {scanned} domains in {time.time() - start_time:.1f}s, "
+          f"certificate cache {cache.hit_rate:.1%} hit rate, attempts {scheduler.stats.summary()}")
+    return scanned
+
+def _sort_key(row):
+    return int(row['rank']), int(row['chain_position'])
+
+def _write_shard(path, rows):
+    with open(path, mode='w', newline='', encoding='utf-8') as file:
+        writer = csv.DictWriter(file, fieldnames=SHARD_FIELDNAMES)
+        writer.writeheader()
+        writer.writerows(rows)
+
+def sort_shard(path, run_rows=500000):
+    """
+    Rewrite a shard output in (rank, chain_position) order with an external
+    sort: runs of 'run_rows' rows are sorted and written to temporary files,
+    then merged, so memory is bounded by 'run_rows' whatever the shard size.
+    """
+    runs = []
+    try:
+        with open(path, mode='r', newline='', encoding='utf-8') as file:
+            reader = csv.DictReader(file)
+            while True:
+                rows = sorted(islice(reader, run_rows), key=_sort_key)
+                if not rows:
+                    break
+                runs.append(f'{path}.run{len(runs):05d}.tmp')
+                _write_shard(runs[-1], rows)
+        _write_shard(path + '.tmp', heapq.merge(*(_read_shard(run) for run in runs), key=_sort_key))
+        os.replace(path + '.tmp', path)
+    finally:
+        for run in runs:
+            if os.path.exists(run):
+                os.remove(run)
+
+def _read_shard(path):
+    with open(path, mode='r', newline='', encoding='utf-8') as file:
+        yield from csv.DictReader(file)
+
+def merge_shards(shard_files, output_file):
+    """
+    Combine sorted shard outputs into one CSV in input order, with the
+    usual columns. The result does not depend on how the shards were
+    scheduled or which finished first.
+    """
+    merged = heapq.merge(*(_read_shard(path) for path in shard_files), key=_sort_key)
+    rows = 0
+    with open(output_file, mode='w', newline='', encoding='utf-8') as file:
+        writer = csv.DictWriter(file, fieldnames=FIELDNAMES, extrasaction='ignore')
+        writer.writeheader()
+        for row in merged:
+            writer.writerow(row)
+            rows += 1
+    return rows
+
+def process_domains_sharded(input_file, output_file, shards=None, concurrency=1000, scheduler=None,
+                            resolve=True, state_file=None, max_attempts=3, port=443, limits=None,
+                            metrics_dir=None, archive_dir=None, fast_handshake=False):
+    """
+    Split the input domains across 'shards' worker processes by a hash of
+    the domain, each running its own scanner with 'concurrency' handshakes
+    in flight and its own copy of 'scheduler' (a RetryScheduler), and
+    writing its own output, then merge the shard outputs into
+    'output_file'. Shard outputs (and state files, '<state_file>.shardNNN')
+    are kept, so an interrupted scan resumes with the same number of shards.
+    Without 'state_file' nothing is resumed and old shard outputs are
+    truncated, so their rows are not merged in twice.
+    """
+    shards = shards or os.cpu_count()
+    shard_files = [shard_path(output_file, shard) for shard in range(shards)]
+    if not state_file:
+        for path in shard_files:
+            open(path, mode='w').close()
+    start_time = time.time()
+    if metrics_dir:
+        os.makedirs(metrics_dir, exist_ok=True)
+
+    with ProcessPoolExecutor(max_workers=shards) as executor:
+        futures = [executor.submit(scan_shard, input_file, shard, shards, shard_files[shard],
+                                   concurrency, scheduler, resolve,
+                                   f'{state_file}.shard{shard:03d}' if state_file else None,
+                                   max_attempts, port, limits, metrics_dir, archive_dir,
+                                   fast_handshake)
+                   for shard in range(shards)]
+        scanned = sum(future.result() for future in futures)
+        elapsed = time.time() - start_time
+        print(f"Scanned {scanned} domains in {elapsed:.1f}s ({scanned / max(elapsed, 1e-9):.1f} domains/sec)")
+
+        # Shards are sorted in parallel too; the merge itself only streams
+        list(executor.map(sort_shard, shard_files))
+
+    rows = merge_shards(shard_files, output_file)
+    print(f"Merged {rows} rows from {shards} shards into {output_file}")
+
+def main():
+    parser = argparse.ArgumentParser(description='Scan certificate chains with one process per shard.')
+    parser.add_argument('input_file')
+    parser.add_argument('output_file')
+    parser.add_argument('--shards', type=int, default=None, help='worker processes (default: one per CPU)')
+    parser.add_argument('--concurrency', type=int, default=1000, help='handshakes in flight per shard')
+    parser.add_argument('--max-attempts', type=int, default=3)
+    parser.add_argument('--state-file', default=None)
+    parser.add_argument('--no-resolve', action='store_true', help='let the OS resolver look names up')
+    parser.add_argument('--per-destination', type=int, default=8,
+                        help='handshakes in flight per destination and shard')
+    parser.add_argument('--destination-rate', type=float, default=None,
+                        help='new handshakes per second per destination and shard')
+    parser.add_argument('--destination-prefix', type=int, default=None,
+                        help='group IPv4 destinations by this prefix length, e.g. 24')
+    parser.add_argument('--metrics-dir', default=None,
+                        help='write per-shard metrics (JSON and Prometheus text) here')
+    parser.add_argument('--archive-dir', default=None,
+                        help='append raw DER chains to one archive per shard under this directory')
+    parser.add_argument('--fast-handshake', action='store_true',
+                        help='negotiate TLS 1.2 or 1.3 and reset each connection once the chain is in')
+    args = parser.parse_args()
+
+    limits = DestinationLimits(args.per_destination, args.destination_rate, prefix=args.destination_prefix)
+    process_domains_sharded(args.input_file, args.output_file, args.shards, args.concurrency,
+                            resolve=not args.no_resolve, state_file=args.state_file,
+                            max_attempts=args.max_attempts, limits=limits, metrics_dir=args.metrics_dir,
+                            archive_dir=args.archive_dir, fast_handshake=args.fast_handshake)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,131 @@
+import constants
+
+def load_public_suffix_list(path):
+    """
+    Read the rules of a Public Suffix List file (public_suffix_list.dat)
+    into a set, skipping comments and blank lines.
+    """
+    rules = set()
+    with open(path, mode='r', encoding='utf-8') as file:
+        for line in file:
+            rule = line.split('//', 1)[0].strip()
+            if rule:
+                rules.add(rule.lower())
+    return rules
+
+class SuffixClassifier:
+    """
+    Maps a domain to the region and suffix it belongs to with hash lookups
+    on its last labels, instead of trying every suffix with endswith().
+
+    'regions' maps region names to suffix lists as in constants.py; a suffix
+    may have several labels ('.co.uk'). When a Public Suffix List file is
+    given, public_suffix() returns a domain's public suffix from it and
+    classify_series() adds it as a 'public_suffix' column ('co.in',
+    'com.br'), which the region lists do not always go down to.
+    """
+    def __init__(self, regions=None, public_suffix_file=None):
+        if regions is None:
+            regions = constants.regions
+
+        # 'de' -> ('.de', ('eu',)); a suffix listed in several regions keeps all of them
+        self._entries = {}
+        for region, suffixes in regions.items():
+            for suffix in suffixes:
+                key = suffix.strip('.').lower()
+                dotted, matched = self._entries.get(key, ('.' + key, ()))
+                if region not in matched:
+                    self._entries[key] = (dotted, matched + (region,))
+        self.max_labels = max((key.count('.') + 1 for key in self._entries), default=0)
+
+        self._public_suffixes = None
+        if public_suffix_file is not None:
+            self._public_suffixes = load_public_suffix_list(public_suffix_file)
+
+    def _longest_match(self, domain):
+        # Try 'de', then 'example.de' style keys, keeping the longest hit.
+        # A key only counts if a label precedes it, like endswith('.de')
+        best = None
+        pos = len(domain)
+        for _ in range(self.max_labels):
+            pos = domain.rfind('.', 0, pos)
+            if pos < 0:
+                break
+            entry = self._entries.get(domain[pos + 1:])
+            if entry is not None:
+                best = entry
+        return best
+
+    def classify(self, domain):
+        """
+        Return (region, suffix) for a domain, or (None, None) if it matches
+        no region. With overlapping regions the first listed one is returned.
+        """
+        entry = self._longest_match(domain.rstrip('.').lower())
+        if entry is None:
+            return None, None
+        return entry[1][0], entry[0]
+
+    def regions_for(self, domain):
+        # Every region the domain's suffix belongs to
+        entry = self._longest_match(domain.rstrip('.').lower())
+        return () if entry is None else entry[1]
+
+    def matches(self, domain):
+        return self._longest_match(domain.rstrip('.').lower()) is not None
+
+    def classify_series(self, domains):
+        """
+        Vectorized classify() for a pandas Series of domains. Returns a
+        DataFrame with 'region' and 'suffix' columns (NaN where no match),
+        and 'public_suffix' when a Public Suffix List was loaded.
+        """
+        import pandas as pd
+
+        columns = ['region', 'suffix'] + (['public_suffix'] if self._public_suffixes is not None else [])
+        if domains.empty:
+            return pd.DataFrame({column: [] for column in columns}, index=domains.index, dtype=object)
+
+        domains = domains.str.rstrip('.').str.lower()
+        keys = pd.Series(self._entries.keys())
+        head = domains
+        key = None
+        matched_key = pd.Series(None, index=domains.index, dtype=object)
+        for _ in range(self.max_labels):
+            # Peel one more label off the end; longer matches overwrite shorter ones
+            parts = head.str.rpartition('.')
+            key = parts[2] if key is None else parts[2] + '.' + key
+            matched = (parts[1] == '.') & key.isin(keys)
+            matched_key = matched_key.mask(matched, key)
+            head = parts[0]
+
+        result = pd.DataFrame({
+            'region': matched_key.map({name: entry[1][0] for name, entry in self._entries.items()}),
+            'suffix': matched_key.map({name: entry[0] for name, entry in self._entries.items()}),
+        }, index=domains.index)
+        if self._public_suffixes is not None:
+            # Top lists repeat few suffixes; look each distinct domain up once
+            distinct = domains.unique()
+            result['public_suffix'] = domains.map(dict(zip(distinct, map(self.public_suffix, distinct))))
+        return result
+
+    def public_suffix(self, domain):
+        """
+        Return the public suffix of a domain per the Public Suffix List
+        rules (including '*.' wildcards and '!' exceptions), or its last
+        label when no list was loaded or no rule matches.
+        """
+        labels = domain.rstrip('.').lower().split('.')
+        if self._public_suffixes is None:
+            return labels[-1]
+
+        rules = self._public_suffixes
+        for start in range(len(labels)):
+            candidate = '.'.join(labels[start:])
+            if '!' + candidate in rules:
+                return '.'.join(labels[start + 1:])
+            if candidate in rules:
+                return candidate
+            if start + 1 < len(labels) and '*.' + '.'.join(labels[start + 1:]) in rules:
+                return candidate
+        return labels[-1]
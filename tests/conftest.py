@@ -0,0 +1,14 @@
+import os
+import sys
+import pytest
+
+# The modules live at the top of the repository, not in a package
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from tls_farm import TLSFarm
+
+@pytest.fixture(scope='session')
+def farm():
+    # One TLS server process and its stub DNS server, without injected faults
+    with TLSFarm(processes=1, chains=1, slow=0, blackhole=0, reset=0) as farm:
+        yield farm
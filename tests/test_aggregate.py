@@ -0,0 +1,82 @@
+import random
+import pandas as pd
+import pytest
+import analyze_certificates as analysis
+from aggregate_cube import ALL_SUFFIXES, load_cube
+from tls_farm import ISSUERS
+
+SUFFIXES = ['de', 'fr', 'com.br', 'in', 'ru', 'com']
+
+def chain_rows(domains=300, seed=0):
+    # Scan output rows, one per certificate of each chain; some domains
+    # are scanned twice, as after a crash, and keep their first chain
+    rng = random.Random(seed)
+    names = [f'site{index}.{rng.choice(SUFFIXES)}' for index in range(domains)]
+    rows = []
+    for domain in names + rng.sample(names, domains // 10):
+        for position in range(rng.randint(1, 3)):
+            organization, country = rng.choice(ISSUERS)
+            organization = organization.replace(',', '\\,')
+            rows.append({
+                'domain': domain,
+                'chain_position': position,
+                'subject': f'CN={domain}',
+                'issuer': f'CN=CA {position},O={organization},C={country}',
+                'not_before': '2024-01-01 00:00:00',
+                'not_after': f'{rng.choice([2024, 2025, 2026])}-0{rng.randint(1, 9)}-01 00:00:00',
+            })
+    return pd.DataFrame(rows)
+
+def write_csv(rows, path):
+    # The CSV output has no chain_position column
+    rows.drop(columns='chain_position').to_csv(path, index=False)
+    return str(path)
+
+def write_parquet(rows, path, part_rows=200):
+    path.mkdir()
+    for part, start in enumerate(range(0, len(rows), part_rows)):
+        rows.iloc[start:start + part_rows].to_parquet(path / f'part-{part:05d}.parquet', index=False)
+    return str(path)
+
+def normalized(counts):
+    # One count per key, whatever dtypes the keys were built with
+    keys = ['suffix', 'company', 'country', 'expiration_group']
+    counts = counts.astype({key: str for key in keys})
+    return counts.groupby(keys)['count'].sum().astype('int64').sort_index()
+
+@pytest.fixture(params=['csv', 'parquet'])
+def scan_output(request, tmp_path):
+    rows = chain_rows()
+    if request.param == 'parquet':
+        pytest.importorskip('pyarrow')
+        return write_parquet(rows, tmp_path / 'certs.parquet'), rows
+    return write_csv(rows, tmp_path / 'certs.csv'), rows
+
+def in_memory(filename):
+    df = analysis.load_leaf_certificates(filename)
+    return normalized(analysis.aggregate_counts(analysis.prepare_certificates(df, ALL_SUFFIXES)))
+
+@pytest.mark.parametrize('chunksize', [7, 64, 100000])
+def test_chunked_matches_in_memory(scan_output, chunksize):
+    filename, _ = scan_output
+    chunked = normalized(analysis.aggregate_certificates(filename, ALL_SUFFIXES, chunksize))
+    pd.testing.assert_series_equal(chunked, in_memory(filename))
+
+def test_rescanned_domains_count_once(scan_output):
+    filename, rows = scan_output
+    first_chains = rows[rows['chain_position'] == 0].drop_duplicates(subset='domain')
+    for leaves in [analysis.load_leaf_certificates(filename),
+                   pd.concat(analysis.iter_leaf_chunks(filename, chunksize=50))]:
+        assert leaves['domain'].tolist() == first_chains['domain'].tolist()
+        assert leaves['issuer'].astype(str).tolist() == first_chains['issuer'].tolist()
+
+def test_csv_and_parquet_agree(tmp_path):
+    pytest.importorskip('pyarrow')
+    rows = chain_rows(seed=1)
+    csv_counts = in_memory(write_csv(rows, tmp_path / 'certs.csv'))
+    parquet_counts = in_memory(write_parquet(rows, tmp_path / 'certs.parquet'))
+    pd.testing.assert_series_equal(csv_counts, parquet_counts)
+
+def test_cube_matches_in_memory(scan_output):
+    filename, _ = scan_output
+    pd.testing.assert_series_equal(normalized(load_cube(filename)), in_memory(filename))
@@ -0,0 +1,61 @@
+import asyncio
+from collections import Counter
+from destination_limits import DestinationLimits, DestinationQueue
+
+def drain(limits, items, workers=10, hold=0.01):
+    """
+    Put (item, address) pairs through a DestinationQueue served by
+    'workers' workers that hold each item for 'hold' seconds. Returns the
+    items in the order they were done and the most handshakes in flight
+    per destination.
+    """
+    async def main():
+        queue = DestinationQueue(limits, maxsize=len(items))
+        in_flight = Counter()
+        peak = Counter()
+        done = []
+
+        async def worker():
+            while True:
+                got = await queue.get()
+                if got is None:
+                    return
+                item, destination = got
+                in_flight[destination] += 1
+                peak[destination] = max(peak[destination], in_flight[destination])
+                await asyncio.sleep(hold)
+                in_flight[destination] -= 1
+                done.append(item)
+                await queue.release(destination)
+
+        tasks = [asyncio.ensure_future(worker()) for _ in range(workers)]
+        for item, address in items:
+            await queue.put(item, address)
+        await queue.close()
+        await asyncio.gather(*tasks)
+        return done, peak
+
+    return asyncio.run(main())
+
+def test_per_destination_cap():
+    items = [(index, '127.1.0.1' if index % 4 else '127.1.0.2') for index in range(40)]
+    done, peak = drain(DestinationLimits(per_destination=2), items)
+    assert sorted(done) == list(range(40))
+    assert peak == {'127.1.0.1': 2, '127.1.0.2': 2}
+
+def test_cap_applies_per_prefix():
+    items = [(index, f'127.1.0.{index % 8}') for index in range(24)]
+    done, peak = drain(DestinationLimits(per_destination=1, prefix=24), items)
+    assert sorted(done) == list(range(24))
+    assert list(peak.values()) == [1]
+
+def test_items_without_address_are_not_limited():
+    done, peak = drain(DestinationLimits(per_destination=1), [(index, None) for index in range(20)])
+    assert sorted(done) == list(range(20))
+    assert peak[None] > 1
+
+def test_busy_destination_does_not_block_others():
+    # Other destinations' items are handed out while the busy one is at its cap
+    items = [(index, '127.1.0.1') for index in range(10)] + [(10, '127.1.0.2')]
+    done, _ = drain(DestinationLimits(per_destination=1), items, workers=4)
+    assert done.index(10) < 3
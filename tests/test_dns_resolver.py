@@ -0,0 +1,139 @@
+import asyncio
+import socket
+import struct
+import threading
+import pytest
+from dns_resolver import RCODE_NXDOMAIN, AsyncResolver, DNSError, build_query
+from tls_farm import address_for, name_for
+
+def resolve_all(resolver, names):
+    # Resolve 'names' concurrently; DNSErrors are returned instead of raised
+    async def main():
+        try:
+            return await asyncio.gather(*(resolver.resolve(name) for name in names), return_exceptions=True)
+        finally:
+            resolver.close()
+    return asyncio.run(main())
+
+def test_resolves_through_stub_server(farm):
+    resolver = AsyncResolver([farm.nameserver], timeout=1.0)
+    assert resolve_all(resolver, [name_for(5)]) == [[address_for(5)]]
+
+def test_cache_hits_and_misses(farm):
+    resolver = AsyncResolver([farm.nameserver], timeout=1.0)
+
+    async def main():
+        try:
+            first = await resolver.resolve(name_for(7))
+            # Names are cached case-insensitively and without the root dot
+            again = await resolver.resolve(name_for(7).upper() + '.')
+            # Concurrent lookups of a new name share one query
+            together = await asyncio.gather(*(resolver.resolve(name_for(8)) for _ in range(5)))
+            return first, again, together
+        finally:
+            resolver.close()
+
+    first, again, together = asyncio.run(main())
+    assert first == again == [address_for(7)]
+    assert together == [[address_for(8)]] * 5
+    assert (resolver.misses, resolver.hits) == (2, 5)
+    assert resolver.stats()['cached_names'] == 2
+
+def test_ttl_expiry(farm):
+    # The stub answers with a 300 s TTL; max_ttl cuts it short
+    resolver = AsyncResolver([farm.nameserver], timeout=1.0, max_ttl=0.2)
+
+    async def main():
+        try:
+            await resolver.resolve(name_for(9))
+            await resolver.resolve(name_for(9))
+            await asyncio.sleep(0.3)
+            await resolver.resolve(name_for(9))
+        finally:
+            resolver.close()
+
+    asyncio.run(main())
+    assert (resolver.misses, resolver.hits) == (2, 1)
+
+def test_nxdomain_is_cached(farm):
+    resolver = AsyncResolver([farm.nameserver], timeout=1.0, negative_ttl=60)
+
+    async def main():
+        errors = []
+        for _ in range(2):
+            with pytest.raises(DNSError) as error:
+                await resolver.resolve('missing.example')
+            errors.append(error.value)
+        resolver.close()
+        return errors
+
+    assert [error.rcode for error in asyncio.run(main())] == [RCODE_NXDOMAIN] * 2
+    assert (resolver.misses, resolver.hits) == (1, 1)
+
+def test_nxdomain_not_cached_without_ttl(farm):
+    resolver = AsyncResolver([farm.nameserver], timeout=1.0, negative_ttl=0)
+
+    async def main():
+        for _ in range(2):
+            with pytest.raises(DNSError):
+                await resolver.resolve('missing.example')
+        resolver.close()
+
+    asyncio.run(main())
+    assert resolver.misses == 2
+
+class ForgingNameserver:
+    """
+    Nameserver in front of the farm's stub that answers every query with
+    forged responses first: the wrong id, another name's question, and the
+    right answer from another address. With 'honest', the stub's real
+    answer follows.
+    """
+    def __init__(self, upstream, honest):
+        self.upstream = upstream
+        self.honest = honest
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind(('127.0.0.1', 0))
+        self.address = self.sock.getsockname()
+        self.other = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.other.bind(('127.0.0.1', 0))
+        self.relay = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.relay.settimeout(1.0)
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _ask(self, query):
+        self.relay.sendto(query, self.upstream)
+        return self.relay.recvfrom(512)[0]
+
+    def _run(self):
+        while True:
+            try:
+                query, client = self.sock.recvfrom(512)
+            except OSError:
+                return
+            query_id, = struct.unpack_from('!H', query)
+            answer = self._ask(query)
+            self.sock.sendto(struct.pack('!H', query_id ^ 1) + answer[2:], client)
+            self.sock.sendto(self._ask(build_query(query_id, name_for(1))), client)
+            self.other.sendto(answer, client)
+            if self.honest:
+                self.sock.sendto(answer, client)
+
+    def close(self):
+        for sock in (self.sock, self.other, self.relay):
+            sock.close()
+
+@pytest.mark.parametrize('honest', [False, True])
+def test_mismatched_responses_are_ignored(farm, honest):
+    nameserver = ForgingNameserver(farm.nameserver, honest)
+    try:
+        resolver = AsyncResolver([nameserver.address], timeout=0.5, attempts=1)
+        result, = resolve_all(resolver, [name_for(3)])
+    finally:
+        nameserver.close()
+    if honest:
+        assert result == [address_for(3)]
+    else:
+        # Forged answers only: the query times out rather than taking one
+        assert isinstance(result, DNSError) and result.rcode is None
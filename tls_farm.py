@@ -0,0 +1,255 @@
+import asyncio
+import datetime
+import multiprocessing
+import os
+import socket
+import ssl
+import struct
+import tempfile
+import zlib
+from cryptography import x509
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import ec
+from cryptography.x509.oid import NameOID
+
+# Issuers the generated chains are signed by, as (organization, country)
+ISSUERS = [
+    ("Let's Encrypt", 'US'), ('DigiCert Inc', 'US'), ('Sectigo Limited', 'GB'),
+    ('GlobalSign nv-sa', 'BE'), ('GoDaddy.com, Inc.', 'US'), ('Google Trust Services', 'US'),
+    ('Amazon', 'US'), ('Certum', 'PL'), ('D-TRUST GmbH', 'DE'), ('Buypass AS-983163327', 'NO'),
+]
+
+# Kinds of endpoint served, chosen per destination address
+OK = 'ok'
+SLOW = 'slow'
+BLACKHOLE = 'blackhole'
+RESET = 'reset'
+
+# Names served by the stub DNS server: '127-1-0-5.bench' resolves to 127.1.0.5
+DNS_SUFFIX = '.bench'
+
+def address_for(index):
+    # A distinct loopback address per domain, avoiding 127.0.0.0/16
+    return f'127.{1 + index // 65536}.{index // 256 % 256}.{index % 256}'
+
+def name_for(index):
+    return address_for(index).replace('.', '-') + DNS_SUFFIX
+
+def endpoint_kind(address, slow=0.0, blackhole=0.0, reset=0.0):
+    # Deterministic per address, so the benchmark knows what each domain will do
+    draw = zlib.crc32(address.encode()) % 10000 / 10000
+    if draw < blackhole:
+        return BLACKHOLE
+    if draw < blackhole + reset:
+        return RESET
+    if draw < blackhole + reset + slow:
+        return SLOW
+    return OK
+
+def generate_chain(directory, index, intermediates):
+    """
+    Write a key and a certificate chain (leaf first, then 'intermediates'
+    CA certificates below a root that is not sent) to 'directory'.
+    Returns (certfile, keyfile).
+    """
+    now = datetime.datetime.now(datetime.timezone.utc)
+    organization, country = ISSUERS[index % len(ISSUERS)]
+    keys = [ec.generate_private_key(ec.SECP256R1()) for _ in range(intermediates + 2)]
+    names = [x509.Name([
+        x509.NameAttribute(NameOID.COUNTRY_NAME, country),
+        x509.NameAttribute(NameOID.ORGANIZATION_NAME, organization),
+        x509.NameAttribute(NameOID.COMMON_NAME, f'{organization} CA {level}'),
+    ]) for level in range(intermediates + 1)]
+    names.append(x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, f'bench-{index}')]))
+
+    certs = []
+    for level in range(1, len(names)):
+        builder = (x509.CertificateBuilder()
+                   .subject_name(names[level])
+                   .issuer_name(names[level - 1])
+                   .public_key(keys[level].public_key())
+                   .serial_number(x509.random_serial_number())
+                   .not_valid_before(now)
+                   .not_valid_after(now + datetime.timedelta(days=90 if level == len(names) - 1 else 3650)))
+        if level < len(names) - 1:
+            builder = builder.add_extension(x509.BasicConstraints(ca=True, path_length=None), critical=True)
+        certs.append(builder.sign(keys[level - 1], hashes.SHA256()))
+
+    certfile = os.path.join(directory, f'chain-{index}.pem')
+    keyfile = os.path.join(directory, f'key-{index}.pem')
+    with open(certfile, mode='wb') as file:
+        for cert in reversed(certs):
+            file.write(cert.public_bytes(serialization.Encoding.PEM))
+    with open(keyfile, mode='wb') as file:
+        file.write(keys[-1].private_bytes(serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8,
+                                          serialization.NoEncryption()))
+    return certfile, keyfile
+
+def _server_contexts(chains):
+    contexts = []
+    for certfile, keyfile in chains:
+        context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        context.minimum_version = ssl.TLSVersion.TLSv1_2
+        context.load_cert_chain(certfile, keyfile)
+        contexts.append(context)
+
+    def pick_chain(ssl_object, server_name, context):
+        # Each SNI name always gets the same chain
+        if server_name:
+            ssl_object.context = contexts[zlib.crc32(server_name.encode()) % len(contexts)]
+
+    for context in contexts:
+        context.sni_callback = pick_chain
+    return contexts[0]
+
+class _FarmProtocol(asyncio.Protocol):
+    # Reading is paused as soon as the connection is made, so no byte of the
+    # ClientHello is consumed before the TLS layer takes over
+    def __init__(self, context, faults, slow_delay):
+        self.context = context
+        self.faults = faults
+        self.slow_delay = slow_delay
+        self.closed = None
+
+    def connection_made(self, transport):
+        transport.pause_reading()
+        self.closed = asyncio.get_running_loop().create_future()
+        asyncio.ensure_future(self._run(transport))
+
+    def eof_received(self):
+        self._close()
+
+    def connection_lost(self, exc):
+        self._close()
+
+    def _close(self):
+        if not self.closed.done():
+            self.closed.set_result(None)
+
+    async def _run(self, transport):
+        kind = endpoint_kind(transport.get_extra_info('sockname')[0], **self.faults)
+        try:
+            if kind == BLACKHOLE:
+                # Accept the connection, never answer the ClientHello
+                transport.resume_reading()
+            elif kind == RESET:
+                sock = transport.get_extra_info('socket')
+                sock.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER, struct.pack('ii', 1, 0))
+                transport.abort()
+                return
+            else:
+                if kind == SLOW:
+                    await asyncio.sleep(self.slow_delay)
+                transport = await asyncio.get_running_loop().start_tls(
+                    transport, self, self.context, server_side=True)
+            # Keep the connection until the client is done with it
+            await asyncio.wait_for(self.closed, 60)
+        except Exception:
+            pass
+        finally:
+            transport.close()
+
+async def _serve(port, chains, faults, slow_delay, ready):
+    context = _server_contexts(chains)
+    server = await asyncio.get_running_loop().create_server(
+        lambda: _FarmProtocol(context, faults, slow_delay), '0.0.0.0', port, reuse_port=True, backlog=4096)
+    ready.set()
+    async with server:
+        await server.serve_forever()
+
+def _serve_process(port, chains, faults, slow_delay, ready):
+    asyncio.run(_serve(port, chains, faults, slow_delay, ready))
+
+def _dns_response(query):
+    # Answer 'a-b-c-d.bench' A queries with a.b.c.d, NXDOMAIN for anything else
+    query_id, = struct.unpack_from('!H', query)
+    offset, labels = 12, []
+    while query[offset]:
+        length = query[offset]
+        labels.append(query[offset + 1:offset + 1 + length].decode('ascii', 'replace'))
+        offset += length + 1
+    question = query[12:offset + 5]
+    name = '.'.join(labels).lower()
+    parts = name[:-len(DNS_SUFFIX)].split('-') if name.endswith(DNS_SUFFIX) else []
+    try:
+        address = socket.inet_aton('.'.join(parts)) if len(parts) == 4 else None
+    except OSError:
+        address = None
+    if address is None:
+        return struct.pack('!HHHHHH', query_id, 0x8183, 1, 0, 0, 0) + question
+    answer = b'\xc0\x0c' + struct.pack('!HHIH', 1, 1, 300, 4) + address
+    return struct.pack('!HHHHHH', query_id, 0x8180, 1, 1, 0, 0) + question + answer
+
+def _dns_process(sock):
+    while True:
+        query, client = sock.recvfrom(512)
+        try:
+            sock.sendto(_dns_response(query), client)
+        except (IndexError, struct.error):
+            pass
+
+class TLSFarm:
+    """
+    Local stand-in for the internet: 'processes' TLS server processes on one
+    port (SO_REUSEPORT) answering every loopback address, with a chain
+    picked per SNI name out of 'chains' generated ones of 1-4 certificates,
+    and a stub DNS server for '<a-b-c-d>.bench' names.
+
+    Destinations listed by endpoint_kind() as slow answer after
+    'slow_delay' seconds, black-holed ones never answer and resetting ones
+    send a TCP RST straight away. Use as a context manager.
+    """
+    def __init__(self, processes=None, chains=32, slow=0.05, blackhole=0.01, reset=0.01,
+                 slow_delay=0.5):
+        self.processes = processes or max(os.cpu_count() // 2, 1)
+        self.chain_count = chains
+        self.faults = {'slow': slow, 'blackhole': blackhole, 'reset': reset}
+        self.slow_delay = slow_delay
+        self.port = None
+        self.nameserver = None
+        self._workers = []
+
+    def kind(self, address):
+        return endpoint_kind(address, **self.faults)
+
+    def start(self):
+        self._directory = tempfile.TemporaryDirectory()
+        chains = [generate_chain(self._directory.name, index, index % 4)
+                  for index in range(self.chain_count)]
+
+        # Held, never listening, so the port stays ours until the servers bind it
+        self._reserved = socket.socket()
+        self._reserved.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        self._reserved.bind(('0.0.0.0', 0))
+        self.port = self._reserved.getsockname()[1]
+
+        for _ in range(self.processes):
+            ready = multiprocessing.Event()
+            worker = multiprocessing.Process(target=_serve_process, daemon=True,
+                                             args=(self.port, chains, self.faults, self.slow_delay, ready))
+            worker.start()
+            ready.wait()
+            self._workers.append(worker)
+
+        self._dns_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self._dns_socket.bind(('127.0.0.1', 0))
+        self.nameserver = self._dns_socket.getsockname()
+        worker = multiprocessing.Process(target=_dns_process, args=(self._dns_socket,), daemon=True)
+        worker.start()
+        self._workers.append(worker)
+        return self
+
+    def stop(self):
+        for worker in self._workers:
+            worker.terminate()
+            worker.join()
+        self._workers = []
+        self._dns_socket.close()
+        self._reserved.close()
+        self._directory.cleanup()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc, tb):
+        self.stop()